@@ -0,0 +1,234 @@
+"""
+Textual building reports on top of the zonal statistics, shared by the API (main.py) and its worker processes.
+
+Importing this module has no side effects: it creates no app, pools or open datasets, so the
+worker processes of main.BuildingWorkerPool import it instead of main.
+"""
+from typing import Dict, Optional
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+import logging
+from instrumentation import metrics, RequestTimings
+from terrain_stats import RasterDatasetPool, RasterService, BuildingStatsEngine
+
+logger = logging.getLogger(__name__)
+
+class InterpretationService:
+    def interpret_slope(self, slope_value: float) -> str:
+        logger.debug("Interpreting slope value: %s", slope_value)
+        if slope_value < 10:
+            return "gentle"
+        elif 10 <= slope_value < 30:
+            return "moderate"
+        else:
+            return "steep"
+
+    def interpret_aspect(self, aspect_value: float) -> str:
+        logger.debug("Interpreting aspect value: %s", aspect_value)
+        if 0 <= aspect_value < 45 or 315 <= aspect_value <= 360:
+            return "north"
+        elif 45 <= aspect_value < 135:
+            return "east"
+        elif 135 <= aspect_value < 225:
+            return "south"
+        elif 225 <= aspect_value < 315:
+            return "west"
+        else:
+            return "unknown"
+
+    def interpret_solar_potential(self, solar_value: float, solar_min: float, solar_max: float) -> str:
+        logger.debug("Interpreting solar potential value: %s with min: %s, max: %s", solar_value, solar_min, solar_max)
+        if solar_value is None or np.isnan(solar_value):
+            return "unknown"
+        if solar_value < solar_min + (solar_max - solar_min) * 0.33:
+            return "lower end"
+        elif solar_min + (solar_max - solar_min) * 0.33 <= solar_value < solar_min + (solar_max - solar_min) * 0.66:
+            return "middle range"
+        else:
+            return "higher end"
+
+    def determine_aspect_relation(self, direction: str, aspect_value: float) -> str:
+        logger.debug("Determining aspect relation for direction: %s, aspect_value: %s", direction, aspect_value)
+        towards_aspect = {
+            'north': 180,
+            'south': 0,    # or 360
+            'east': 270,
+            'west': 90
+        }
+
+        threshold = 45  # degrees
+        expected = towards_aspect.get(direction, None)
+
+        if expected is None:
+            logger.warning("Unknown direction: %s", direction)
+            return "unknown relation"
+
+        lower = (expected - threshold) % 360
+        upper = (expected + threshold) % 360
+
+        if lower < upper:
+            if lower <= aspect_value < upper:
+                return 'towards'
+            else:
+                return 'away'
+        else:
+            if aspect_value >= lower or aspect_value < upper:
+                return 'towards'
+            else:
+                return 'away'
+
+class ReportService:
+    def __init__(self, interpretation_service: InterpretationService):
+        self.interpretation_service = interpretation_service
+        logger.debug("ReportService initialized with InterpretationService.")
+
+    def generate_textual_report(self, zonal_variation: dict, raster_stats: dict) -> dict:
+        logger.debug("Generating textual report for zonal variation.")
+        descriptions = {}
+        solar_min, solar_max = raster_stats.get('solar', (0, 1))  # Avoid division by zero
+
+        for zone, values in zonal_variation.items():
+            slope_value = np.round(values.get('slope', np.nan), 2)
+            aspect_value = np.round(values.get('aspect', np.nan), 2)
+            solar_value = np.round(values.get('solar', np.nan), 2)
+
+            logger.debug("Processing zone: %s with slope: %s, aspect: %s, solar: %s", zone, slope_value, aspect_value, solar_value)
+
+            slope_description = self.interpretation_service.interpret_slope(slope_value)
+            aspect_description = self.interpretation_service.interpret_aspect(aspect_value)
+
+            if solar_value is not None and not np.isnan(solar_value):
+                solar_description = self.interpretation_service.interpret_solar_potential(solar_value, solar_min, solar_max)
+                solar_text = f"The solar potential is in the {solar_description}. Value is {solar_value}."
+            else:
+                solar_text = "The solar potential data is unavailable."
+
+            descriptions[zone] = {
+                'slope': f"The slope is {slope_description}. Value is {slope_value}.",
+                'aspect': f"The aspect is facing {aspect_description}. Value is {aspect_value}.",
+                'solar': solar_text
+            }
+            logger.debug("Generated textual description for zone %s.", zone)
+
+        logger.debug("Completed generating textual report for zonal variation.")
+        return descriptions
+
+    def generate_neighborhood_report(self, neighborhood_stats: dict, raster_stats: dict) -> dict:
+        logger.debug("Generating neighborhood report.")
+        descriptions = {}
+        solar_min, solar_max = raster_stats.get('solar', (0, 1))  # Avoid division by zero
+
+        for direction, stats in neighborhood_stats.items():
+            slope_value = stats.get('slope', None)
+            aspect_value = stats.get('aspect', None)
+
+            logger.debug("Processing neighborhood direction: %s with slope: %s, aspect: %s", direction, slope_value, aspect_value)
+
+            if slope_value is not None and not np.isnan(slope_value):
+                slope_description = self.interpretation_service.interpret_slope(slope_value)
+            else:
+                slope_description = "unknown slope"
+
+            if aspect_value is not None and not np.isnan(aspect_value):
+                aspect_direction = self.interpretation_service.interpret_aspect(aspect_value)
+                relation = self.interpretation_service.determine_aspect_relation(direction, aspect_value)
+                if relation == 'towards':
+                    relation_text = "facing towards the building."
+                elif relation == 'away':
+                    relation_text = "facing away from the building."
+                else:
+                    relation_text = "facing an unknown direction relative to the building."
+            else:
+                aspect_direction = "unknown aspect"
+                relation_text = "unknown relation to the building."
+
+            descriptions[direction] = {
+                'slope': f"The terrain to the {direction} has a {slope_description} slope.",
+                'aspect': f"It is facing {aspect_direction} and is {relation_text}"
+            }
+            logger.debug("Generated neighborhood description for direction %s.", direction)
+
+        logger.debug("Completed generating neighborhood report.")
+        return descriptions
+
+class BuildingReportEngine(BuildingStatsEngine):
+    """ BuildingStatsEngine that also writes the textual report of every building. """
+    def __init__(self, raster_service: RasterService, report_service: ReportService):
+        super().__init__(raster_service)
+        self.report_service = report_service
+
+    def generate_textual_report(self, zonal_variation: dict, raster_stats: dict) -> dict:
+        logger.debug("Generating textual report for building.")
+        return self.report_service.generate_textual_report(zonal_variation, raster_stats)
+
+    def generate_neighborhood_report(self, neighborhood_stats: dict, raster_stats: dict) -> dict:
+        logger.debug("Generating textual neighborhood report for building.")
+        return self.report_service.generate_neighborhood_report(neighborhood_stats, raster_stats)
+
+    @metrics.timed('process_building')
+    def process_building_geometry(self, building_id: str, building_geom: Polygon, raster_stats: dict) -> dict:
+        with RequestTimings.stage('zonal'):
+            zonal_variation, neighborhood_understanding = self.calculate_building_stats(building_geom)
+        with RequestTimings.stage('report'):
+            zonal_text = self.generate_textual_report(zonal_variation, raster_stats)
+
+            logger.debug("Building ID %s: Completed zonal variation report. Generating neighborhood report.", building_id)
+            neighborhood_text = self.generate_neighborhood_report(neighborhood_understanding, raster_stats)
+
+        logger.debug("Building ID %s: Completed neighborhood analysis.", building_id)
+
+        report = self.build_report(building_id, zonal_variation, zonal_text, neighborhood_understanding, neighborhood_text)
+
+        logger.debug("Building ID %s: Report generation complete.", building_id)
+        return report
+
+    @staticmethod
+    def build_report(building_id: str, zonal_variation: dict, zonal_text: dict, neighborhood_understanding: dict, neighborhood_text: dict) -> dict:
+        return {
+            'building_id': building_id,
+            'zonal_variation': zonal_variation,
+            'zonal_variation_text': zonal_text,
+            'neighborhood_understanding': neighborhood_understanding,
+            'neighborhood_understanding_text': neighborhood_text
+        }
+
+    def build_stats_report(self, building_id: str, zonal_variation: dict, neighborhood_understanding: dict, raster_stats: dict) -> dict:
+        return self.build_report(
+            building_id,
+            zonal_variation,
+            self.generate_textual_report(zonal_variation, raster_stats),
+            neighborhood_understanding,
+            self.generate_neighborhood_report(neighborhood_understanding, raster_stats)
+        )
+
+
+# ---------------------------
+# Worker Processes
+# ---------------------------
+
+_worker_report_engine: Optional[BuildingReportEngine] = None
+_worker_queued_tasks = None
+
+def init_building_worker(raster_paths: Dict[str, str], gdal_cache_mb: int, queued_tasks=None):
+    """
+    Runs once in every worker process: each worker keeps its own raster handles.
+
+    queued_tasks is the pool's shared count of tasks not started yet, see task_started.
+    """
+    global _worker_report_engine, _worker_queued_tasks
+    _worker_report_engine = BuildingReportEngine(
+        RasterService(raster_paths, RasterDatasetPool(gdal_cache_mb)),
+        ReportService(InterpretationService())
+    )
+    _worker_queued_tasks = queued_tasks
+
+def task_started():
+    if _worker_queued_tasks is not None:
+        with _worker_queued_tasks.get_lock():
+            _worker_queued_tasks.value -= 1
+
+def process_building_task(task: tuple) -> dict:
+    task_started()
+    building_id, building_wkb, raster_stats = task
+    return _worker_report_engine.process_building_geometry(building_id, shapely.from_wkb(building_wkb), raster_stats)
@@ -0,0 +1,186 @@
+"""
+Per-stage latency histograms, Server-Timing stages and request profiling of the GeoTerrain backend.
+"""
+from typing import List, Dict, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+
+
+class LatencyMetrics:
+    """ Thread-safe latency histograms per pipeline stage, rendered in the Prometheus text format. """
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str):
+        """ Decorator recording every call of the function under stage, whether it returns or raises. """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {stage: dict(histogram, counts=list(histogram['counts'])) for stage, histogram in self._stages.items()}
+
+    @staticmethod
+    def render_family(name: str, metric_type: str, description: str, samples: List[tuple]) -> str:
+        """ One metric family in the Prometheus text format; samples are (suffix, labels, value) tuples. """
+        lines = [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+    def render(self) -> str:
+        samples = []
+        for stage, histogram in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], histogram['counts']):
+                cumulative += count
+                samples.append(('_bucket', {'stage': stage, 'le': bound}, cumulative))
+            samples.append(('_sum', {'stage': stage}, histogram['sum']))
+            samples.append(('_count', {'stage': stage}, histogram['count']))
+        return self.render_family('geoterrain_stage_duration_seconds', 'histogram', 'Latency of instrumented backend stages.', samples)
+
+# Stages are recorded per process: workers of the shared pool keep their own, unexported, histograms
+metrics = LatencyMetrics()
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads working on one request, every interval seconds.
+
+    collapsed() returns one 'outer;inner;leaf count' line per distinct stack, the collapsed
+    stack format read by flamegraph.pl, speedscope and similar tools.
+    """
+    interval = 0.005
+
+    def __init__(self):
+        self.samples = Counter()
+        self._threads = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def add_thread(self, ident: int):
+        with self._lock:
+            self._threads[ident] += 1
+
+    def remove_thread(self, ident: int):
+        with self._lock:
+            self._threads[ident] -= 1
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = [ident for ident, active in self._threads.items() if active > 0]
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+class RequestTimings:
+    """
+    Stage durations of one request for its Server-Timing header, summed over every thread working on it.
+
+    The collecting request's timings travel in a context variable, which the geohash executor copies
+    into its threads; stages outside a collecting request cost a single lookup.
+    """
+    current: ContextVar[Optional['RequestTimings']] = ContextVar('request_timings', default=None)
+
+    def __init__(self, profiler: Optional[SamplingProfiler] = None):
+        self.profiler = profiler
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def collect(cls, profile: bool = False):
+        """ Collect the stages of the current request, sampling its threads when profile is set. """
+        timings = cls(SamplingProfiler() if profile else None)
+        token = cls.current.set(timings)
+        if timings.profiler is not None:
+            timings.profiler.add_thread(threading.get_ident())
+            timings.profiler.start()
+        try:
+            yield timings
+        finally:
+            cls.current.reset(token)
+            if timings.profiler is not None:
+                timings.profiler.stop()
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name: str):
+        timings = cls.current.get()
+        if timings is None:
+            yield
+            return
+        ident = threading.get_ident()
+        if timings.profiler is not None:
+            timings.profiler.add_thread(ident)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with timings._lock:
+                timings.stages[name] = timings.stages.get(name, 0.0) + elapsed
+            if timings.profiler is not None:
+                timings.profiler.remove_thread(ident)
+
+    def header(self) -> str:
+        """ Server-Timing value in milliseconds; 'total' is wall time, stages may add up to more when run in parallel. """
+        with self._lock:
+            stages = dict(self.stages)
+        stages['total'] = time.perf_counter() - self.started
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items())
@@ -1,21 +1,68 @@
-from typing import List, Dict, Optional
-from fastapi import FastAPI, HTTPException, Depends
+from typing import List, Dict, Optional, Iterator, Tuple, Literal
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-import rasterio
-from rasterio.mask import mask
 import os
 import numpy as np
-from shapely.geometry import shape, Polygon
+import shapely
+from shapely.geometry import shape, mapping, Point, Polygon
 import geopandas as gpd
-import pygeohash as pgh
+import pyarrow as pa
+import pyarrow.parquet as pq
 import math
-from multiprocessing import Pool, cpu_count
+import json
+import orjson
+import re
+import hashlib
+import sqlite3
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+from collections import OrderedDict
+from contextvars import copy_context
 import logging
 from fastapi.openapi.docs import get_swagger_ui_html
+from instrumentation import LatencyMetrics, RequestTimings, metrics
+from terrain_stats import RasterDatasetPool, RasterService, BuildingStatsStore
+from building_reports import InterpretationService, ReportService, BuildingReportEngine, init_building_worker, process_building_task
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per line, carrying the fields passed through logging's extra= as top-level keys.
+    """
+    reserved = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.reserved})
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """
+    LOG_LEVEL picks the threshold (per-item lines are DEBUG), LOG_FORMAT=json switches to structured lines.
+    """
+    handler = logging.StreamHandler()
+    if os.environ.get('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), handlers=[handler])
+
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # ---------------------------
@@ -64,6 +111,8 @@ class GeoClipRequest(BaseModel):
         ]
     })
     tif_url: str = Field(..., example="cog_merged_slope.tif")
+    approximate: bool = Field(False, description="Compute min/max from the finest overview whose window fits max_pixels, instead of always reading full resolution.")
+    max_pixels: Optional[int] = Field(None, gt=0, description="Pixel budget for approximate mode, defaults to 1,000,000.")
 
 class GeoInsights(BaseModel):
     geojson: dict = Field(..., example={
@@ -107,9 +156,19 @@ class GeoInsights(BaseModel):
         ]
     })
 
+class GeoClipBatchRequest(BaseModel):
+    geojsons: List[dict] = Field(..., description="GeoJSON feature collections, each one answered for every raster in tif_urls.")
+    tif_urls: List[str] = Field(..., example=["cog_merged_slope.tif", "cog_merged_aspect.tif", "cog_merged_solar.tif"])
+    approximate: bool = Field(False, description="Compute min/max from the finest overview whose window fits max_pixels, instead of always reading full resolution.")
+    max_pixels: Optional[int] = Field(None, gt=0, description="Pixel budget for approximate mode, defaults to 1,000,000.")
+
 class RasterStatsResponse(BaseModel):
     min: Optional[float]
     max: Optional[float]
+    overview_level: Optional[int] = Field(None, description="Only in approximate mode: 0 for full resolution, n for the n-th overview.")
+
+class RasterStatsBatchResponse(BaseModel):
+    results: List[Dict[str, RasterStatsResponse]] = Field(..., description="One entry per GeoJSON, mapping each tif_url to its stats.")
 
 class HealthResponse(BaseModel):
     status: str
@@ -120,474 +179,472 @@ class BuildingReport(BaseModel):
     zonal_variation_text: dict
     neighborhood_understanding: dict
     neighborhood_understanding_text: dict
+    feature_indices: Optional[List[int]] = Field(None, description="Only for several input features: indices of the features the building intersects.")
 
 class StatsResponse(BaseModel):
     building_reports: List[BuildingReport]
 
+class BuildingAtResponse(BaseModel):
+    geohash: str
+    geometry: dict = Field(..., description="GeoJSON geometry of the building footprint.")
+    report: BuildingReport
 
-# ---------------------------
-# Services
-# ---------------------------
-
-class RasterService:
-    def __init__(self, raster_paths: Dict[str, str]):
-        self.raster_paths = raster_paths
-        logger.info("RasterService initialized with raster paths.")
-
-    def get_raster_stats(self, raster_key: str, zone_geom: Polygon) -> Optional[float]:
-        logger.info(f"Starting get_raster_stats for raster_key: {raster_key}")
-        raster_path = self.raster_paths.get(raster_key)
-        if not raster_path:
-            logger.error(f"No raster path found for key: {raster_key}")
-            return None
-
-        try:
-            logger.info(f"Opening raster file: {raster_path}")
-            with rasterio.open(raster_path) as src:
-                logger.info(f"Masking raster with provided geometry.")
-                out_image, _ = mask(src, [zone_geom], crop=True, all_touched=True)
-                data = out_image
-
-                if src.nodata is not None:
-                    logger.info(f"Removing nodata values from raster data.")
-                    data = data[data != src.nodata]
-                if data.size == 0:
-                    logger.warning(f"No data found in raster {raster_path} for zone {zone_geom}.")
-                    return np.nan
-                mean_val = float(data.mean())
-                logger.info(f"Computed mean value for raster {raster_key}: {mean_val}")
-                return mean_val
-        except Exception as e:
-            logger.error(f"Error processing raster {raster_path} for zone {zone_geom}: {e}")
-            return np.nan
-
-    def clip_raster_stats(self, geojson: dict, tif_path: str) -> Dict[str, Optional[float]]:
-        logger.info(f"Starting clip_raster_stats for TIFF path: {tif_path}")
-        try:
-            logger.info(f"Opening raster file: {tif_path}")
-            with rasterio.open(tif_path) as src:
-                geometries = [shape(feature['geometry']) for feature in geojson['features']]
-                logger.info(f"Masking raster with provided GeoJSON geometries.")
-                clipped_image, _ = mask(src, geometries, crop=True, all_touched=True)
-
-                if clipped_image.size == 0:
-                    logger.warning("Clipped image has no data.")
-                    return {"min": None, "max": None}
-
-                # Remove nodata values
-                if src.nodata is not None:
-                    logger.info("Removing nodata values from clipped raster data.")
-                    clipped_image = clipped_image[clipped_image != src.nodata]
-
-                if clipped_image.size == 0:
-                    logger.warning("Clipped image has no valid data after masking.")
-                    return {"min": None, "max": None}
+class JobSubmitResponse(BaseModel):
+    job_id: str
+    status: str
 
-                min_val = float(np.min(clipped_image))
-                max_val = float(np.max(clipped_image))
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    geohashes_done: int
+    geohashes_total: int
+    building_count: int
+    error: Optional[str]
+    offset: int
+    limit: int
+    next_offset: Optional[int]
+    results: List[BuildingReport]
 
-                logger.info(f"Raster stats - min: {min_val}, max: {max_val}")
 
-                return {"min": min_val, "max": max_val}
-        except Exception as e:
-            logger.error(f"Error processing raster {tif_path}: {e}")
-            raise
+# ---------------------------
+# Services
+# ---------------------------
 
 class GeohashService:
     def get_geohash_bbox(self, geohash: str) -> Polygon:
-        logger.info(f"Starting get_geohash_bbox for geohash: {geohash}")
-        try:
-            lat_min, lon_min, lat_max, lon_max = pgh.decode_exactly(geohash)[:4]
-            bbox = Polygon([
-                (lon_min, lat_min),
-                (lon_max, lat_min),
-                (lon_max, lat_max),
-                (lon_min, lat_max),
-                (lon_min, lat_min)
-            ])
-            logger.info(f"Generated bounding box for geohash {geohash}.")
-            return bbox
-        except Exception as e:
-            logger.error(f"Error decoding geohash {geohash}: {e}")
+        logger.debug("Starting get_geohash_bbox for geohash: %s", geohash)
+        lon_min, lat_min, lon_max, lat_max = self.decode_bounds([geohash])[0]
+        if np.isnan(lon_min):
+            logger.error(f"Error decoding geohash {geohash}: invalid geohash.")
             return Polygon()
+        bbox = Polygon([
+            (lon_min, lat_min),
+            (lon_max, lat_min),
+            (lon_max, lat_max),
+            (lon_min, lat_max),
+            (lon_min, lat_min)
+        ])
+        logger.debug("Generated bounding box for geohash %s.", geohash)
+        return bbox
+
+    base32 = np.array(list("0123456789bcdefghjkmnpqrstuvwxyz"))
 
+    @staticmethod
+    def cell_size(precision: int) -> tuple:
+        """ (lon_bits, lat_bits, cell_width, cell_height) of the geohash grid at a given precision. """
+        lon_bits = (5 * precision + 1) // 2
+        lat_bits = (5 * precision) // 2
+        return lon_bits, lat_bits, 360.0 / (1 << lon_bits), 180.0 / (1 << lat_bits)
+
+    @classmethod
+    def encode_cells(cls, lon_idx: np.ndarray, lat_idx: np.ndarray, precision: int) -> np.ndarray:
+        """ Geohash strings for integer grid cell indices, interleaving longitude and latitude bits. """
+        lon_bits, lat_bits, _, _ = cls.cell_size(precision)
+        lon_idx = np.asarray(lon_idx, dtype=np.uint64)
+        lat_idx = np.asarray(lat_idx, dtype=np.uint64)
+
+        code = np.zeros(lon_idx.shape, dtype=np.uint64)
+        for bit in range(5 * precision):
+            if bit % 2 == 0:
+                value = (lon_idx >> np.uint64(lon_bits - 1 - bit // 2)) & np.uint64(1)
+            else:
+                value = (lat_idx >> np.uint64(lat_bits - 1 - bit // 2)) & np.uint64(1)
+            code = (code << np.uint64(1)) | value
+
+        shifts = np.uint64(5) * np.arange(precision - 1, -1, -1, dtype=np.uint64)
+        digits = (code[:, None] >> shifts) & np.uint64(31)
+        return np.ascontiguousarray(cls.base32[digits.astype(np.int64)]).view(f'<U{precision}').ravel()
+
+    @classmethod
+    def encode_point(cls, lon: float, lat: float, precision: int) -> str:
+        """ Geohash of the cell containing a point, computed from the grid arithmetic without a covering. """
+        lon_bits, lat_bits, cell_width, cell_height = cls.cell_size(precision)
+        lon_idx = min(max(int((lon + 180.0) // cell_width), 0), (1 << lon_bits) - 1)
+        lat_idx = min(max(int((lat + 90.0) // cell_height), 0), (1 << lat_bits) - 1)
+        return str(cls.encode_cells([lon_idx], [lat_idx], precision)[0])
+
+    @metrics.timed('geohash_grid_covering_polygon')
     def geohash_grid_covering_polygon(self, polygon: Polygon, resolution: int) -> List[str]:
-        logger.info(f"Starting geohash_grid_covering_polygon with resolution: {resolution}")
+        logger.debug("Starting geohash_grid_covering_polygon with resolution: %s", resolution)
         try:
+            lon_bits, lat_bits, cell_width, cell_height = self.cell_size(resolution)
             minx, miny, maxx, maxy = polygon.bounds
-            lat_steps = 100  
-            lon_steps = 100
-
-            latitudes = np.linspace(miny, maxy, lat_steps)
-            longitudes = np.linspace(minx, maxx, lon_steps)
 
-            geohashes = set()
-            logger.info("Generating geohash grid covering the polygon.")
-            for lat in latitudes:
-                for lon in longitudes:
-                    geohash = pgh.encode(lat, lon, precision=resolution)
-                    geohashes.add(geohash)
+            # Geohash cells are a regular lon/lat grid, so the cells over the bbox can be enumerated directly
+            lon_start, lon_stop = (np.clip(np.floor((np.array([minx, maxx]) + 180.0) / cell_width), 0, (1 << lon_bits) - 1)).astype(np.int64)
+            lat_start, lat_stop = (np.clip(np.floor((np.array([miny, maxy]) + 90.0) / cell_height), 0, (1 << lat_bits) - 1)).astype(np.int64)
+            lon_idx, lat_idx = np.meshgrid(np.arange(lon_start, lon_stop + 1), np.arange(lat_start, lat_stop + 1))
+            lon_idx, lat_idx = lon_idx.ravel(), lat_idx.ravel()
+            logger.debug("Testing %s candidate geohash cells against the polygon.", lon_idx.size)
+
+            cells = shapely.box(
+                lon_idx * cell_width - 180.0,
+                lat_idx * cell_height - 90.0,
+                (lon_idx + 1) * cell_width - 180.0,
+                (lat_idx + 1) * cell_height - 90.0
+            )
+            shapely.prepare(polygon)
+            intersecting = shapely.intersects(polygon, cells)
 
-            logger.info(f"Generated {len(geohashes)} geohashes covering the polygon.")
-            return list(geohashes)
+            geohashes = self.encode_cells(lon_idx[intersecting], lat_idx[intersecting], resolution).tolist()
+            logger.debug("Generated %s geohashes covering the polygon.", len(geohashes))
+            return geohashes
         except Exception as e:
             logger.error(f"Error generating geohash grid: {e}")
             return []
 
-    def filter_intersecting_geohashes(self, polygon: Polygon, geohashes: List[str]) -> List[str]:
-        logger.info("Starting filter_intersecting_geohashes.")
-        intersecting_geohashes = []
-        for geohash in geohashes:
-            logger.info(f"Checking intersection for geohash: {geohash}")
-            geohash_polygon = self.get_geohash_bbox(geohash)
-            if polygon.intersects(geohash_polygon):
-                logger.info(f"Geohash {geohash} intersects with the polygon.")
-                intersecting_geohashes.append(geohash)
-            else:
-                logger.info(f"Geohash {geohash} does not intersect with the polygon.")
-        logger.info(f"Total intersecting geohashes: {len(intersecting_geohashes)}")
-        return intersecting_geohashes
-
-class InterpretationService:
-    def interpret_slope(self, slope_value: float) -> str:
-        logger.info(f"Interpreting slope value: {slope_value}")
-        if slope_value < 10:
-            return "gentle"
-        elif 10 <= slope_value < 30:
-            return "moderate"
-        else:
-            return "steep"
-
-    def interpret_aspect(self, aspect_value: float) -> str:
-        logger.info(f"Interpreting aspect value: {aspect_value}")
-        if 0 <= aspect_value < 45 or 315 <= aspect_value <= 360:
-            return "north"
-        elif 45 <= aspect_value < 135:
-            return "east"
-        elif 135 <= aspect_value < 225:
-            return "south"
-        elif 225 <= aspect_value < 315:
-            return "west"
-        else:
-            return "unknown"
-
-    def interpret_solar_potential(self, solar_value: float, solar_min: float, solar_max: float) -> str:
-        logger.info(f"Interpreting solar potential value: {solar_value} with min: {solar_min}, max: {solar_max}")
-        if solar_value is None or np.isnan(solar_value):
-            return "unknown"
-        if solar_value < solar_min + (solar_max - solar_min) * 0.33:
-            return "lower end"
-        elif solar_min + (solar_max - solar_min) * 0.33 <= solar_value < solar_min + (solar_max - solar_min) * 0.66:
-            return "middle range"
-        else:
-            return "higher end"
-
-    def determine_aspect_relation(self, direction: str, aspect_value: float) -> str:
-        logger.info(f"Determining aspect relation for direction: {direction}, aspect_value: {aspect_value}")
-        towards_aspect = {
-            'north': 180,
-            'south': 0,    # or 360
-            'east': 270,
-            'west': 90
-        }
-
-        threshold = 45  # degrees
-        expected = towards_aspect.get(direction, None)
-
-        if expected is None:
-            logger.warning(f"Unknown direction: {direction}")
-            return "unknown relation"
-
-        lower = (expected - threshold) % 360
-        upper = (expected + threshold) % 360
-
-        if lower < upper:
-            if lower <= aspect_value < upper:
-                return 'towards'
-            else:
-                return 'away'
-        else:
-            if aspect_value >= lower or aspect_value < upper:
-                return 'towards'
-            else:
-                return 'away'
-
-class ReportService:
-    def __init__(self, interpretation_service: InterpretationService):
-        self.interpretation_service = interpretation_service
-        logger.info("ReportService initialized with InterpretationService.")
-
-    def generate_textual_report(self, zonal_variation: dict, raster_stats: dict) -> dict:
-        logger.info("Generating textual report for zonal variation.")
-        descriptions = {}
-        solar_min, solar_max = raster_stats.get('solar', (0, 1))  # Avoid division by zero
-
-        for zone, values in zonal_variation.items():
-            slope_value = np.round(values.get('slope', np.nan), 2)
-            aspect_value = np.round(values.get('aspect', np.nan), 2)
-            solar_value = np.round(values.get('solar', np.nan), 2)
-
-            logger.info(f"Processing zone: {zone} with slope: {slope_value}, aspect: {aspect_value}, solar: {solar_value}")
-
-            slope_description = self.interpretation_service.interpret_slope(slope_value)
-            aspect_description = self.interpretation_service.interpret_aspect(aspect_value)
-
-            if solar_value is not None and not np.isnan(solar_value):
-                solar_description = self.interpretation_service.interpret_solar_potential(solar_value, solar_min, solar_max)
-                solar_text = f"The solar potential is in the {solar_description}. Value is {solar_value}."
-            else:
-                solar_text = "The solar potential data is unavailable."
-
-            descriptions[zone] = {
-                'slope': f"The slope is {slope_description}. Value is {slope_value}.",
-                'aspect': f"The aspect is facing {aspect_description}. Value is {aspect_value}.",
-                'solar': solar_text
-            }
-            logger.info(f"Generated textual description for zone {zone}.")
-
-        logger.info("Completed generating textual report for zonal variation.")
-        return descriptions
-
-    def generate_neighborhood_report(self, neighborhood_stats: dict, raster_stats: dict) -> dict:
-        logger.info("Generating neighborhood report.")
-        descriptions = {}
-        solar_min, solar_max = raster_stats.get('solar', (0, 1))  # Avoid division by zero
+    @classmethod
+    def decode_bounds(cls, geohashes: List[str]) -> np.ndarray:
+        """ (lon_min, lat_min, lon_max, lat_max) rows for many geohashes at once; NaN rows for invalid geohashes. """
+        geohashes = np.asarray(geohashes, dtype=str)
+        bounds = np.full((geohashes.size, 4), np.nan)
+        lookup = np.full(128, -1, dtype=np.int64)
+        lookup[[ord(char) for char in cls.base32]] = np.arange(32)
+
+        lengths = np.char.str_len(geohashes) if geohashes.size else np.array([], dtype=np.int64)
+        for precision in np.unique(lengths):
+            if precision == 0:
+                continue
+            rows = np.flatnonzero(lengths == precision)
+            codepoints = np.ascontiguousarray(geohashes[rows].astype(f'<U{precision}')).view(np.int32).reshape(-1, precision)
+            digits = lookup[np.clip(codepoints, 0, 127)]
+            valid = ((codepoints < 128) & (digits >= 0)).all(axis=1)
+            digits = np.where(digits >= 0, digits, 0)
+
+            lon_bits, lat_bits, cell_width, cell_height = cls.cell_size(int(precision))
+            lon_idx = np.zeros(len(rows), dtype=np.int64)
+            lat_idx = np.zeros(len(rows), dtype=np.int64)
+            for bit in range(5 * precision):
+                value = (digits[:, bit // 5] >> (4 - bit % 5)) & 1
+                if bit % 2 == 0:
+                    lon_idx = (lon_idx << 1) | value
+                else:
+                    lat_idx = (lat_idx << 1) | value
 
-        for direction, stats in neighborhood_stats.items():
-            slope_value = stats.get('slope', None)
-            aspect_value = stats.get('aspect', None)
+            decoded = np.stack([
+                lon_idx * cell_width - 180.0,
+                lat_idx * cell_height - 90.0,
+                (lon_idx + 1) * cell_width - 180.0,
+                (lat_idx + 1) * cell_height - 90.0
+            ], axis=1)
+            bounds[rows[valid]] = decoded[valid]
+        return bounds
 
-            logger.info(f"Processing neighborhood direction: {direction} with slope: {slope_value}, aspect: {aspect_value}")
+    def filter_intersecting_geohashes(self, polygon: Polygon, geohashes: List[str]) -> List[str]:
+        logger.debug("Starting filter_intersecting_geohashes for %s geohashes.", len(geohashes))
+        if not geohashes:
+            return []
+        bounds = self.decode_bounds(geohashes)
+        cells = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+        shapely.prepare(polygon)
+        intersecting = shapely.intersects(polygon, cells)
+        intersecting_geohashes = [geohash for geohash, keep in zip(geohashes, intersecting) if keep]
+        logger.debug("Total intersecting geohashes: %s", len(intersecting_geohashes))
+        return intersecting_geohashes
 
-            if slope_value is not None and not np.isnan(slope_value):
-                slope_description = self.interpretation_service.interpret_slope(slope_value)
-            else:
-                slope_description = "unknown slope"
-
-            if aspect_value is not None and not np.isnan(aspect_value):
-                aspect_direction = self.interpretation_service.interpret_aspect(aspect_value)
-                relation = self.interpretation_service.determine_aspect_relation(direction, aspect_value)
-                if relation == 'towards':
-                    relation_text = "facing towards the building."
-                elif relation == 'away':
-                    relation_text = "facing away from the building."
-                else:
-                    relation_text = "facing an unknown direction relative to the building."
-            else:
-                aspect_direction = "unknown aspect"
-                relation_text = "unknown relation to the building."
+class BuildingPartitionCache:
+    """ LRU cache of decoded building partitions (with their spatial index), bounded by an approximate byte budget. """
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        logger.info("BuildingPartitionCache initialized with a budget of %s bytes.", max_bytes)
+
+    def __getstate__(self):
+        # Cached frames stay in the process that decoded them.
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
 
-            descriptions[direction] = {
-                'slope': f"The terrain to the {direction} has a {slope_description} slope.",
-                'aspect': f"It is facing {aspect_direction} and is {relation_text}"
+    @staticmethod
+    def estimate_bytes(building_df: gpd.GeoDataFrame) -> int:
+        # memory_usage only counts the geometry pointers, so add the coordinates and per-geometry overhead
+        geometry_bytes = int(shapely.get_num_coordinates(building_df.geometry.to_numpy()).sum()) * 16 + len(building_df) * 200
+        return int(building_df.memory_usage(deep=True).sum()) + geometry_bytes
+
+    @classmethod
+    def load_buildings(cls, building_path: str) -> tuple:
+        logger.debug("Reading buildings from %s", building_path)
+        building_df = gpd.read_parquet(building_path)
+        building_df.sindex  # Build the spatial index once, while the partition is cached
+        return building_df, cls.estimate_bytes(building_df)
+
+    def get(self, key: str, path: str, loader=None):
+        """
+        Cached result of loader(path), re-read whenever the file changes.
+
+        loader returns a (value, approximate_bytes) tuple and defaults to reading a building
+        partition, so other per-partition files can share the same byte budget.
+        """
+        value = self.peek(key, path)
+        if value is None:
+            value = self.load(key, path, loader)
+        return value
+
+    def peek(self, key: str, path: str):
+        """ The cached value of path if it is still current, or None without loading it. """
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def load(self, key: str, path: str, loader=None):
+        """ Read path with loader and cache the result, after a peek that missed. """
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+        value, size = (loader or self.load_buildings)(path)
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (signature, value, size)
+                self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
             }
-            logger.info(f"Generated neighborhood description for direction {direction}.")
 
-        logger.info("Completed generating neighborhood report.")
-        return descriptions
-
-class BuildingService:
-    def __init__(self, raster_service: RasterService, geohash_service: GeohashService, report_service: ReportService, db_path: str):
-        self.raster_service = raster_service
+class BuildingIndex:
+    """
+    Footprints of every building partition in one STRtree, loaded once at startup.
+
+    Buildings repeated across partitions are kept once, under the first partition in geohash order that
+    holds them, and are stored grouped by that partition. Queries need no file I/O, partition joins
+    or duplicate removal, and every geohash thread of the API process shares the same tree.
+    """
+    def __init__(self, building_ids: np.ndarray, geometries: np.ndarray, geohashes: np.ndarray):
+        self.building_ids = building_ids
+        self.geometries = geometries
+        self.geohashes = geohashes
+        self.tree = shapely.STRtree(geometries)
+        partitions, starts = np.unique(geohashes, return_index=True)
+        stops = np.append(starts[1:], len(geohashes))
+        self.partitions = {geohash: (start, stop) for geohash, start, stop in zip(partitions.tolist(), starts.tolist(), stops.tolist())}
+
+    def __len__(self):
+        return len(self.geometries)
+
+    @classmethod
+    def load(cls, db_path: str) -> 'BuildingIndex':
+        """ Read the ids and WKB footprints of every {geohash}/buildings.parquet below db_path. """
+        started = time.perf_counter()
+        building_ids, footprints, geohashes = [], [], []
+        seen = set()
+        for geohash in sorted(os.listdir(db_path)):
+            building_path = os.path.join(db_path, geohash, 'buildings.parquet')
+            if not os.path.exists(building_path):
+                continue
+            has_ids = 'gmlid' in pq.read_schema(building_path).names
+            table = pq.read_table(building_path, columns=['gmlid', 'geometry'] if has_ids else ['geometry'])
+            ids = table.column('gmlid').to_pylist() if has_ids else [None] * table.num_rows
+            # Partitions repeat the unmodified footprint of every building crossing their border
+            for building_id, footprint in zip(ids, table.column('geometry').to_pylist()):
+                if footprint in seen:
+                    continue
+                seen.add(footprint)
+                building_ids.append(building_id)
+                footprints.append(footprint)
+                geohashes.append(geohash)
+
+        index = cls(
+            np.array(building_ids, dtype=object),
+            shapely.from_wkb(np.array(footprints, dtype=object)),
+            np.array(geohashes, dtype=str)
+        )
+        logger.info("Loaded %s buildings of %s partitions into the building index in %.1fs.", len(index), len(index.partitions), time.perf_counter() - started)
+        return index
+
+    def query(self, geom, geohash: Optional[str] = None) -> np.ndarray:
+        """ Sorted indices of the buildings intersecting geom, only those stored under geohash when given. """
+        candidates = self.tree.query(geom)
+        if geohash is not None:
+            start, stop = self.partitions.get(geohash, (0, 0))
+            candidates = candidates[(candidates >= start) & (candidates < stop)]
+        shapely.prepare(geom)
+        return np.sort(candidates[shapely.intersects(geom, self.geometries[candidates])])
+
+    def partitions_intersecting(self, geoms: np.ndarray) -> List[str]:
+        """ Geohashes storing a building that intersects any of geoms, from one vectorized tree query. """
+        _, building_idx = self.tree.query(geoms, predicate='intersects')
+        return np.unique(self.geohashes[building_idx]).tolist()
+
+    def frame(self, building_idx: np.ndarray) -> gpd.GeoDataFrame:
+        """ The buildings at building_idx, laid out like a building partition. """
+        return gpd.GeoDataFrame({'gmlid': self.building_ids[building_idx]}, geometry=self.geometries[building_idx], crs='EPSG:4326')
+
+class BuildingService(BuildingReportEngine):
+    bbox_read_max_fraction = 0.25  # Larger queries read the whole partition, which is then cached
+
+    def __init__(self, raster_service: RasterService, geohash_service: GeohashService, report_service: ReportService, db_path: str, batch_mode: bool = True, partition_cache: Optional[BuildingPartitionCache] = None, worker_pool: Optional['BuildingWorkerPool'] = None, geohash_executor: Optional[ThreadPoolExecutor] = None, max_concurrent_geohashes: int = 4, use_precomputed_stats: bool = True, building_index: Optional[BuildingIndex] = None, bbox_pruning: bool = True):
+        super().__init__(raster_service, report_service)
         self.geohash_service = geohash_service
-        self.report_service = report_service
         self.db_path = db_path
+        self.batch_mode = batch_mode
+        self.partition_cache = partition_cache or BuildingPartitionCache()
+        self.worker_pool = worker_pool
+        self.geohash_executor = geohash_executor
+        self.max_concurrent_geohashes = max(1, max_concurrent_geohashes)
+        self.use_precomputed_stats = use_precomputed_stats
+        self.building_index = building_index
+        self.bbox_pruning = bbox_pruning
+        self._queued_geohashes = 0
+        self._queued_geohashes_lock = threading.Lock()
         logger.info("BuildingService initialized with RasterService, GeohashService, and ReportService.")
 
     def get_raster_stats_for_zone(self, raster_key: str, zone_geom: Polygon) -> Optional[float]:
-        logger.info(f"Retrieving raster stats for key: {raster_key}")
+        logger.debug("Retrieving raster stats for key: %s", raster_key)
         stats = self.raster_service.get_raster_stats(raster_key, zone_geom)
         if stats is not None:
-            logger.info(f"Retrieved raster stats for {raster_key}: {stats}")
+            logger.debug("Retrieved raster stats for %s: %s", raster_key, stats)
         else:
-            logger.warning(f"Raster stats for {raster_key} could not be retrieved.")
+            logger.warning("Raster stats for %s could not be retrieved.", raster_key)
         return stats
 
-    def calculate_zonal_variation(self, building_geom: Polygon) -> dict:
-        logger.info("Calculating zonal variation for building geometry.")
-        minx, miny, maxx, maxy = building_geom.bounds
-        width = maxx - minx
-        height = maxy - miny
-
-        zone_percentage = 0.4  # Adjust this value to change the size of the zones
-
-        zones = {
-            'north': building_geom.intersection(Polygon([
-                (minx, maxy - height * zone_percentage),
-                (maxx, maxy - height * zone_percentage),
-                (maxx, maxy),
-                (minx, maxy)
-            ])),
-            'south': building_geom.intersection(Polygon([
-                (minx, miny),
-                (maxx, miny),
-                (maxx, miny + height * zone_percentage),
-                (minx, miny + height * zone_percentage)
-            ])),
-            'east': building_geom.intersection(Polygon([
-                (maxx - width * zone_percentage, miny),
-                (maxx, miny),
-                (maxx, maxy),
-                (maxx - width * zone_percentage, maxy)
-            ])),
-            'west': building_geom.intersection(Polygon([
-                (minx, miny),
-                (minx + width * zone_percentage, miny),
-                (minx + width * zone_percentage, maxy),
-                (minx, maxy)
-            ]))
-        }
-
-        logger.info("Generated zonal geometries for north, south, east, and west.")
-        logger.info("North: "+str(zones['north']))
-        logger.info("South: "+str(zones['south']))
-        logger.info("East: "+str(zones['east']))
-        logger.info("West: "+str(zones['west']))
-
-        zonal_stats = {}
-        for zone_name, zone_geom in zones.items():
-            if not zone_geom.is_empty:
-                logger.info(f"Calculating raster stats for zone: {zone_name}")
-                zonal_stats[zone_name] = {
-                    'slope': self.get_raster_stats_for_zone('slope', zone_geom),
-                    'aspect': self.get_raster_stats_for_zone('aspect', zone_geom),
-                    'solar': self.get_raster_stats_for_zone('solar', zone_geom)
-                }
-            else:
-                logger.info(f"No geometry found for zone: {zone_name}. Setting stats to None.")
-                zonal_stats[zone_name] = {
-                    'slope': None,
-                    'aspect': None,
-                    'solar': None
-                }
-
-        logger.info("Completed calculating zonal variation.")
-        return zonal_stats
-
-    def calculate_neighborhood_analysis(self, building_geom: Polygon) -> dict:
-        logger.info("Starting neighborhood analysis for building geometry.")
-        buffer_distance = 0.0001  # Adjust this value as needed
-        buffered_polygon = building_geom.buffer(buffer_distance).simplify(0.5)
-        buffer_ring = buffered_polygon.difference(building_geom)
-
-        minx, miny, maxx, maxy = buffer_ring.bounds
-        width = maxx - minx
-        height = maxy - miny
-
-        direction_percentage = 0.4
-
-        logger.info("Buffer Poly: "+str(buffer_ring))
-
-        directions = {
-            'north': buffer_ring.intersection(Polygon([
-                (minx, maxy - height * direction_percentage),
-                (maxx, maxy - height * direction_percentage),
-                (maxx, maxy),
-                (minx, maxy)
-            ])),
-            'south': buffer_ring.intersection(Polygon([
-                (minx, miny),
-                (maxx, miny),
-                (maxx, miny + height * direction_percentage),
-                (minx, miny + height * direction_percentage)
-            ])),
-            'east': buffer_ring.intersection(Polygon([
-                (maxx - width * direction_percentage, miny),
-                (maxx, miny),
-                (maxx, maxy),
-                (maxx - width * direction_percentage, maxy)
-            ])),
-            'west': buffer_ring.intersection(Polygon([
-                (minx, miny),
-                (minx + width * direction_percentage, miny),
-                (minx + width * direction_percentage, maxy),
-                (minx, maxy)
-            ]))
-        }
-
-        logger.info("Generated neighborhood geometries for north, south, east, and west.")
-        logger.info("Buffer North: "+str(directions['north']))
-        logger.info("Buffer South: "+str(directions['south']))
-        logger.info("Buffer East: "+str(directions['east']))
-        logger.info("Buffer West: "+str(directions['west']))
-
-        neighborhood_stats = {}
-        for direction, direction_geom in directions.items():
-            if not direction_geom.is_empty:
-                logger.info(f"Calculating raster stats for neighborhood direction: {direction}")
-                neighborhood_stats[direction] = {
-                    'slope': self.get_raster_stats_for_zone('slope', direction_geom),
-                    'aspect': self.get_raster_stats_for_zone('aspect', direction_geom)
-                }
-            else:
-                logger.info(f"No geometry found for neighborhood direction: {direction}. Setting stats to None.")
-                neighborhood_stats[direction] = {
-                    'slope': None,
-                    'aspect': None
-                }
-
-        logger.info("Completed neighborhood analysis.")
-        return neighborhood_stats
-
-    def generate_textual_report(self, zonal_variation: dict, raster_stats: dict) -> dict:
-        logger.info("Generating textual report for building.")
-        return self.report_service.generate_textual_report(zonal_variation, raster_stats)
-
-    def generate_neighborhood_report(self, neighborhood_stats: dict, raster_stats: dict) -> dict:
-        logger.info("Generating textual neighborhood report for building.")
-        return self.report_service.generate_neighborhood_report(neighborhood_stats, raster_stats)
-
     def process_building(self, building: gpd.GeoSeries, input_geom: Polygon, raster_stats: dict) -> Optional[dict]:
         building_id = building.get('gmlid', 'unknown')
-        logger.info(f"Processing building with ID: {building_id}")
+        logger.debug("Processing building with ID: %s", building_id)
 
         building_geom = building['geometry']
 
         if not building_geom.intersects(input_geom):
-            logger.info(f"Building ID {building_id} does not intersect with input geometry. Skipping.")
+            logger.debug("Building ID %s does not intersect with input geometry. Skipping.", building_id)
             return None
 
-        logger.info(f"Building ID {building_id} intersects with input geometry. Calculating zonal variation.")
-        zonal_variation = self.calculate_zonal_variation(building_geom)
-        zonal_text = self.generate_textual_report(zonal_variation, raster_stats)
+        logger.debug("Building ID %s intersects with input geometry. Calculating zonal and neighborhood stats.", building_id)
+        return self.process_building_geometry(building_id, building_geom, raster_stats)
 
-        logger.info(f"Building ID {building_id}: Completed zonal variation report. Starting neighborhood analysis.")
-        neighborhood_understanding = self.calculate_neighborhood_analysis(building_geom)
-        neighborhood_text = self.generate_neighborhood_report(neighborhood_understanding, raster_stats)
+    @metrics.timed('process_buildings_batch')
+    def process_buildings_batch(self, building_df: gpd.GeoDataFrame, raster_stats: dict) -> List[dict]:
+        building_ids = building_df['gmlid'].tolist() if 'gmlid' in building_df.columns else ['unknown'] * len(building_df)
+        with RequestTimings.stage('zonal'):
+            building_stats = self.calculate_partition_stats(building_df.geometry.to_numpy())
 
-        logger.info(f"Building ID {building_id}: Completed neighborhood analysis.")
+        with RequestTimings.stage('report'):
+            return [
+                self.build_stats_report(building_id, zonal_variation, neighborhood_understanding, raster_stats)
+                for building_id, (zonal_variation, neighborhood_understanding) in zip(building_ids, building_stats)
+            ]
 
-        report = {
-            'building_id': building_id,
-            'zonal_variation': zonal_variation,
-            'zonal_variation_text': zonal_text,
-            'neighborhood_understanding': neighborhood_understanding,
-            'neighborhood_understanding_text': neighborhood_text
-        }
+    @staticmethod
+    def has_bbox_covering(building_path: str) -> bool:
+        """ Whether the GeoParquet file declares a 1.1 bbox covering column for its geometry. """
+        metadata = pq.read_schema(building_path).metadata or {}
+        geo = json.loads(metadata.get(b'geo', b'{}'))
+        return 'bbox' in geo.get('columns', {}).get(geo.get('primary_column', 'geometry'), {}).get('covering', {})
+
+    def covers_small_part(self, geohash: str, input_geom: Polygon) -> bool:
+        """ Whether the bounds of input_geom within the geohash cell cover at most bbox_read_max_fraction of it. """
+        lon_min, lat_min, lon_max, lat_max = GeohashService.decode_bounds([geohash])[0]
+        minx, miny, maxx, maxy = input_geom.bounds
+        overlap = max(min(maxx, lon_max) - max(minx, lon_min), 0.0) * max(min(maxy, lat_max) - max(miny, lat_min), 0.0)
+        return overlap <= self.bbox_read_max_fraction * (lon_max - lon_min) * (lat_max - lat_min)
+
+    def read_partition(self, geohash: str, building_path: str, input_geom: Polygon) -> gpd.GeoDataFrame:
+        """
+        Buildings of a partition, at least all of those whose bounds overlap input_geom.
+
+        A cached partition is used as is. A query covering only a small part of an uncached partition written
+        with a bbox covering column decodes just the row groups whose bbox statistics overlap it, and is not
+        cached. Anything else reads and caches the whole partition.
+        """
+        partition_df = self.partition_cache.peek(geohash, building_path)
+        if partition_df is not None:
+            return partition_df
+        if self.bbox_pruning and self.covers_small_part(geohash, input_geom) and self.has_bbox_covering(building_path):
+            logger.debug("Reading the row groups of geohash %s within %s.", geohash, input_geom.bounds)
+            return gpd.read_parquet(building_path, bbox=input_geom.bounds)
+        return self.partition_cache.load(geohash, building_path)
+
+    def get_precomputed_stats(self, geohash: str, building_path: str) -> Dict[str, tuple]:
+        """ Precomputed (zonal_variation, neighborhood_understanding) per gmlid for a partition, or {} if unavailable. """
+        stats_path = os.path.join(os.path.dirname(building_path), BuildingStatsStore.filename)
+        if not self.use_precomputed_stats or not os.path.exists(stats_path):
+            return {}
 
-        logger.info(f"Building ID {building_id}: Report generation complete.")
-        return report
+        try:
+            if os.stat(stats_path).st_mtime_ns < os.stat(building_path).st_mtime_ns:
+                logger.warning(f"Precomputed stats {stats_path} are older than the buildings. Computing stats live.")
+                return {}
+            return self.partition_cache.get(f"{geohash}/{BuildingStatsStore.filename}", stats_path, BuildingStatsStore.loader(self.zone_rasters))
+        except Exception as e:
+            logger.error(f"Error reading precomputed stats for geohash {geohash}: {e}")
+            return {}
+
+    def process_buildings_live(self, geohash: str, building_df: gpd.GeoDataFrame, raster_stats: dict) -> List[dict]:
+        if self.batch_mode:
+            logger.debug("Processing %s buildings of geohash %s in batch mode.", building_df.shape[0], geohash)
+            return self.process_buildings_batch(building_df, raster_stats)
+
+        building_ids = building_df['gmlid'].tolist() if 'gmlid' in building_df.columns else ['unknown'] * len(building_df)
+        if self.worker_pool is not None and self.worker_pool.is_running:
+            tasks = [
+                (building_id, building_wkb, raster_stats)
+                for building_id, building_wkb in zip(building_ids, shapely.to_wkb(building_df.geometry.to_numpy()))
+            ]
+            logger.debug("Submitting %s buildings of geohash %s to the shared worker pool.", len(tasks), geohash)
+            with RequestTimings.stage('zonal'):
+                return self.worker_pool.map(process_building_task, tasks)
 
-    def process_geohash(self, geohash: str, input_geom: Polygon, raster_stats: dict) -> List[dict]:
-        logger.info(f"Processing geohash: {geohash}")
+        return [
+            self.process_building_geometry(building_id, building_geom, raster_stats)
+            for building_id, building_geom in zip(building_ids, building_df.geometry)
+        ]
+
+    @metrics.timed('process_geohash')
+    def process_geohash(self, geohash: str, input_geom: Polygon, raster_stats: dict, sample: bool = True, feature_tree: Optional[shapely.STRtree] = None) -> List[dict]:
+        """
+        Reports of the buildings of one geohash partition that intersect input_geom.
+
+        With several input features, input_geom is their union and feature_tree indexes the features,
+        so each report also lists the 'feature_indices' its building intersects.
+        """
+        logger.debug("Processing geohash: %s", geohash)
         building_path = os.path.join(self.db_path, f"{geohash}/buildings.parquet")
 
-        if not os.path.exists(building_path):
-            logger.warning(f"Building path {building_path} does not exist. Skipping geohash {geohash}.")
+        if self.building_index is None and not os.path.exists(building_path):
+            logger.debug("Building path %s does not exist. Skipping geohash %s.", building_path, geohash)
             return []
 
         try:
-            logger.info(f"Reading buildings from {building_path}")
-            building_df = gpd.read_parquet(building_path).sjoin(
-                gpd.GeoDataFrame(geometry=[input_geom], crs='EPSG:4326'),
-                how='inner',
-                predicate='intersects'
-            )
-            building_df = building_df.drop_duplicates(subset='geometry')
-            logger.info(f"Found {building_df.shape[0]} buildings intersecting with input geometry in geohash {geohash}.")
-
-            if building_df.shape[0] > 10:
-                logger.info(f"Sampling 10 buildings from geohash {geohash} for processing.")
+            if self.building_index is not None:
+                with RequestTimings.stage('join'):
+                    building_df = self.building_index.frame(self.building_index.query(input_geom, geohash))
+            else:
+                with RequestTimings.stage('read'):
+                    partition_df = self.read_partition(geohash, building_path, input_geom)
+                with RequestTimings.stage('join'):
+                    building_idx = np.sort(partition_df.sindex.query(input_geom, predicate='intersects'))
+                    building_df = partition_df.iloc[building_idx].drop_duplicates(subset='geometry')
+            logger.debug("Found %s buildings intersecting with input geometry in geohash %s.", building_df.shape[0], geohash)
+
+            if sample and not self.batch_mode and building_df.shape[0] > 10:
+                logger.debug("Sampling 10 buildings from geohash %s for processing.", geohash)
                 building_df = building_df.sample(10)
 
         except Exception as e:
@@ -595,40 +652,228 @@ class BuildingService:
             return []
 
         if building_df.empty:
-            logger.info(f"No intersecting buildings found in geohash {geohash}.")
+            logger.debug("No intersecting buildings found in geohash %s.", geohash)
             return []
 
-        args = [(building, input_geom, raster_stats) for _, building in building_df.iterrows()]
-        logger.info(f"Starting multiprocessing pool with {cpu_count()} workers for geohash {geohash}.")
-        with Pool(cpu_count()) as pool:
-            building_reports = pool.starmap(self.process_building, args)
-
-        logger.info(f"Completed processing buildings for geohash {geohash}.")
+        # Precomputed rows only need their text generated, the remaining buildings are computed live
+        with RequestTimings.stage('read'):
+            precomputed_stats = self.get_precomputed_stats(geohash, building_path)
+        building_reports = [None] * len(building_df)
+        missing_idx = []
+        building_ids = building_df['gmlid'].tolist() if 'gmlid' in building_df.columns else [None] * len(building_df)
+        with RequestTimings.stage('report'):
+            for idx, building_id in enumerate(building_ids):
+                building_stats = precomputed_stats.get(building_id)
+                if building_stats is None:
+                    missing_idx.append(idx)
+                else:
+                    building_reports[idx] = self.build_stats_report(building_id, *building_stats, raster_stats)
+        if precomputed_stats:
+            logger.debug("Using precomputed stats for %s of %s buildings in geohash %s.", len(building_df) - len(missing_idx), len(building_df), geohash)
+
+        if missing_idx:
+            live_reports = self.process_buildings_live(geohash, building_df.iloc[missing_idx], raster_stats)
+            for idx, report in zip(missing_idx, live_reports):
+                building_reports[idx] = report
+
+        if feature_tree is not None:
+            with RequestTimings.stage('join'):
+                rows, features = feature_tree.query(building_df.geometry.to_numpy(), predicate='intersects')
+                feature_indices = [[] for _ in building_reports]
+                for row, feature in zip(rows.tolist(), features.tolist()):
+                    feature_indices[row].append(feature)
+                for report, indices in zip(building_reports, feature_indices):
+                    if report:
+                        report['feature_indices'] = sorted(indices)
+
+        logger.debug("Completed processing buildings for geohash %s.", geohash)
         return [report for report in building_reports if report]
 
+    @metrics.timed('building_at')
+    def building_at(self, lon: float, lat: float, raster_stats: dict) -> Optional[dict]:
+        """
+        The building whose footprint contains a point, with its report, or None.
+
+        Partitions hold every building intersecting their geohash, so the point's own geohash-6 cell
+        always holds the building. Its cached partition answers from the spatial index built on load.
+        """
+        if self.building_index is not None:
+            with RequestTimings.stage('join'):
+                building_idx = self.building_index.query(Point(lon, lat))
+            if building_idx.size == 0:
+                return None
+            building = self.building_index.frame(building_idx[:1]).iloc[0]
+            geohash = str(self.building_index.geohashes[building_idx[0]])
+        else:
+            geohash = self.geohash_service.encode_point(lon, lat, 6)
+            building_path = os.path.join(self.db_path, f"{geohash}/buildings.parquet")
+            if not os.path.exists(building_path):
+                logger.debug("No building partition for geohash %s.", geohash)
+                return None
+
+            with RequestTimings.stage('read'):
+                partition_df = self.partition_cache.get(geohash, building_path)
+            with RequestTimings.stage('join'):
+                building_idx = np.sort(partition_df.sindex.query(Point(lon, lat), predicate='intersects'))
+            if building_idx.size == 0:
+                return None
+            building = partition_df.iloc[int(building_idx[0])]
+
+        building_path = os.path.join(self.db_path, f"{geohash}/buildings.parquet")
+        building_id = building.get('gmlid') or 'unknown'
+        with RequestTimings.stage('read'):
+            building_stats = self.get_precomputed_stats(geohash, building_path).get(building_id)
+        if building_stats is None:
+            report = self.process_building_geometry(building_id, building.geometry, raster_stats)
+        else:
+            with RequestTimings.stage('report'):
+                report = self.build_stats_report(building_id, *building_stats, raster_stats)
+        return {'geohash': geohash, 'geometry': mapping(building.geometry), 'report': report}
+
+    def iter_geohash_reports(self, geohashes: List[str], input_geom: Polygon, raster_stats: dict, sample: bool = True, feature_tree: Optional[shapely.STRtree] = None) -> Iterator[Tuple[int, str, List[dict]]]:
+        """
+        Process geohashes on the shared executor and yield (index, geohash, reports) as each one finishes.
+
+        At most max_concurrent_geohashes partitions of one request are in flight at a time, so a
+        single large polygon cannot occupy the whole executor.
+        """
+        if self.geohash_executor is None or len(geohashes) <= 1:
+            for index, geohash in enumerate(geohashes):
+                yield index, geohash, self.process_geohash(geohash, input_geom, raster_stats, sample, feature_tree)
+            return
+
+        queued = iter(enumerate(geohashes))
+        in_flight = {}
+
+        def submit_next():
+            for index, geohash in queued:
+                with self._queued_geohashes_lock:
+                    self._queued_geohashes += 1
+                try:
+                    # Executor threads do not inherit context variables, pass the request's timings along
+                    future = self.geohash_executor.submit(self.run_geohash_task, copy_context(), geohash, input_geom, raster_stats, sample, feature_tree)
+                except RuntimeError:
+                    self.release_queued_geohash()
+                    raise
+                in_flight[future] = (index, geohash)
+                return
+
+        try:
+            for _ in range(self.max_concurrent_geohashes):
+                submit_next()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, geohash = in_flight.pop(future)
+                    submit_next()
+                    yield index, geohash, future.result()
+        finally:
+            for future in in_flight:
+                if future.cancel():
+                    self.release_queued_geohash()
+
+    def run_geohash_task(self, context, *args) -> List[dict]:
+        """ process_geohash on an executor thread, within the submitting request's context. """
+        self.release_queued_geohash()
+        return context.run(self.process_geohash, *args)
+
+    def release_queued_geohash(self):
+        with self._queued_geohashes_lock:
+            self._queued_geohashes -= 1
+
+    def geohash_queue_depth(self) -> int:
+        """ Geohashes submitted to the shared executor that have not started yet. """
+        with self._queued_geohashes_lock:
+            return self._queued_geohashes
+
+    def parse_input_features(self, geojson: dict) -> np.ndarray:
+        input_gdf = gpd.GeoDataFrame.from_features(geojson["features"])
+        input_gdf.set_crs('EPSG:4326', inplace=True)
+        return input_gdf.geometry.to_numpy()
+
+    def cover_features(self, feature_geoms: np.ndarray) -> List[str]:
+        """ Geohashes covering any of the features, each one once even where the features overlap. """
+        if self.building_index is not None:
+            # Only partitions actually holding a matching building, no empty cells to probe
+            return self.building_index.partitions_intersecting(feature_geoms)
+        geohashes = set()
+        for feature_geom in feature_geoms:
+            geohashes.update(self.geohash_service.geohash_grid_covering_polygon(feature_geom, resolution=6))
+        return sorted(geohashes)
+
+    def missing_partitions(self, geohashes: List[str]) -> int:
+        """ Geohashes without a building partition, which process_geohash skips. """
+        if self.building_index is not None:
+            return 0  # The index only lists partitions that exist
+        return sum(not os.path.exists(os.path.join(self.db_path, f"{geohash}/buildings.parquet")) for geohash in geohashes)
+
+    @staticmethod
+    def feature_tree(feature_geoms: np.ndarray) -> Optional[shapely.STRtree]:
+        """ Index of the input features when there are several, so reports can be keyed by feature. """
+        return shapely.STRtree(feature_geoms) if len(feature_geoms) > 1 else None
+
     def generate_building_reports(self, geojson: dict, raster_stats: dict, db_path: Optional[str] = None) -> List[dict]:
-        logger.info("Generating building reports from GeoJSON input.")
+        logger.debug("Generating building reports from GeoJSON input.")
         try:
-            input_gdf = gpd.GeoDataFrame.from_features(geojson["features"])
-            input_gdf.set_crs('EPSG:4326', inplace=True)
-            input_geom = input_gdf.geometry.iloc[0]
-            logger.info("Parsed GeoJSON input successfully.")
+            feature_geoms = self.parse_input_features(geojson)
+            input_geom = shapely.union_all(feature_geoms)
+            logger.debug("Parsed %s GeoJSON features successfully.", len(feature_geoms))
         except Exception as e:
             logger.error(f"Error parsing GeoJSON input: {e}")
             return []
 
-        geohashes = self.geohash_service.geohash_grid_covering_polygon(input_geom, resolution=6)
-        logger.info(f"Found {len(geohashes)} geohashes covering the input polygon.")
+        started = time.perf_counter()
+        with RequestTimings.stage('cover'):
+            geohashes = self.cover_features(feature_geoms)
+            feature_tree = self.feature_tree(feature_geoms)
+        logger.debug("Found %s geohashes covering the input features.", len(geohashes))
+
+        # Partitions finish in any order, reports are returned in geohash order
+        geohash_reports = [None] * len(geohashes)
+        for index, geohash, reports in self.iter_geohash_reports(geohashes, input_geom, raster_stats, feature_tree=feature_tree):
+            geohash_reports[index] = reports
+            logger.debug("Completed geohash %s with %s building reports.", geohash, len(reports))
+
+        building_reports = [report for reports in geohash_reports for report in reports]
+        duration = time.perf_counter() - started
+        missing = self.missing_partitions(geohashes)
+        logger.info("Generated reports for %s buildings from %s geohashes (%s without a partition) in %.3fs.", len(building_reports), len(geohashes), missing, duration,
+                    extra={'buildings': len(building_reports), 'geohashes': len(geohashes), 'missing_partitions': missing, 'duration_s': round(duration, 3)})
+        return building_reports
 
-        building_reports = []
-        for geohash in geohashes:
-            logger.info(f"Processing buildings in geohash: {geohash}")
-            reports = self.process_geohash(geohash, input_geom, raster_stats)
-            building_reports.extend(reports)
-            logger.info(f"Accumulated {len(building_reports)} building reports so far.")
+    def stream_building_reports(self, geojson: dict, raster_stats: dict, sample: bool = True) -> Iterator[dict]:
+        """
+        Yield building reports as soon as their geohash finishes, interleaved with progress events.
 
-        logger.info(f"Generated reports for {len(building_reports)} buildings in total.")
-        return building_reports
+        Events are dicts with an 'event' key: 'progress' (geohashes_done/geohashes_total),
+        'building_report' (one cleaned BuildingReport under 'data') and a final 'complete'.
+        """
+        logger.debug("Streaming building reports from GeoJSON input.")
+        started = time.perf_counter()
+        try:
+            feature_geoms = self.parse_input_features(geojson)
+            input_geom = shapely.union_all(feature_geoms)
+            geohashes = self.cover_features(feature_geoms)
+            feature_tree = self.feature_tree(feature_geoms)
+        except Exception as e:
+            logger.error(f"Error parsing GeoJSON input: {e}")
+            input_geom, geohashes, feature_tree = None, [], None
+
+        yield {'event': 'progress', 'geohashes_done': 0, 'geohashes_total': len(geohashes)}
+        building_count = 0
+        for geohashes_done, (_, geohash, reports) in enumerate(self.iter_geohash_reports(geohashes, input_geom, raster_stats, sample, feature_tree), start=1):
+            for report in reports:
+                with metrics.timer('remove_nan_values'):
+                    cleaned_report = ReportCleaner.remove_nan_values(report)
+                yield {'event': 'building_report', 'data': cleaned_report}
+            building_count += len(reports)
+            yield {'event': 'progress', 'geohashes_done': geohashes_done, 'geohashes_total': len(geohashes), 'geohash': geohash}
+
+        duration = time.perf_counter() - started
+        missing = self.missing_partitions(geohashes)
+        logger.info("Streamed reports for %s buildings from %s geohashes (%s without a partition) in %.3fs.", building_count, len(geohashes), missing, duration,
+                    extra={'buildings': building_count, 'geohashes': len(geohashes), 'missing_partitions': missing, 'duration_s': round(duration, 3)})
+        yield {'event': 'complete', 'building_count': building_count}
 
 class ReportCleaner:
     @staticmethod
@@ -639,16 +884,422 @@ class ReportCleaner:
         elif isinstance(data, list):
             return [ReportCleaner.remove_nan_values(i) for i in data]
         elif isinstance(data, float) and (math.isnan(data) or math.isinf(data)):
-            logger.info("Replacing NaN or Inf value with None.")
             return None  # Replace NaN or infinite values with None
         return data
 
 
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def orjson_response(content) -> Response:
+    """ JSON response rendered with orjson, which writes NaN and Inf as null and numpy scalars as numbers. """
+    return Response(orjson.dumps(content, option=ORJSON_OPTIONS), media_type='application/json')
+
+
+class ReportColumns:
+    """
+    Column-oriented layout of building reports, one row per building, zone group and zone.
+
+    Building ids, groups and zones repeat on every row, so the Arrow form dictionary-encodes them.
+    """
+    groups = {
+        'zonal': ('zonal_variation', 'zonal_variation_text'),
+        'neighborhood': ('neighborhood_understanding', 'neighborhood_understanding_text')
+    }
+    key_columns = ['building_id', 'group', 'zone']
+    value_columns = ['slope', 'aspect', 'solar']
+    arrow_media_type = 'application/vnd.apache.arrow.stream'
+
+    @classmethod
+    def from_reports(cls, reports: List[dict]) -> Dict[str, list]:
+        columns = {name: [] for name in cls.key_columns + cls.value_columns + [f'{name}_text' for name in cls.value_columns]}
+        for report in reports:
+            for group, (stats_key, text_key) in cls.groups.items():
+                texts = report.get(text_key) or {}
+                for zone, stats in (report.get(stats_key) or {}).items():
+                    zone_texts = texts.get(zone) or {}
+                    columns['building_id'].append(report['building_id'])
+                    columns['group'].append(group)
+                    columns['zone'].append(zone)
+                    for name in cls.value_columns:
+                        columns[name].append(stats.get(name))
+                        columns[f'{name}_text'].append(zone_texts.get(name))
+                    if 'feature_indices' in report:
+                        columns.setdefault('feature_indices', []).append(report['feature_indices'])
+        return columns
+
+    @classmethod
+    def to_arrow(cls, columns: Dict[str, list]) -> bytes:
+        """ Arrow IPC stream of the columns, with NaN values stored as nulls. """
+        arrays = {}
+        for name, values in columns.items():
+            if name in cls.value_columns:
+                arrays[name] = pa.array(values, type=pa.float64(), from_pandas=True)
+            elif name in cls.key_columns:
+                arrays[name] = pa.array(values, type=pa.string()).dictionary_encode()
+            elif name == 'feature_indices':
+                arrays[name] = pa.array(values, type=pa.list_(pa.int32()))
+            else:
+                arrays[name] = pa.array(values, type=pa.string())
+        table = pa.table(arrays)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class ResultCache:
+    """
+    LRU + TTL cache of endpoint results keyed on the normalized request geometry, bounded by an approximate byte budget.
+
+    Concurrent requests for the same key are coalesced: the first one computes the result and the
+    others wait for it instead of starting their own computation.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        logger.info("ResultCache initialized with a budget of %s bytes and a TTL of %ss.", max_bytes, ttl_seconds)
+
+    @staticmethod
+    def geometry_key(geojson: dict, *parts: str) -> Optional[str]:
+        """ Hash of the GeoJSON geometries, independent of ring orientation, start vertex and feature properties. """
+        try:
+            geometries = shapely.normalize(np.array([shape(feature['geometry']) for feature in geojson['features']], dtype=object))
+        except Exception:
+            return None  # Invalid input is left to the endpoint to report, uncached
+        digest = hashlib.sha256()
+        for geometry_wkb in shapely.to_wkb(geometries):
+            digest.update(geometry_wkb)
+        for part in parts:
+            digest.update(b'\0' + str(part).encode())
+        return digest.hexdigest()
+
+    def get_or_compute(self, key: Optional[str], compute):
+        if key is None:
+            return compute()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            future = self._in_flight.get(key)
+            if future is None:
+                future = Future()
+                self._in_flight[key] = future
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.coalesced += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            # Failures are not cached, waiting requests get the same error
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        size = len(orjson.dumps(value, default=str, option=ORJSON_OPTIONS))  # Size of the response it is rendered into
+        with self._lock:
+            del self._in_flight[key]
+            if size <= self.max_bytes:
+                self._remove(key)
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value, size)
+                self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        future.set_result(value)
+        return value
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions
+            }
+
+
+class JobStore:
+    """ SQLite store for batch job state and results, one row per building report. """
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        with self._lock:
+            if not self._initialized:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_file)), exist_ok=True)
+                with sqlite3.connect(self.db_file) as connection:
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.execute(
+                        "CREATE TABLE IF NOT EXISTS jobs ("
+                        "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, geohashes_done INTEGER NOT NULL DEFAULT 0, "
+                        "geohashes_total INTEGER NOT NULL DEFAULT 0, building_count INTEGER NOT NULL DEFAULT 0, "
+                        "error TEXT, request TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+                    )
+                    connection.execute(
+                        "CREATE TABLE IF NOT EXISTS job_results ("
+                        "job_id TEXT NOT NULL, seq INTEGER NOT NULL, report TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+                    )
+                self._initialized = True
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def create_job(self, job_id: str, request: dict):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (job_id, status, request, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(request), now, now)
+            )
+
+    def update_job(self, job_id: str, **fields):
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.connect() as connection:
+            connection.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE job_id = ?",
+                (*fields.values(), time.time(), job_id)
+            )
+
+    def append_results(self, job_id: str, start_seq: int, reports: List[dict]):
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT INTO job_results (job_id, seq, report) VALUES (?, ?, ?)",
+                [(job_id, start_seq + i, json.dumps(report)) for i, report in enumerate(reports)]
+            )
+            connection.execute(
+                "UPDATE jobs SET building_count = building_count + ?, updated_at = ? WHERE job_id = ?",
+                (len(reports), time.time(), job_id)
+            )
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute(
+                "SELECT job_id, status, geohashes_done, geohashes_total, building_count, error FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_results(self, job_id: str, offset: int, limit: int) -> List[dict]:
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT report FROM job_results WHERE job_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+                (job_id, limit, offset)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def fail_unfinished_jobs(self, reason: str):
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE status IN ('queued', 'running')",
+                (reason, time.time())
+            )
+
+    def delete_finished_jobs(self, finished_before: float) -> int:
+        """ Delete completed and failed jobs last updated before finished_before, with their results. """
+        finished = "SELECT job_id FROM jobs WHERE status IN ('completed', 'failed') AND updated_at < ?"
+        with self.connect() as connection:
+            connection.execute(f"DELETE FROM job_results WHERE job_id IN ({finished})", (finished_before,))
+            return connection.execute(f"DELETE FROM jobs WHERE job_id IN ({finished})", (finished_before,)).rowcount
+
+class JobService:
+    """
+    Runs full-coverage building analyses in the background on a bounded thread pool.
+
+    Finished jobs and their results are deleted retention_seconds after their last update.
+    """
+    def __init__(self, building_service: BuildingService, job_store: JobStore, max_workers: int = 1, retention_seconds: float = 24 * 3600):
+        self.building_service = building_service
+        self.job_store = job_store
+        self.retention_seconds = retention_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+        logger.info("JobService initialized with %s job workers.", max_workers)
+
+    def submit(self, geojson: dict, raster_stats: dict) -> str:
+        self.delete_expired_jobs()
+        job_id = uuid.uuid4().hex
+        self.job_store.create_job(job_id, {'geojson': geojson, 'raster_stats': raster_stats})
+        with self._queued_lock:
+            self._queued += 1
+        try:
+            self.executor.submit(self.run_job, job_id, geojson, raster_stats)
+        except RuntimeError:
+            with self._queued_lock:
+                self._queued -= 1
+            raise
+        logger.info("Queued job %s.", job_id)
+        return job_id
+
+    def delete_expired_jobs(self):
+        deleted = self.job_store.delete_finished_jobs(time.time() - self.retention_seconds)
+        if deleted:
+            logger.info("Deleted %s jobs finished more than %ss ago.", deleted, self.retention_seconds)
+
+    def run_job(self, job_id: str, geojson: dict, raster_stats: dict):
+        with self._queued_lock:
+            self._queued -= 1
+        logger.info("Starting job %s.", job_id)
+        self.job_store.update_job(job_id, status='running')
+        building_count = 0
+        pending_reports = []
+        try:
+            for event in self.building_service.stream_building_reports(geojson, raster_stats, sample=False):
+                if event['event'] == 'building_report':
+                    pending_reports.append(event['data'])
+                elif event['event'] == 'progress':
+                    # Results of a geohash are written together with its progress update
+                    if pending_reports:
+                        self.job_store.append_results(job_id, building_count, pending_reports)
+                        building_count += len(pending_reports)
+                        pending_reports = []
+                    self.job_store.update_job(
+                        job_id, geohashes_done=event['geohashes_done'], geohashes_total=event['geohashes_total']
+                    )
+            self.job_store.update_job(job_id, status='completed')
+            logger.info("Completed job %s with %s building reports.", job_id, building_count)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self.job_store.update_job(job_id, status='failed', error=str(e))
+
+    def get_status(self, job_id: str, offset: int, limit: int) -> Optional[dict]:
+        job = self.job_store.get_job(job_id)
+        if job is None:
+            return None
+        results = self.job_store.get_results(job_id, offset, limit)
+        next_offset = offset + len(results) if offset + len(results) < job['building_count'] else None
+        return {**job, 'offset': offset, 'limit': limit, 'next_offset': next_offset, 'results': results}
+
+    def queue_depth(self) -> int:
+        """ Jobs waiting for a job worker. """
+        with self._queued_lock:
+            return self._queued
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------------------------
+# Worker Pool
+# ---------------------------
+
+def available_cpus() -> int:
+    """ CPUs this process may use: the cgroup CPU quota (docker-compose `cpus`) capped by the CPU affinity mask. """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    quota_files = [
+        ('/sys/fs/cgroup/cpu.max', None),
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    ]
+    for quota_file, period_file in quota_files:
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if period_file is None:
+                quota, period = values[0], values[1]
+            else:
+                with open(period_file) as f:
+                    quota, period = values[0], f.read().strip()
+        except (OSError, IndexError):
+            continue
+        if quota not in ('max', '-1'):
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        break
+    return max(1, cpus)
+
+class BuildingWorkerPool:
+    """ Process pool created once at startup and shared by all requests. """
+    def __init__(self, raster_paths: Dict[str, str], gdal_cache_mb: int = 256, processes: Optional[int] = None):
+        self.raster_paths = raster_paths
+        self.gdal_cache_mb = gdal_cache_mb
+        self.processes = processes or available_cpus()
+        self._pool = None
+        # Shared with the workers, which decrement it as they start each task
+        self._queued_tasks = multiprocessing.get_context('spawn').Value('i', 0)
+
+    def __getstate__(self):
+        # The pool itself lives in the parent process only.
+        return {'raster_paths': self.raster_paths, 'gdal_cache_mb': self.gdal_cache_mb, 'processes': self.processes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def is_running(self) -> bool:
+        return self._pool is not None
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if self.processes <= 1:
+            logger.info("Only one CPU available. Buildings are processed in the request thread.")
+            return
+        logger.info("Starting shared worker pool with %s processes.", self.processes)
+        self._pool = multiprocessing.get_context('spawn').Pool(
+            self.processes,
+            initializer=init_building_worker,
+            initargs=(self.raster_paths, self.gdal_cache_mb, self._queued_tasks)
+        )
+
+    def queue_depth(self) -> int:
+        """ Building tasks waiting for a worker process. """
+        return self._queued_tasks.value
+
+    def map(self, func, tasks: list) -> list:
+        """ func over tasks on the workers; func must call building_reports.task_started() first, as process_building_task does. """
+        chunksize = max(1, len(tasks) // (self.processes * 4))
+        with self._queued_tasks.get_lock():
+            self._queued_tasks.value += len(tasks)
+        return self._pool.map(func, tasks, chunksize=chunksize)
+
+    def close(self):
+        if self._pool is not None:
+            logger.info("Shutting down shared worker pool.")
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
 # ---------------------------
 # Application Initialization
 # ---------------------------
 
 class GeoApp:
+    # Value ranges of the terrain rasters, used to interpret the report values
+    raster_stats = {
+        "slope": [101.018, 657.570],
+        "aspect": [0, 360],
+        "solar": [0, 975]
+    }
+
     def __init__(self):
         self.app = FastAPI(
             title="GeoTerrain API",
@@ -656,12 +1307,30 @@ class GeoApp:
             version="1.0.0",
             contact={
                 "name": "Jaskaran",
-            }
+            },
+            lifespan=self.lifespan
         )
         self.configure_middleware()
         self.configure_services()
         self.configure_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        if not self.building_service.batch_mode:
+            # Batch mode computes whole partitions in the request threads and never uses the pool
+            self.worker_pool.start()
+        if self.use_building_index:
+            # Loaded after the worker pool started, the pool processes only compute stats and never query it
+            self.building_service.building_index = BuildingIndex.load(self.building_service.db_path)
+        self.job_service.job_store.fail_unfinished_jobs("Interrupted by server restart.")
+        self.job_service.delete_expired_jobs()
+        yield
+        logger.info("Shutting down GeoTerrain API.")
+        self.job_service.close()
+        self.geohash_executor.shutdown(wait=True, cancel_futures=True)
+        self.worker_pool.close()
+        self.raster_service.close()
+
     def configure_middleware(self):
         self.app.add_middleware(
             CORSMiddleware,
@@ -677,7 +1346,22 @@ class GeoApp:
             'aspect': '/var/task/fastapi/data/raster/cog_merged_aspect.tif',
             'solar': '/var/task/fastapi/data/raster/cog_global_solar_potential.tif'
         }
-        self.raster_service = RasterService(terrain_rasters)
+        gdal_cache_mb = int(os.environ.get('GDAL_CACHEMAX_MB', 256))
+        self.raster_service = RasterService(
+            terrain_rasters,
+            RasterDatasetPool(gdal_cache_mb=gdal_cache_mb),
+            use_minmax_pyramids=os.environ.get('USE_MINMAX_PYRAMIDS', 'true').lower() == 'true',
+            use_summed_area_tables=os.environ.get('USE_SUMMED_AREA_TABLES', 'false').lower() == 'true'
+        )
+        self.geohash_executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('GEOHASH_EXECUTOR_THREADS', 8)),
+            thread_name_prefix='geohash'
+        )
+        self.worker_pool = BuildingWorkerPool(
+            terrain_rasters,
+            gdal_cache_mb=gdal_cache_mb,
+            processes=int(os.environ.get('WORKER_PROCESSES', 0)) or None
+        )
         self.geohash_service = GeohashService()
         self.interpretation_service = InterpretationService()
         self.report_service = ReportService(self.interpretation_service)
@@ -685,37 +1369,190 @@ class GeoApp:
             raster_service=self.raster_service,
             geohash_service=self.geohash_service,
             report_service=self.report_service,
-            db_path='/var/task/fastapi/db/'
+            db_path='/var/task/fastapi/db/',
+            batch_mode=os.environ.get('PARTITION_BATCH_MODE', 'true').lower() == 'true',
+            partition_cache=BuildingPartitionCache(max_bytes=int(os.environ.get('BUILDING_CACHE_MB', 512)) * 1024 * 1024),
+            worker_pool=self.worker_pool,
+            geohash_executor=self.geohash_executor,
+            max_concurrent_geohashes=int(os.environ.get('GEOHASH_REQUEST_CONCURRENCY', 4)),
+            use_precomputed_stats=os.environ.get('USE_PRECOMPUTED_STATS', 'true').lower() == 'true',
+            bbox_pruning=os.environ.get('PARQUET_BBOX_PRUNING', 'true').lower() == 'true'
+        )
+        self.use_building_index = os.environ.get('BUILDING_INDEX', 'false').lower() == 'true'
+        self.job_service = JobService(
+            building_service=self.building_service,
+            job_store=JobStore(os.environ.get('JOB_DB_PATH', '/var/task/fastapi/jobs/jobs.sqlite')),
+            max_workers=int(os.environ.get('JOB_WORKERS', 1)),
+            retention_seconds=float(os.environ.get('JOB_RETENTION_HOURS', 24)) * 3600
         )
         self.report_cleaner = ReportCleaner()
+        self.request_profiling = os.environ.get('REQUEST_PROFILING', 'false').lower() == 'true'
+        self.profile_dir = os.environ.get('PROFILE_DIR', '/var/task/fastapi/profiles')
+        self.profile_max_count = int(os.environ.get('PROFILE_MAX_COUNT', 50))
+        self.result_cache = ResultCache(
+            max_bytes=int(os.environ.get('RESULT_CACHE_MB', 64)) * 1024 * 1024,
+            ttl_seconds=float(os.environ.get('RESULT_CACHE_TTL_SECONDS', 600))
+        )
+
+    raster_dir = '/var/task/fastapi/data/raster/'
+
+    @staticmethod
+    def timed_response(content, timings: RequestTimings, render=orjson_response) -> Response:
+        """
+        Response rendered as the 'serialize' stage, carrying the request's Server-Timing header.
+
+        The default orjson rendering writes NaN and Inf as null and numpy scalars as numbers,
+        so results need no ReportCleaner pass and no response_model validation before it.
+        """
+        with metrics.timer('serialize'), RequestTimings.stage('serialize'):
+            response = render(content)
+        response.headers['Server-Timing'] = timings.header()
+        return response
+
+    def attach_profile(self, response: Response, timings: RequestTimings) -> Response:
+        """ Store the request's sampled stacks, if it was profiled, and point to them with an X-Profile-Id header. """
+        if timings.profiler is None:
+            return response
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile_id = uuid.uuid4().hex
+            with open(os.path.join(self.profile_dir, f"{profile_id}.folded"), 'w') as f:
+                f.write(timings.profiler.collapsed())
+            self.prune_profiles()
+        except OSError as e:
+            logger.error(f"Error storing request profile: {e}")
+            return response
+        logger.info("Stored profile %s with %s samples.", profile_id, sum(timings.profiler.samples.values()))
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    def prune_profiles(self):
+        """ Delete the oldest stored profiles beyond profile_max_count. """
+        profiles = [entry for entry in os.scandir(self.profile_dir) if entry.name.endswith('.folded')]
+        profiles.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for entry in profiles[self.profile_max_count:]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Pruned by a concurrent request
+
+    def render_metrics(self) -> str:
+        cache_stats = {
+            'building_partitions': self.building_service.partition_cache.stats(),
+            'results': self.result_cache.stats()
+        }
+        queue_depths = {
+            'geohash_executor': self.building_service.geohash_queue_depth(),
+            'worker_pool': self.worker_pool.queue_depth(),
+            'jobs': self.job_service.queue_depth()
+        }
+        families = [
+            metrics.render(),
+            LatencyMetrics.render_family('geoterrain_cache_hits_total', 'counter', 'Cache lookups served from the cache.', [
+                ('', {'cache': cache}, stats['hits']) for cache, stats in cache_stats.items()
+            ]),
+            LatencyMetrics.render_family('geoterrain_cache_misses_total', 'counter', 'Cache lookups that had to compute or read the value.', [
+                ('', {'cache': cache}, stats['misses']) for cache, stats in cache_stats.items()
+            ]),
+            LatencyMetrics.render_family('geoterrain_cache_hit_ratio', 'gauge', 'Share of cache lookups served from the cache since startup.', [
+                ('', {'cache': cache}, stats['hits'] / (stats['hits'] + stats['misses']) if stats['hits'] + stats['misses'] else 0.0)
+                for cache, stats in cache_stats.items()
+            ]),
+            LatencyMetrics.render_family('geoterrain_cache_bytes', 'gauge', 'Approximate bytes held by the cache.', [
+                ('', {'cache': cache}, stats['bytes']) for cache, stats in cache_stats.items()
+            ]),
+            LatencyMetrics.render_family('geoterrain_queue_depth', 'gauge', 'Tasks waiting for a free worker.', [
+                ('', {'pool': pool}, depth) for pool, depth in queue_depths.items()
+            ])
+        ]
+        return "".join(families)
 
     def configure_routes(self):
         app = self.app
         building_service = self.building_service
         raster_service = self.raster_service
+        job_service = self.job_service
+        result_cache = self.result_cache
 
         @app.post(
             "/rasterstats",
             response_model=RasterStatsResponse,
+            response_model_exclude_unset=True,
             summary="Clip Raster and Get Statistics For Terrain Raster",
-            description="Clips a raster file based on the provided GeoJSON geometry and returns the minimum and maximum values within the clipped area.",
+            description="Clips a raster file based on the provided GeoJSON geometry and returns the minimum and maximum values within the clipped area. With `approximate` large polygons are read from a raster overview that fits `max_pixels`.",
             tags=["Raster Operations"]
         )
-        def clip_and_stats(request_data: GeoClipRequest):
-            base_path = '/var/task/fastapi/data/raster/'
+        def clip_and_stats(
+            request_data: GeoClipRequest,
+            profile: bool = Query(False, description="Sample this request's stacks into a flamegraph file, returned as `X-Profile-Id` and served at `/profiles/{profile_id}`. Bypasses the result cache.")
+        ):
             geojson = request_data.geojson
-            tif_url = os.path.join(base_path, request_data.tif_url)
+            tif_url = os.path.join(self.raster_dir, request_data.tif_url)
+            max_pixels = (request_data.max_pixels or RasterService.default_max_pixels) if request_data.approximate else None
 
             if not os.path.exists(tif_url):
                 logger.error(f"Raster file {tif_url} does not exist.")
                 raise HTTPException(status_code=404, detail="Raster file not found.")
 
-            try:
-                stats = raster_service.clip_raster_stats(geojson, tif_url)
-                return stats
-            except Exception as e:
-                logger.error(f"Error in /rasterstats: {e}")
-                raise HTTPException(status_code=500, detail="Error processing raster data.")
+            profile = profile and self.request_profiling
+            with RequestTimings.collect(profile) as timings:
+                try:
+                    stats = result_cache.get_or_compute(
+                        None if profile else ResultCache.geometry_key(geojson, 'rasterstats', request_data.tif_url, max_pixels),
+                        lambda: raster_service.clip_raster_stats(geojson, tif_url, max_pixels)
+                    )
+                except Exception as e:
+                    logger.error(f"Error in /rasterstats: {e}")
+                    raise HTTPException(status_code=500, detail="Error processing raster data.")
+                response = self.timed_response(stats, timings)
+            return self.attach_profile(response, timings)
+
+        @app.post(
+            "/rasterstats/batch",
+            response_model=RasterStatsBatchResponse,
+            response_model_exclude_unset=True,
+            summary="Get Statistics For Several Terrain Rasters And Geometries",
+            description="Returns the minimum and maximum of every raster in `tif_urls` within each GeoJSON of `geojsons`, as `/rasterstats` would. Each geometry is parsed once and rasterized once per raster grid, so one request refreshes a whole legend.",
+            tags=["Raster Operations"]
+        )
+        def clip_and_stats_batch(
+            request_data: GeoClipBatchRequest,
+            profile: bool = Query(False, description="Sample this request's stacks into a flamegraph file, returned as `X-Profile-Id` and served at `/profiles/{profile_id}`. Bypasses the result cache.")
+        ):
+            tif_urls = list(dict.fromkeys(request_data.tif_urls))
+            tif_paths = {tif_url: os.path.join(self.raster_dir, tif_url) for tif_url in tif_urls}
+            max_pixels = (request_data.max_pixels or RasterService.default_max_pixels) if request_data.approximate else None
+
+            for tif_path in tif_paths.values():
+                if not os.path.exists(tif_path):
+                    logger.error(f"Raster file {tif_path} does not exist.")
+                    raise HTTPException(status_code=404, detail="Raster file not found.")
+
+            profile = profile and self.request_profiling
+            with RequestTimings.collect(profile) as timings:
+                results = []
+                for geojson in request_data.geojsons:
+                    try:
+                        raster_stats = result_cache.get_or_compute(
+                            None if profile else ResultCache.geometry_key(geojson, 'rasterstats_batch', max_pixels, *tif_urls),
+                            lambda: raster_service.clip_rasters_stats(geojson, list(tif_paths.values()), max_pixels)
+                        )
+                    except Exception as e:
+                        logger.error(f"Error in /rasterstats/batch: {e}")
+                        raise HTTPException(status_code=500, detail="Error processing raster data.")
+                    results.append({tif_url: raster_stats[tif_path] for tif_url, tif_path in tif_paths.items()})
+                response = self.timed_response({'results': results}, timings)
+            return self.attach_profile(response, timings)
+
+        @app.get(
+            "/metrics",
+            response_class=PlainTextResponse,
+            summary="Prometheus Metrics",
+            description="Latency histograms of the backend stages, cache hit ratios and queue depths in the Prometheus text format.",
+            tags=["Health Check"]
+        )
+        def prometheus_metrics():
+            return PlainTextResponse(self.render_metrics(), media_type="text/plain; version=0.0.4")
 
         @app.get(
             "/health",
@@ -731,18 +1568,115 @@ class GeoApp:
             "/stats",
             response_model=StatsResponse,
             summary="Generate Building Insights",
-            description="Processes building data within a GeoJSON polygon and returns detailed reports.",
+            description="Processes building data within a GeoJSON polygon and returns detailed reports. With `stream=ndjson` or `stream=sse` the reports are streamed per geohash together with progress events. With `format=columnar` or `format=arrow` the reports are returned as columns with one row per building and zone.",
             tags=["Building Insights"]
         )
-        def bbox_insights(request_data: GeoInsights):
-            raster_stats = {
-                "slope": [101.018, 657.570],
-                "aspect": [0, 360],
-                "solar": [0, 975]
-            }
-            building_reports = building_service.generate_building_reports(request_data.geojson, raster_stats)
-            cleaned_reports = ReportCleaner.remove_nan_values(building_reports)
-            return {'building_reports': cleaned_reports}
+        def bbox_insights(
+            request_data: GeoInsights,
+            stream: Optional[Literal['ndjson', 'sse']] = Query(None, description="Stream reports per geohash as NDJSON lines or Server-Sent Events instead of one JSON document."),
+            profile: bool = Query(False, description="Sample this request's stacks into a flamegraph file, returned as `X-Profile-Id` and served at `/profiles/{profile_id}`. Bypasses the result cache; ignored when streaming."),
+            response_format: Literal['json', 'columnar', 'arrow'] = Query('json', alias='format', description="`columnar` returns JSON arrays per column (building_id, group, zone, slope, aspect, solar and their texts), `arrow` the same columns as an Arrow IPC stream. Ignored when streaming.")
+        ):
+            raster_stats = self.raster_stats
+            if stream == 'ndjson':
+                events = building_service.stream_building_reports(request_data.geojson, raster_stats)
+                return StreamingResponse(
+                    (json.dumps(event) + "\n" for event in events),
+                    media_type="application/x-ndjson"
+                )
+            if stream == 'sse':
+                events = building_service.stream_building_reports(request_data.geojson, raster_stats)
+                return StreamingResponse(
+                    (f"event: {event['event']}\ndata: {json.dumps(event)}\n\n" for event in events),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache"}
+                )
+
+            if response_format == 'arrow':
+                def render(reports):
+                    return Response(ReportColumns.to_arrow(ReportColumns.from_reports(reports)), media_type=ReportColumns.arrow_media_type)
+            elif response_format == 'columnar':
+                def render(reports):
+                    return orjson_response(ReportColumns.from_reports(reports))
+            else:
+                def render(reports):
+                    return orjson_response({'building_reports': reports})
+
+            profile = profile and self.request_profiling
+            with RequestTimings.collect(profile) as timings:
+                # Identical polygons share one computation and its cached result, whatever the format
+                building_reports = result_cache.get_or_compute(
+                    None if profile else ResultCache.geometry_key(request_data.geojson, 'stats'),
+                    lambda: building_service.generate_building_reports(request_data.geojson, raster_stats)
+                )
+                response = self.timed_response(building_reports, timings, render)
+            return self.attach_profile(response, timings)
+
+        @app.get(
+            "/building-at",
+            response_model=BuildingAtResponse,
+            summary="Get Building At Point",
+            description="Returns the footprint and report of the building containing a lon/lat point. Only the point's geohash partition is consulted, through its cached spatial index.",
+            tags=["Building Insights"]
+        )
+        def building_at(
+            lon: float = Query(..., ge=-180, le=180, description="Longitude in EPSG:4326."),
+            lat: float = Query(..., ge=-90, le=90, description="Latitude in EPSG:4326.")
+        ):
+            with RequestTimings.collect(False) as timings:
+                try:
+                    building = building_service.building_at(lon, lat, self.raster_stats)
+                except Exception as e:
+                    logger.error(f"Error in /building-at: {e}")
+                    raise HTTPException(status_code=500, detail="Error processing building data.")
+                if building is None:
+                    raise HTTPException(status_code=404, detail="No building found at this location.")
+                return self.timed_response(building, timings)
+
+        @app.get(
+            "/profiles/{profile_id}",
+            response_class=PlainTextResponse,
+            summary="Get Request Profile",
+            description="Returns the sampled stacks of a request made with `profile=true`, in the collapsed stack format of flamegraph.pl and speedscope.",
+            tags=["Health Check"]
+        )
+        def get_profile(profile_id: str):
+            profile_path = os.path.join(self.profile_dir, f"{profile_id}.folded")
+            if not re.fullmatch(r'[0-9a-f]{32}', profile_id) or not os.path.exists(profile_path):
+                raise HTTPException(status_code=404, detail="Profile not found.")
+            with open(profile_path) as f:
+                return PlainTextResponse(f.read())
+
+        @app.post(
+            "/jobs/stats",
+            response_model=JobSubmitResponse,
+            status_code=202,
+            summary="Submit Building Insights Job",
+            description="Queues a background job that processes every building within a GeoJSON polygon. Poll `/jobs/{job_id}` for progress and results.",
+            tags=["Building Insights"]
+        )
+        def submit_stats_job(request_data: GeoInsights):
+            raster_stats = self.raster_stats
+            try:
+                job_id = job_service.submit(request_data.geojson, raster_stats)
+            except Exception as e:
+                logger.error(f"Error in /jobs/stats: {e}")
+                raise HTTPException(status_code=500, detail="Error queuing job.")
+            return {'job_id': job_id, 'status': 'queued'}
+
+        @app.get(
+            "/jobs/{job_id}",
+            response_model=JobStatusResponse,
+            response_model_exclude_unset=True,
+            summary="Get Building Insights Job",
+            description="Returns the progress of a job and a page of its building reports.",
+            tags=["Building Insights"]
+        )
+        def get_stats_job(job_id: str, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+            job = job_service.get_status(job_id, offset, limit)
+            if job is None:
+                raise HTTPException(status_code=404, detail="Job not found.")
+            return job
 
 # Instantiate the application
 geo_app = GeoApp()
@@ -0,0 +1,1256 @@
+"""
+Zonal statistics of the terrain rasters, shared by the API (main.py) and the preprocessing scripts.
+
+Importing this module has no side effects: it creates no app, pools or open datasets.
+"""
+from typing import List, Dict, Optional, Hashable, Iterator, Tuple, Union
+import rasterio
+from rasterio.mask import mask
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.windows import Window
+from rasterio.transform import Affine
+from rasterio.errors import WindowError
+import os
+import numpy as np
+import shapely
+from shapely.geometry import shape, Polygon
+import pyarrow as pa
+import pyarrow.parquet as pq
+import math
+import json
+import shutil
+import threading
+import logging
+from instrumentation import metrics, RequestTimings
+
+logger = logging.getLogger(__name__)
+
+class RasterDatasetPool:
+    """ Long-lived rasterio dataset handles, one per (process, thread), reopened when the file on disk changes. """
+    def __init__(self, gdal_cache_mb: int = 256):
+        self.gdal_cache_mb = gdal_cache_mb
+        self._handles = {}
+        self._lock = threading.Lock()
+        rasterio.env.set_gdal_config('GDAL_CACHEMAX', gdal_cache_mb)
+        logger.info("RasterDatasetPool initialized with a %s MB GDAL block cache.", gdal_cache_mb)
+
+    def __getstate__(self):
+        # Open datasets cannot cross process boundaries, workers open their own.
+        return {'gdal_cache_mb': self.gdal_cache_mb}
+
+    def __setstate__(self, state):
+        self.__init__(state['gdal_cache_mb'])
+
+    def _thread_handles(self) -> dict:
+        key = (os.getpid(), threading.get_ident())
+        with self._lock:
+            return self._handles.setdefault(key, {})
+
+    def get(self, path: str, overview_level: Optional[int] = None):
+        """ Pooled dataset for path, or for one of its overviews (0-based, as in rasterio.open). """
+        handles = self._thread_handles()
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = path if overview_level is None else (path, overview_level)
+
+        entry = handles.get(key)
+        if entry is not None:
+            src, cached_signature = entry
+            if cached_signature == signature and not src.closed:
+                return src
+            logger.info("Raster file %s changed on disk. Reopening dataset.", path)
+            src.close()
+
+        if overview_level is None:
+            logger.info("Opening raster file: %s", path)
+            src = rasterio.open(path)
+        else:
+            logger.info("Opening overview %s of raster file: %s", overview_level, path)
+            src = rasterio.open(path, overview_level=overview_level)
+        handles[key] = (src, signature)
+        return src
+
+    def close(self):
+        pid = os.getpid()
+        with self._lock:
+            for key in [key for key in self._handles if key[0] == pid]:
+                for src, _ in self._handles.pop(key).values():
+                    src.close()
+        logger.info("Closed all pooled raster datasets.")
+
+class RasterSidecar:
+    """
+    Offline index of a raster, stored as memory-mappable .npy arrays in a '{raster}{suffix}/' directory.
+
+    meta.json records the grid the index was built for. Indexes need a non-NaN nodata value: without one
+    mask() counts pixels outside the polygon as 0, which a precomputed index cannot express.
+    """
+    suffix = ''
+    meta_filename = 'meta.json'
+
+    def __init__(self, meta: dict, arrays: Dict[str, np.ndarray]):
+        self.meta = meta
+        self.arrays = arrays
+
+    @classmethod
+    def sidecar_dir(cls, raster_path: str) -> str:
+        return raster_path + cls.suffix
+
+    @classmethod
+    def open_build(cls, raster_path: str, src) -> str:
+        """ Empty temporary directory for a build of the sidecar of src, after checking the raster suits it. """
+        if src.nodata is None or np.isnan(src.nodata):
+            raise ValueError(f"Raster {raster_path} needs a non-NaN nodata value for a {cls.__name__}.")
+        if src.transform.b != 0 or src.transform.d != 0:
+            raise ValueError(f"Raster {raster_path} is rotated, a {cls.__name__} needs a north-up grid.")
+        tmp_directory = cls.sidecar_dir(raster_path) + '.tmp'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        return tmp_directory
+
+    @classmethod
+    def commit_build(cls, raster_path: str, src, meta: dict) -> str:
+        """ Write meta.json and move the temporary directory in place, so readers never see a partial sidecar. """
+        directory = cls.sidecar_dir(raster_path)
+        tmp_directory = directory + '.tmp'
+        meta = dict(meta, width=src.width, height=src.height, count=src.count, nodata=src.nodata, transform=list(src.transform)[:6])
+        meta['arrays'] = sorted(name[:-len('.npy')] for name in os.listdir(tmp_directory) if name.endswith('.npy'))
+        with open(os.path.join(tmp_directory, cls.meta_filename), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+        return directory
+
+    @classmethod
+    def load(cls, raster_path: str):
+        """ Memory-mapped sidecar of raster_path, or None if it is missing, older than the raster or unreadable. """
+        directory = cls.sidecar_dir(raster_path)
+        meta_path = os.path.join(directory, cls.meta_filename)
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            if os.stat(meta_path).st_mtime_ns < os.stat(raster_path).st_mtime_ns:
+                logger.warning(f"{cls.__name__} {directory} is older than the raster. Reading full resolution pixels.")
+                return None
+            with open(meta_path) as f:
+                meta = json.load(f)
+            arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in meta['arrays']}
+        except Exception as e:
+            logger.error(f"Error reading {cls.__name__} {directory}: {e}")
+            return None
+        logger.info("Loaded %s %s.", cls.__name__, directory)
+        return cls(meta, arrays)
+
+    def matches(self, src) -> bool:
+        return (
+            (self.meta['width'], self.meta['height'], self.meta['count'], self.meta['nodata']) == (src.width, src.height, src.count, src.nodata)
+            and np.allclose(self.meta['transform'], list(src.transform)[:6], rtol=0, atol=1e-12)
+        )
+
+    @staticmethod
+    def read_valid(src, window: Window) -> Tuple[np.ndarray, np.ndarray]:
+        """ Pixel values of a window as float64 and the mask of pixels that are neither masked nor nodata. """
+        data = src.read(window=window, masked=True)
+        return data.data.astype(np.float64), ~np.ma.getmaskarray(data) & (data.data != src.nodata)
+
+class MinMaxPyramid(RasterSidecar):
+    """
+    Min/max quadtree of a raster, stored as '{raster}.minmax/' sidecar levels.
+
+    Level 0 holds the min and max over all bands of every cell_size x cell_size pixel cell, ignoring
+    masked and nodata pixels; every further level reduces 2x2 cells of the level below. Cells without
+    valid pixels hold min=+inf and max=-inf.
+    """
+    suffix = '.minmax'
+    default_cell_size = 16
+
+    def __init__(self, meta: dict, arrays: Dict[str, np.ndarray]):
+        super().__init__(meta, arrays)
+        self.levels = [(arrays[f'min_{level}'], arrays[f'max_{level}']) for level in range(meta['levels'])]
+
+    @staticmethod
+    def reduce_cells(array: np.ndarray, factor: int, fill: float, reducer) -> np.ndarray:
+        """ reducer over factor x factor cells of the last two axes and all leading axes, padding edges with fill. """
+        height, width = array.shape[-2:]
+        pad_rows, pad_cols = -height % factor, -width % factor
+        array = array.reshape(-1, height, width)
+        if pad_rows or pad_cols:
+            array = np.pad(array, ((0, 0), (0, pad_rows), (0, pad_cols)), constant_values=fill)
+        cells = array.reshape(array.shape[0], (height + pad_rows) // factor, factor, (width + pad_cols) // factor, factor)
+        return reducer(cells, axis=(0, 2, 4))
+
+    @classmethod
+    def build(cls, raster_path: str, cell_size: int = default_cell_size, tile_cells: int = 64) -> str:
+        """ Write the sidecar of raster_path, reading tile_cells x tile_cells cells at a time. Returns its directory. """
+        with rasterio.open(raster_path) as src:
+            tmp_directory = cls.open_build(raster_path, src)
+            shape = (math.ceil(src.height / cell_size), math.ceil(src.width / cell_size))
+            level_min = np.lib.format.open_memmap(os.path.join(tmp_directory, 'min_0.npy'), mode='w+', dtype=np.float64, shape=shape)
+            level_max = np.lib.format.open_memmap(os.path.join(tmp_directory, 'max_0.npy'), mode='w+', dtype=np.float64, shape=shape)
+            tile = cell_size * tile_cells
+            for row_off in range(0, src.height, tile):
+                for col_off in range(0, src.width, tile):
+                    window = Window(col_off, row_off, min(tile, src.width - col_off), min(tile, src.height - row_off))
+                    values, valid = cls.read_valid(src, window)
+                    cell_min = cls.reduce_cells(np.where(valid, values, np.inf), cell_size, np.inf, np.min)
+                    cell_max = cls.reduce_cells(np.where(valid, values, -np.inf), cell_size, -np.inf, np.max)
+                    rows = slice(row_off // cell_size, row_off // cell_size + cell_min.shape[0])
+                    cols = slice(col_off // cell_size, col_off // cell_size + cell_min.shape[1])
+                    level_min[rows, cols] = cell_min
+                    level_max[rows, cols] = cell_max
+            level_min.flush()
+            level_max.flush()
+
+            levels = 1
+            while level_min.shape != (1, 1):
+                level_min = cls.reduce_cells(np.asarray(level_min), 2, np.inf, np.min)
+                level_max = cls.reduce_cells(np.asarray(level_max), 2, -np.inf, np.max)
+                np.save(os.path.join(tmp_directory, f'min_{levels}.npy'), level_min)
+                np.save(os.path.join(tmp_directory, f'max_{levels}.npy'), level_max)
+                levels += 1
+
+            return cls.commit_build(raster_path, src, {'cell_size': cell_size, 'levels': levels})
+
+class SummedAreaTable(RasterSidecar):
+    """
+    Summed-area tables of a raster's valid pixel sums and counts, stored as a '{raster}.sat/' sidecar.
+
+    The raster is split into tile_size x tile_size tiles, each with its own (tile_size + 1)^2 prefix sums
+    over all bands, so any rectangle within a tile is summed from four lookups and float64 sums stay
+    accurate on large rasters.
+    """
+    suffix = '.sat'
+    default_cell_size = 8
+    default_tile_size = 512
+
+    @classmethod
+    def build(cls, raster_path: str, cell_size: int = default_cell_size, tile_size: int = default_tile_size) -> str:
+        """ Write the sidecar of raster_path one tile at a time. Returns its directory. """
+        if tile_size % cell_size:
+            raise ValueError("tile_size must be a multiple of cell_size.")
+
+        with rasterio.open(raster_path) as src:
+            tmp_directory = cls.open_build(raster_path, src)
+            shape = (math.ceil(src.height / tile_size), math.ceil(src.width / tile_size), tile_size + 1, tile_size + 1)
+            sums = np.lib.format.open_memmap(os.path.join(tmp_directory, 'sum.npy'), mode='w+', dtype=np.float64, shape=shape)
+            counts = np.lib.format.open_memmap(os.path.join(tmp_directory, 'count.npy'), mode='w+', dtype=np.int32, shape=shape)
+            for tile_row in range(shape[0]):
+                for tile_col in range(shape[1]):
+                    row_off, col_off = tile_row * tile_size, tile_col * tile_size
+                    window = Window(col_off, row_off, min(tile_size, src.width - col_off), min(tile_size, src.height - row_off))
+                    values, valid = cls.read_valid(src, window)
+                    tile_sum = np.zeros((tile_size, tile_size))
+                    tile_count = np.zeros((tile_size, tile_size), dtype=np.int32)
+                    tile_sum[:window.height, :window.width] = np.where(valid, values, 0).sum(axis=0)
+                    tile_count[:window.height, :window.width] = valid.sum(axis=0)
+                    sums[tile_row, tile_col, 1:, 1:] = tile_sum.cumsum(axis=0).cumsum(axis=1)
+                    counts[tile_row, tile_col, 1:, 1:] = tile_count.cumsum(axis=0).cumsum(axis=1)
+            sums.flush()
+            counts.flush()
+
+            return cls.commit_build(raster_path, src, {'cell_size': cell_size, 'tile_size': tile_size})
+
+    def rectangle_totals(self, row_start: np.ndarray, row_stop: np.ndarray, col_start: np.ndarray, col_stop: np.ndarray) -> Tuple[float, int]:
+        """ Total valid sum and count of pixel rectangles that each lie within one tile. """
+        tile_size = self.meta['tile_size']
+        tile_row, tile_col = row_start // tile_size, col_start // tile_size
+        top, bottom = row_start - tile_row * tile_size, row_stop - tile_row * tile_size
+        left, right = col_start - tile_col * tile_size, col_stop - tile_col * tile_size
+
+        totals = []
+        for name in ('sum', 'count'):
+            table = self.arrays[name]
+            totals.append(
+                table[tile_row, tile_col, bottom, right] - table[tile_row, tile_col, top, right]
+                - table[tile_row, tile_col, bottom, left] + table[tile_row, tile_col, top, left]
+            )
+        return float(totals[0].sum()), int(totals[1].sum())
+
+class RasterService:
+    default_max_pixels = 1_000_000  # Pixel budget of approximate /rasterstats requests
+    block_stream_min_pixels = 1024 * 1024  # Larger crops are reduced block by block instead of masked in one array
+    summed_area_min_pixels = 64 * 64  # Zones with a larger pixel extent take the sums of their interior cells from the summed-area table
+    mask_band_pixels = 1024 * 1024  # Boundary cell masks are rasterized in bands of rows of about this many pixels
+
+    def __init__(self, raster_paths: Dict[str, str], dataset_pool: Optional[RasterDatasetPool] = None, use_minmax_pyramids: bool = True, use_summed_area_tables: bool = False):
+        self.raster_paths = raster_paths
+        self.dataset_pool = dataset_pool or RasterDatasetPool()
+        self.use_minmax_pyramids = use_minmax_pyramids
+        self.use_summed_area_tables = use_summed_area_tables
+        self._sidecars = {}
+        self._sidecars_lock = threading.Lock()
+        logger.info("RasterService initialized with raster paths.")
+
+    def close(self):
+        self.dataset_pool.close()
+
+    def get_raster_stats(self, raster_key: str, zone_geom: Polygon) -> Optional[float]:
+        logger.debug("Starting get_raster_stats for raster_key: %s", raster_key)
+        raster_path = self.raster_paths.get(raster_key)
+        if not raster_path:
+            logger.error(f"No raster path found for key: {raster_key}")
+            return None
+
+        try:
+            src = self.dataset_pool.get(raster_path)
+            if self.use_block_stream(src, [zone_geom]):
+                block_stats = self.block_stream_stats(src, [zone_geom])
+                if block_stats['count'] == 0:
+                    logger.debug("No data found in raster %s for zone %s.", raster_path, zone_geom)
+                    return np.nan
+                mean_val = block_stats['sum'] / block_stats['count']
+                logger.debug("Computed block-streamed mean value for raster %s: %s", raster_key, mean_val)
+                return mean_val
+
+            logger.debug("Masking raster with provided geometry.")
+            out_image, _ = mask(src, [zone_geom], crop=True, all_touched=True)
+            data = out_image
+
+            if src.nodata is not None:
+                logger.debug("Removing nodata values from raster data.")
+                data = data[data != src.nodata]
+            if data.size == 0:
+                logger.debug("No data found in raster %s for zone %s.", raster_path, zone_geom)
+                return np.nan
+            mean_val = float(data.mean())
+            logger.debug("Computed mean value for raster %s: %s", raster_key, mean_val)
+            return mean_val
+        except Exception as e:
+            logger.error("Error processing raster %s for zone with bounds %s: %s", raster_path, zone_geom.bounds, e)
+            return np.nan
+
+    @metrics.timed('get_zones_stats')
+    def get_zones_stats(self, raster_key: str, zones: Dict[Hashable, Polygon]) -> Dict[Hashable, Optional[float]]:
+        """
+        Mean value of every zone from a single window read covering all of them.
+
+        Each zone is burned as one bit of a shared label array, rasterized on the same
+        grid mask(..., crop=True, all_touched=True) would use, so the means match
+        get_raster_stats called zone by zone. The interior of large zones is summed from
+        the raster's summed-area table, see summed_area_interior.
+        """
+        logger.debug("Starting get_zones_stats for raster_key: %s with %s zones", raster_key, len(zones))
+        raster_path = self.raster_paths.get(raster_key)
+        if not raster_path:
+            logger.error(f"No raster path found for key: {raster_key}")
+            return {key: None for key in zones}
+        if not zones:
+            return {}
+        if len(zones) > 64:
+            raise ValueError("get_zones_stats supports at most 64 zones per call.")
+
+        zone_keys = list(zones)
+        try:
+            src = self.dataset_pool.get(raster_path)
+            window = geometry_window(src, list(zones.values()))
+            data = src.read(window=window, masked=True)
+        except Exception as e:
+            logger.error(f"Error reading window from raster {raster_path}: {e}")
+            return {key: np.nan for key in zone_keys}
+
+        labels = np.zeros(data.shape[-2:], dtype=np.uint64)
+        zone_slices = {}
+        for bit, (key, zone_geom) in enumerate(zones.items()):
+            try:
+                zone_window = geometry_window(src, [zone_geom])
+            except WindowError:
+                logger.debug("Zone %s does not overlap raster %s.", key, raster_path)
+                continue
+            if zone_window.height == 0 or zone_window.width == 0:
+                continue
+            row_off = int(zone_window.row_off - window.row_off)
+            col_off = int(zone_window.col_off - window.col_off)
+            rows = slice(row_off, row_off + int(zone_window.height))
+            cols = slice(col_off, col_off + int(zone_window.width))
+            inside = geometry_mask(
+                [zone_geom],
+                transform=src.window_transform(zone_window),
+                out_shape=(int(zone_window.height), int(zone_window.width)),
+                all_touched=True,
+                invert=True
+            )
+            labels[rows, cols] |= inside.astype(np.uint64) << np.uint64(bit)
+            zone_slices[key] = (bit, rows, cols, zone_window)
+
+        table = self.summed_area_table(raster_path, src)
+        fill_value = src.nodata if src.nodata is not None else 0
+        invalid = np.ma.getmaskarray(data)
+        zone_stats = {}
+        summed_count = 0
+        for key in zones:
+            if key not in zone_slices:
+                zone_stats[key] = np.nan
+                continue
+            bit, rows, cols, zone_window = zone_slices[key]
+            outside = ((labels[rows, cols] >> np.uint64(bit)) & np.uint64(1)) == 0
+            summed = table is not None and zone_window.height * zone_window.width >= self.summed_area_min_pixels
+            if summed:
+                interior_sum, interior_count, covered = self.summed_area_interior(table, ~outside, zone_window)
+                outside |= covered
+                summed_count += 1
+            zone_image = np.where(invalid[:, rows, cols] | outside, fill_value, data.data[:, rows, cols]).astype(data.dtype)
+            if src.nodata is not None:
+                zone_image = zone_image[zone_image != src.nodata]
+            if summed:
+                total_count = interior_count + zone_image.size
+                zone_stats[key] = (interior_sum + float(zone_image.sum(dtype=np.float64))) / total_count if total_count else np.nan
+            else:
+                zone_stats[key] = float(zone_image.mean()) if zone_image.size else np.nan
+
+        logger.debug("Computed mean values for %s zones of raster %s, %s using the summed-area table", len(zone_stats), raster_key, summed_count)
+        return {key: zone_stats[key] for key in zone_keys}
+
+    @staticmethod
+    def assign_label_layers(pixel_windows: np.ndarray, out_shape: tuple) -> np.ndarray:
+        """
+        First-fit assignment of zones to label layers so that no two zones in a layer share a pixel.
+
+        pixel_windows holds (row_start, row_stop, col_start, col_stop) per zone; zones whose
+        windows overlap are pushed to a later layer.
+        """
+        layers = np.full(len(pixel_windows), -1, dtype=np.int64)
+        occupancy = []
+        for zone_idx, (row_start, row_stop, col_start, col_stop) in enumerate(pixel_windows):
+            if row_stop <= row_start or col_stop <= col_start:
+                continue
+            for layer_idx, occupied in enumerate(occupancy):
+                if not occupied[row_start:row_stop, col_start:col_stop].any():
+                    break
+            else:
+                occupancy.append(np.zeros(out_shape, dtype=bool))
+                layer_idx = len(occupancy) - 1
+            occupancy[layer_idx][row_start:row_stop, col_start:col_stop] = True
+            layers[zone_idx] = layer_idx
+        return layers
+
+    @metrics.timed('get_partition_zones_stats')
+    def get_partition_zones_stats(self, raster_key: str, zone_geoms: np.ndarray) -> np.ndarray:
+        """
+        Mean value of many zones (e.g. every zone of every building in a geohash) from one window read.
+
+        Zones are burned into integer label rasters aligned to the window, stacked in as few
+        layers as needed to keep overlapping zones apart, and reduced with np.bincount.
+        The interior of large zones is summed from the raster's summed-area table, see summed_area_interior.
+        Returns one mean per zone, NaN where the zone has no valid pixels.
+        """
+        logger.debug("Starting get_partition_zones_stats for raster_key: %s with %s zones", raster_key, len(zone_geoms))
+        zone_means = np.full(len(zone_geoms), np.nan)
+        raster_path = self.raster_paths.get(raster_key)
+        if not raster_path:
+            logger.error(f"No raster path found for key: {raster_key}")
+            return zone_means
+        if len(zone_geoms) == 0:
+            return zone_means
+
+        try:
+            src = self.dataset_pool.get(raster_path)
+        except Exception as e:
+            logger.error(f"Error opening raster {raster_path}: {e}")
+            return zone_means
+
+        row_start, row_stop, col_start, col_stop = self.pixel_extents(src, zone_geoms)
+        overlapping = (row_stop > row_start) & (col_stop > col_start)
+        if not overlapping.any():
+            logger.warning(f"No zones overlap raster {raster_path}.")
+            return zone_means
+
+        window = Window(
+            col_off=int(col_start[overlapping].min()),
+            row_off=int(row_start[overlapping].min()),
+            width=int(col_stop[overlapping].max() - col_start[overlapping].min()),
+            height=int(row_stop[overlapping].max() - row_start[overlapping].min())
+        )
+        try:
+            data = src.read(window=window, masked=True)
+        except Exception as e:
+            logger.error(f"Error reading window from raster {raster_path}: {e}")
+            return zone_means
+
+        table = self.summed_area_table(raster_path, src)
+        summed = overlapping & ((row_stop - row_start) * (col_stop - col_start) >= self.summed_area_min_pixels) if table is not None else np.zeros(len(zone_geoms), dtype=bool)
+        zone_windows = {
+            zone_id: Window(int(col_start[zone_id]), int(row_start[zone_id]), int(col_stop[zone_id] - col_start[zone_id]), int(row_stop[zone_id] - row_start[zone_id]))
+            for zone_id in np.flatnonzero(summed).tolist()
+        }
+
+        out_shape = data.shape[-2:]
+        transform = src.window_transform(window)
+        row_start, row_stop = row_start - window.row_off, row_stop - window.row_off
+        col_start, col_stop = col_start - window.col_off, col_stop - window.col_off
+
+        # all_touched can burn a pixel sharing an edge with the extent, so pad by one for the overlap test
+        padded_windows = np.stack([
+            np.maximum(row_start - 1, 0), np.minimum(row_stop + 1, out_shape[0]),
+            np.maximum(col_start - 1, 0), np.minimum(col_stop + 1, out_shape[1])
+        ], axis=1)
+        padded_windows[~overlapping] = 0
+        layers = self.assign_label_layers(padded_windows, out_shape)
+
+        invalid = np.ma.getmaskarray(data)
+        if src.nodata is not None:
+            invalid = invalid | (data.data == src.nodata)
+        values = np.where(invalid, 0, data.data).astype(np.float64)
+        valid = (~invalid).astype(np.float64)
+
+        sums = np.zeros(len(zone_geoms))
+        counts = np.zeros(len(zone_geoms))
+        for layer_idx in range(layers.max() + 1):
+            labels = rasterize(
+                [(zone_geoms[zone_id], zone_id + 1) for zone_id in np.flatnonzero(layers == layer_idx)],
+                out_shape=out_shape,
+                transform=transform,
+                fill=0,
+                all_touched=True,
+                dtype='int32'
+            )
+            # Zones of a layer are apart, so the table cells inside each can share one layer-wide mask
+            layer_summed = np.flatnonzero(summed & (layers == layer_idx)).tolist()
+            if layer_summed:
+                covered = np.zeros(out_shape, dtype=bool)
+            for zone_id in layer_summed:
+                rows = slice(row_start[zone_id], row_stop[zone_id])
+                cols = slice(col_start[zone_id], col_stop[zone_id])
+                interior_sum, interior_count, covered[rows, cols] = self.summed_area_interior(table, labels[rows, cols] == zone_id + 1, zone_windows[zone_id])
+                sums[zone_id] += interior_sum
+                counts[zone_id] += interior_count
+            rows_idx, cols_idx = np.nonzero(labels)
+            zone_idx = labels[rows_idx, cols_idx] - 1
+            # Drop pixels touched outside the zone's own extent, which a cropped mask() would never see
+            inside = (
+                (rows_idx >= row_start[zone_idx]) & (rows_idx < row_stop[zone_idx]) &
+                (cols_idx >= col_start[zone_idx]) & (cols_idx < col_stop[zone_idx])
+            )
+            if layer_summed:
+                # The pixels of table cells inside the zone are already summed
+                inside &= ~covered[rows_idx, cols_idx]
+            rows_idx, cols_idx, zone_idx = rows_idx[inside], cols_idx[inside], zone_idx[inside]
+            for band in range(data.shape[0]):
+                sums += np.bincount(zone_idx, weights=values[band, rows_idx, cols_idx], minlength=len(zone_geoms))
+                counts += np.bincount(zone_idx, weights=valid[band, rows_idx, cols_idx], minlength=len(zone_geoms))
+
+        if src.nodata is None:
+            # mask() fills pixels outside the zone with 0 when the raster has no nodata, and they count towards the mean
+            counts = np.where(counts > 0, (row_stop - row_start) * (col_stop - col_start) * data.shape[0], 0)
+
+        np.divide(sums, counts, out=zone_means, where=counts > 0)
+        logger.debug("Computed mean values for %s zones of raster %s using %s label layers", len(zone_geoms), raster_key, layers.max() + 1)
+        return zone_means
+
+    @staticmethod
+    def pixel_extents(src, zone_geoms: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Row start/stop and column start/stop of every zone, clipped to the raster, with the floor/ceil rule geometry_window uses. """
+        minx, miny, maxx, maxy = shapely.bounds(zone_geoms).T
+        inverse = ~src.transform
+        cols = np.stack([inverse.a * minx + inverse.c, inverse.a * maxx + inverse.c])
+        rows = np.stack([inverse.e * maxy + inverse.f, inverse.e * miny + inverse.f])
+        row_start = np.clip(np.floor(rows.min(axis=0)), 0, src.height).astype(np.int64)
+        row_stop = np.clip(np.ceil(rows.max(axis=0)), 0, src.height).astype(np.int64)
+        col_start = np.clip(np.floor(cols.min(axis=0)), 0, src.width).astype(np.int64)
+        col_stop = np.clip(np.ceil(cols.max(axis=0)), 0, src.width).astype(np.int64)
+        return row_start, row_stop, col_start, col_stop
+
+    def summed_area_table(self, raster_path: str, src) -> Optional[SummedAreaTable]:
+        """
+        The raster's current summed-area table, or None when it has none or no nodata value: mask()
+        then counts the pixels outside a zone as 0, which the table does not hold.
+        """
+        if not self.use_summed_area_tables or src.nodata is None:
+            return None
+        table = self.get_sidecar(SummedAreaTable, raster_path)
+        return table if table is not None and table.matches(src) else None
+
+    @staticmethod
+    def summed_area_interior(table: SummedAreaTable, inside: np.ndarray, crop: Window) -> Tuple[float, int, np.ndarray]:
+        """
+        Sum and count of the pixels of the table cells lying fully inside a zone mask, from O(1) lookups per cell.
+
+        inside is the zone's all_touched mask over crop, as the zone paths already rasterize it; every pixel
+        of a cell it fully covers is selected, so the cell's table totals are exact. Also returns the mask
+        of those cells' pixels, whose complement within inside the zone paths sum from the window they read.
+        """
+        cell_size = table.meta['cell_size']
+        row_start, col_start = int(crop.row_off), int(crop.col_off)
+        cell_row_start, cell_col_start = -(-row_start // cell_size), -(-col_start // cell_size)
+        cell_row_stop, cell_col_stop = (row_start + int(crop.height)) // cell_size, (col_start + int(crop.width)) // cell_size
+        covered = np.zeros(inside.shape, dtype=bool)
+        if cell_row_stop <= cell_row_start or cell_col_stop <= cell_col_start:
+            return 0.0, 0, covered
+
+        rows = slice(cell_row_start * cell_size - row_start, cell_row_stop * cell_size - row_start)
+        cols = slice(cell_col_start * cell_size - col_start, cell_col_stop * cell_size - col_start)
+        full = inside[rows, cols].reshape(cell_row_stop - cell_row_start, cell_size, cell_col_stop - cell_col_start, cell_size).all(axis=(1, 3))
+        cell_rows, cell_cols = np.nonzero(full)
+        cell_rows, cell_cols = (cell_rows + cell_row_start) * cell_size, (cell_cols + cell_col_start) * cell_size
+        total_sum, total_count = table.rectangle_totals(cell_rows, cell_rows + cell_size, cell_cols, cell_cols + cell_size)
+        covered[rows, cols] = np.repeat(np.repeat(full, cell_size, axis=0), cell_size, axis=1)
+        return total_sum, total_count, covered
+
+    def use_block_stream(self, src, geometries: list) -> bool:
+        try:
+            window = geometry_window(src, geometries)
+            return window.width * window.height * src.count > self.block_stream_min_pixels
+        except Exception:
+            return False  # Let mask() report geometries outside the raster
+
+    @staticmethod
+    def crop_mask(src, geometries: list, crop: Window) -> np.ndarray:
+        """
+        all_touched pixel mask of the geometries over their crop window.
+
+        Rasterized on the crop's own transform like mask(crop=True), so slices of it select the same
+        pixels mask() does. Rasterizing each sub-window on its own transform does not: edges running
+        exactly along pixel boundaries may touch a neighbouring pixel from one origin and not from another.
+        """
+        return geometry_mask(
+            geometries, transform=src.window_transform(crop),
+            out_shape=(int(crop.height), int(crop.width)), all_touched=True, invert=True
+        )
+
+    @staticmethod
+    def window_mask(inside: np.ndarray, crop: Window, window: Window) -> np.ndarray:
+        """ Slice of the crop_mask inside covering window, a sub-window of crop. """
+        row_off, col_off = int(window.row_off) - int(crop.row_off), int(window.col_off) - int(crop.col_off)
+        return inside[row_off:row_off + int(window.height), col_off:col_off + int(window.width)]
+
+    @staticmethod
+    def pixel_geometries(src, geometries: list, crop: Window) -> list:
+        """
+        The geometries in pixel coordinates of their crop window, inverting the crop transform as GDAL does.
+
+        Rows of the crop rasterized from them with an integer translation (band_mask) land on the
+        same pixel edges as one rasterization of the whole crop, and so select the pixels mask() does.
+        """
+        transform = src.window_transform(crop)
+        if transform.b == 0 and transform.d == 0:
+            # GDALInvGeoTransform's north-up case, which rasterize() applies to geographic coordinates
+            x_off, x_scale, y_off, y_scale = -transform.c / transform.a, 1.0 / transform.a, -transform.f / transform.e, 1.0 / transform.e
+
+            def to_pixels(coords):
+                return np.column_stack([x_off + coords[:, 0] * x_scale, y_off + coords[:, 1] * y_scale])
+        else:
+            inverse = ~transform
+
+            def to_pixels(coords):
+                return np.column_stack(inverse * (coords[:, 0], coords[:, 1]))
+        return [shapely.transform(geom, to_pixels) for geom in geometries]
+
+    @staticmethod
+    def band_mask(pixel_geoms: list, crop: Window, top: int, bottom: int) -> np.ndarray:
+        """
+        Rows top to bottom (relative to crop) of the geometries' crop_mask, without rasterizing the rest of the crop.
+
+        Bands span the full crop width: GDAL's all_touched rasterizer writes out of bounds when a
+        narrower output's right edge passes exactly through a vertex, as on-grid geometries often do.
+        """
+        return geometry_mask(
+            pixel_geoms, transform=Affine.translation(0, top),
+            out_shape=(bottom - top, int(crop.width)), all_touched=True, invert=True
+        )
+
+    def iter_window_masks(self, src, geometries: list, crop: Window, windows: List[Window]) -> Iterator[Tuple[Window, np.ndarray]]:
+        """
+        Each window of the crop with its slice of the geometries' crop_mask.
+
+        Only bands of rows holding windows are rasterized, each of about mask_band_pixels, so the
+        cost follows the rows the windows span rather than the crop area.
+        """
+        pixel_geoms = self.pixel_geometries(src, geometries, crop)
+        row_start, col_start = int(crop.row_off), int(crop.col_off)
+        band_rows = max(self.mask_band_pixels // int(crop.width), 1)
+        windows = sorted(windows, key=lambda window: window.row_off)
+        band_start = 0
+        while band_start < len(windows):
+            top = int(windows[band_start].row_off) - row_start
+            band_stop, bottom = band_start, top
+            while band_stop < len(windows) and int(windows[band_stop].row_off) - row_start < top + band_rows:
+                bottom = max(bottom, int(windows[band_stop].row_off) + int(windows[band_stop].height) - row_start)
+                band_stop += 1
+            band = self.band_mask(pixel_geoms, crop, top, bottom)
+            for window in windows[band_start:band_stop]:
+                row_off, col_off = int(window.row_off) - row_start - top, int(window.col_off) - col_start
+                yield window, band[row_off:row_off + int(window.height), col_off:col_off + int(window.width)]
+            band_start = band_stop
+
+    @staticmethod
+    def iter_block_masks(src, geometries: list) -> Iterator[Tuple[Window, Union[np.ndarray, bool]]]:
+        """
+        Every internal raster block window of the geometries' crop with its slice of their crop_mask.
+
+        The mask is rasterized one row of blocks at a time. Slices the geometries cover fully are
+        reduced to True and untouched ones to False, so only blocks crossed by a boundary keep an array.
+        """
+        try:
+            window = geometry_window(src, geometries)
+        except WindowError:
+            raise ValueError('Input shapes do not overlap raster.')
+        pixel_geoms = RasterService.pixel_geometries(src, geometries, window)
+
+        col_start, row_start = int(window.col_off), int(window.row_off)
+        col_stop, row_stop = col_start + int(window.width), row_start + int(window.height)
+        block_height, block_width = src.block_shapes[0]
+
+        for block_row in range(row_start - row_start % block_height, row_stop, block_height):
+            row_off = max(block_row, row_start)
+            band_stop = min(block_row + block_height, row_stop)
+            band = RasterService.band_mask(pixel_geoms, window, row_off - row_start, band_stop - row_start)
+            for block_col in range(col_start - col_start % block_width, col_stop, block_width):
+                col_off = max(block_col, col_start)
+                block_window = Window(col_off, row_off, min(block_col + block_width, col_stop) - col_off, band_stop - row_off)
+                block_inside = band[:, col_off - col_start:col_off - col_start + int(block_window.width)]
+                yield block_window, (True if block_inside.all() else block_inside if block_inside.any() else False)
+
+    @staticmethod
+    def iter_masked_blocks(src, geometries: list, block_masks: Optional[list] = None) -> Iterator[np.ndarray]:
+        """
+        Valid pixel values of the geometries' crop, one internal raster block at a time.
+
+        Pixels are selected exactly as mask(crop=True, all_touched=True) followed by the nodata
+        filter: without nodata, pixels outside the geometries count as 0 just like mask() fills them.
+        Blocks the geometries do not touch are not read. block_masks are the geometries'
+        iter_block_masks, when already computed for a raster on the same grid.
+        """
+        if block_masks is None:
+            block_masks = RasterService.iter_block_masks(src, geometries)
+        for block_window, block_inside in block_masks:
+            if block_inside is not False:
+                yield RasterService.read_masked_values(src, block_window, block_inside)
+            elif src.nodata is None:
+                # mask() fills the untouched block with 0, which still counts
+                yield np.zeros(src.count * int(block_window.height) * int(block_window.width), dtype=src.dtypes[0])
+
+    @staticmethod
+    def read_masked_values(src, window: Window, inside: np.ndarray) -> np.ndarray:
+        """
+        Valid pixel values of one window of the geometries' crop, selected as in iter_masked_blocks.
+
+        inside is the window's slice of the geometries' crop_mask, or True when it covers the whole window.
+        """
+        data = src.read(window=window, masked=True)
+        filled = np.where(inside & ~np.ma.getmaskarray(data), data.data, src.nodata if src.nodata is not None else 0)
+        return filled[filled != src.nodata] if src.nodata is not None else filled.ravel()
+
+    def block_stream_stats(self, src, geometries: list, masks: Optional[dict] = None) -> dict:
+        """
+        Running min/max/sum/count over iter_masked_blocks, holding one block and one row of block masks at a time.
+
+        With masks, the block masks are kept for the next raster on the same grid (see shared_mask_min_max);
+        only blocks crossed by a geometry boundary hold an array.
+        """
+        block_masks = None
+        if masks is not None:
+            key = ('blocks', self.raster_grid(src), src.block_shapes[0])
+            if key not in masks:
+                masks[key] = list(self.iter_block_masks(src, geometries))
+            block_masks = masks[key]
+
+        stats = {'min': None, 'max': None, 'sum': 0.0, 'count': 0}
+        for values in self.iter_masked_blocks(src, geometries, block_masks):
+            if values.size == 0:
+                continue
+            block_min, block_max = float(values.min()), float(values.max())
+            # np.minimum/np.maximum propagate NaN like np.min/np.max over the whole crop would
+            stats['min'] = block_min if stats['min'] is None else float(np.minimum(stats['min'], block_min))
+            stats['max'] = block_max if stats['max'] is None else float(np.maximum(stats['max'], block_max))
+            stats['sum'] += float(values.sum(dtype=np.float64))
+            stats['count'] += values.size
+        return stats
+
+    def get_sidecar(self, sidecar_cls, tif_path: str) -> Optional[RasterSidecar]:
+        """ Sidecar index of tif_path, reloaded whenever the raster or the sidecar changes. """
+        meta_path = os.path.join(sidecar_cls.sidecar_dir(tif_path), sidecar_cls.meta_filename)
+        try:
+            signature = (os.stat(tif_path).st_mtime_ns, os.stat(meta_path).st_mtime_ns)
+        except OSError:
+            return None
+
+        key = (sidecar_cls.suffix, tif_path)
+        with self._sidecars_lock:
+            entry = self._sidecars.get(key)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+        sidecar = sidecar_cls.load(tif_path)
+        with self._sidecars_lock:
+            self._sidecars[key] = (signature, sidecar)
+        return sidecar
+
+    @staticmethod
+    def quadtree_cover(geometries: list, transform, crop: Window, cell_size: int, top_level: int) -> Tuple[List[tuple], List[Window]]:
+        """
+        Split the crop window of the geometries into quadtree cells, starting from cells of cell_size << top_level pixels.
+
+        Returns (level, rows, cols) index arrays of the cells lying fully inside the geometries and the crop,
+        whose pixels are all selected by mask(all_touched=True), and the windows of the level-0 cells crossed
+        by a geometry boundary, clipped to the crop, which still need their pixels masked.
+        """
+        union = shapely.union_all(geometries)
+        shapely.prepare(union)
+        row_start, col_start = int(crop.row_off), int(crop.col_off)
+        row_stop, col_stop = row_start + int(crop.height), col_start + int(crop.width)
+
+        span = cell_size << top_level
+        rows, cols = np.meshgrid(
+            np.arange(row_start // span, (row_stop - 1) // span + 1),
+            np.arange(col_start // span, (col_stop - 1) // span + 1),
+            indexing='ij'
+        )
+        rows, cols = rows.ravel(), cols.ravel()
+        covered_cells = []
+        for level in range(top_level, -1, -1):
+            span = cell_size << level
+            cell_rows = np.stack([rows * span, (rows + 1) * span])
+            cell_cols = np.stack([cols * span, (cols + 1) * span])
+            overlapping = (
+                (cell_rows[1] > row_start) & (cell_rows[0] < row_stop) &
+                (cell_cols[1] > col_start) & (cell_cols[0] < col_stop)
+            )
+            rows, cols = rows[overlapping], cols[overlapping]
+            cell_rows, cell_cols = cell_rows[:, overlapping], cell_cols[:, overlapping]
+
+            xs = transform.c + cell_cols * transform.a
+            ys = transform.f + cell_rows * transform.e
+            cells = shapely.box(xs.min(axis=0), ys.min(axis=0), xs.max(axis=0), ys.max(axis=0))
+            # all_touched selects every pixel of a cell inside the geometries; cells crossing the crop edge are split further
+            covered = shapely.contains(union, cells) & (
+                (cell_rows[0] >= row_start) & (cell_rows[1] <= row_stop) &
+                (cell_cols[0] >= col_start) & (cell_cols[1] <= col_stop)
+            )
+            covered_cells.append((level, rows[covered], cols[covered]))
+
+            partial = ~covered & shapely.intersects(union, cells)
+            rows, cols = rows[partial], cols[partial]
+            if level > 0:
+                rows = (rows[:, None] * 2 + np.array([0, 0, 1, 1])).ravel()
+                cols = (cols[:, None] * 2 + np.array([0, 1, 0, 1])).ravel()
+
+        boundary_windows = []
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            row_off, col_off = max(row * cell_size, row_start), max(col * cell_size, col_start)
+            boundary_windows.append(Window(
+                col_off, row_off,
+                min((col + 1) * cell_size, col_stop) - col_off,
+                min((row + 1) * cell_size, row_stop) - row_off
+            ))
+        return covered_cells, boundary_windows
+
+    @staticmethod
+    def sidecar_crop(src, geometries: list) -> Window:
+        try:
+            return geometry_window(src, geometries)
+        except WindowError:
+            raise ValueError('Input shapes do not overlap raster.')
+
+    def pyramid_min_max(self, pyramid: MinMaxPyramid, src, geometries: list, masks: Optional[dict] = None) -> Dict[str, Optional[float]]:
+        """
+        Same values as masked_min_max, reading full resolution pixels only along the geometry boundaries.
+
+        With masks, the quadtree cover and boundary cell masks are kept for the next raster on the same
+        grid with the same pyramid layout (see shared_mask_min_max).
+        """
+        key = ('pyramid', self.raster_grid(src), pyramid.meta['cell_size'], len(pyramid.levels))
+        if masks is not None and key in masks:
+            covered_cells, window_masks = masks[key]
+        else:
+            crop = self.sidecar_crop(src, geometries)
+            covered_cells, boundary_windows = self.quadtree_cover(
+                geometries, src.transform, crop, pyramid.meta['cell_size'], len(pyramid.levels) - 1
+            )
+            window_masks = self.iter_window_masks(src, geometries, crop, boundary_windows)
+            if masks is not None:
+                window_masks = list(window_masks)
+                masks[key] = (covered_cells, window_masks)
+
+        minimums, maximums = [], []
+        for level, rows, cols in covered_cells:
+            level_min, level_max = pyramid.levels[level]
+            minimums.append(np.asarray(level_min[rows, cols]))
+            maximums.append(np.asarray(level_max[rows, cols]))
+        boundary_count = 0
+        for window, inside in window_masks:
+            values = self.read_masked_values(src, window, inside)
+            boundary_count += 1
+            if values.size:
+                minimums.append(values.min(keepdims=True).astype(np.float64))
+                maximums.append(values.max(keepdims=True).astype(np.float64))
+        logger.info("Answered raster stats from the min/max pyramid, masking %s boundary cells.", boundary_count)
+
+        # np.min/np.max propagate NaN like masked_min_max; empty cells hold +inf/-inf
+        minimums, maximums = np.concatenate(minimums), np.concatenate(maximums)
+        min_val = float(np.min(minimums)) if minimums.size else np.inf
+        max_val = float(np.max(maximums)) if maximums.size else -np.inf
+        if min_val > max_val:
+            logger.warning("Clipped image has no valid data after masking.")
+            return {"min": None, "max": None}
+        return {"min": min_val, "max": max_val}
+
+    @staticmethod
+    def select_overview_level(src, geometries: list, max_pixels: int) -> int:
+        """
+        Finest resolution whose crop of the geometries fits max_pixels: 0 for full resolution,
+        n for the n-th overview. Falls back to the coarsest overview when none fits.
+        """
+        try:
+            window = geometry_window(src, geometries)
+        except WindowError:
+            return 0
+
+        factors = src.overviews(1)
+        for level, factor in enumerate([1] + factors):
+            pixels = math.ceil(window.width / factor) * math.ceil(window.height / factor) * src.count
+            if pixels <= max_pixels:
+                return level
+        return len(factors)
+
+    def clip_raster_stats(self, geojson: dict, tif_path: str, max_pixels: Optional[int] = None) -> Dict[str, Optional[float]]:
+        """
+        Min and max of the raster within the GeoJSON geometries.
+
+        With max_pixels the values are read from the finest overview that fits the pixel budget, and the
+        level used is returned as 'overview_level'. Polygons that fit at full resolution stay exact.
+        Rasters with a min/max pyramid sidecar are always answered exactly from it, at overview level 0.
+        """
+        logger.debug("Starting clip_raster_stats for TIFF path: %s", tif_path)
+        try:
+            with RequestTimings.stage('read'):
+                src = self.dataset_pool.get(tif_path)
+                geometries = [shape(feature['geometry']) for feature in geojson['features']]
+                pyramid = self.get_sidecar(MinMaxPyramid, tif_path) if self.use_minmax_pyramids else None
+
+            with RequestTimings.stage('zonal'):
+                return self.clip_stats(src, tif_path, geometries, pyramid, max_pixels)
+        except Exception as e:
+            logger.error(f"Error processing raster {tif_path}: {e}")
+            raise
+
+    def clip_rasters_stats(self, geojson: dict, tif_paths: List[str], max_pixels: Optional[int] = None) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        clip_raster_stats of several rasters for the same GeoJSON, keyed by tif path.
+
+        The geometries are parsed once and rasterized once per distinct raster grid, instead of once per raster,
+        whichever of the pyramid, block stream and mask paths answers it.
+        """
+        with RequestTimings.stage('read'):
+            geometries = [shape(feature['geometry']) for feature in geojson['features']]
+        masks = {}
+        raster_stats = {}
+        for tif_path in tif_paths:
+            try:
+                with RequestTimings.stage('read'):
+                    src = self.dataset_pool.get(tif_path)
+                    pyramid = self.get_sidecar(MinMaxPyramid, tif_path) if self.use_minmax_pyramids else None
+
+                with RequestTimings.stage('zonal'):
+                    raster_stats[tif_path] = self.clip_stats(src, tif_path, geometries, pyramid, max_pixels, masks)
+            except Exception as e:
+                logger.error(f"Error processing raster {tif_path}: {e}")
+                raise
+        logger.debug("Computed raster stats of %s rasters using %s pixel masks.", len(tif_paths), len(masks))
+        return raster_stats
+
+    def clip_stats(self, src, tif_path: str, geometries: list, pyramid: Optional[MinMaxPyramid], max_pixels: Optional[int], masks: Optional[dict] = None) -> Dict[str, Optional[float]]:
+        if pyramid is not None and pyramid.matches(src):
+            stats = self.pyramid_min_max(pyramid, src, geometries, masks)
+            if max_pixels is not None:
+                stats['overview_level'] = 0
+            return stats
+
+        overview_level = 0
+        if max_pixels is not None:
+            overview_level = self.select_overview_level(src, geometries, max_pixels)
+            if overview_level > 0:
+                logger.info("Reading overview level %s to stay within %s pixels.", overview_level, max_pixels)
+                src = self.dataset_pool.get(tif_path, overview_level - 1)
+
+        if self.use_block_stream(src, geometries):
+            block_stats = self.block_stream_stats(src, geometries, masks)
+            stats = {"min": block_stats['min'], "max": block_stats['max']}
+            logger.info("Block-streamed raster stats - min: %s, max: %s", stats['min'], stats['max'])
+        elif masks is not None:
+            stats = self.shared_mask_min_max(src, geometries, masks)
+        else:
+            stats = self.masked_min_max(src, geometries)
+        if max_pixels is not None:
+            stats['overview_level'] = overview_level
+        return stats
+
+    @staticmethod
+    def raster_grid(src) -> tuple:
+        """ (crs, transform, width, height) of src: rasters with equal grids select the same pixels for a geometry. """
+        return (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.width, src.height)
+
+    def shared_mask_min_max(self, src, geometries: list, masks: dict) -> Dict[str, Optional[float]]:
+        """
+        Same values as masked_min_max, reusing the crop window and pixel mask of rasters on the same grid.
+
+        masks maps ('crop', raster_grid) to the (crop, inside) pair computed for the first of them;
+        pyramid_min_max and block_stream_stats keep their own masks in it under their own keys.
+        """
+        key = ('crop', self.raster_grid(src))
+        if key not in masks:
+            crop = self.sidecar_crop(src, geometries)
+            masks[key] = (crop, self.crop_mask(src, geometries, crop))
+        crop, inside = masks[key]
+        values = self.read_masked_values(src, crop, inside)
+
+        if values.size == 0:
+            logger.warning("Clipped image has no valid data after masking.")
+            return {"min": None, "max": None}
+        return {"min": float(np.min(values)), "max": float(np.max(values))}
+
+    @staticmethod
+    def masked_min_max(src, geometries: list) -> Dict[str, Optional[float]]:
+        logger.debug("Masking raster with provided GeoJSON geometries.")
+        clipped_image, _ = mask(src, geometries, crop=True, all_touched=True)
+
+        if clipped_image.size == 0:
+            logger.warning("Clipped image has no data.")
+            return {"min": None, "max": None}
+
+        # Remove nodata values
+        if src.nodata is not None:
+            logger.debug("Removing nodata values from clipped raster data.")
+            clipped_image = clipped_image[clipped_image != src.nodata]
+
+        if clipped_image.size == 0:
+            logger.warning("Clipped image has no valid data after masking.")
+            return {"min": None, "max": None}
+
+        min_val = float(np.min(clipped_image))
+        max_val = float(np.max(clipped_image))
+
+        logger.info("Raster stats - min: %s, max: %s", min_val, max_val)
+
+        return {"min": min_val, "max": max_val}
+
+class BuildingStatsEngine:
+    """
+    Zonal and neighborhood stats of building footprints.
+
+    Each footprint is split into north/south/east/west zones, and the ring around it into the same
+    four neighborhood directions; every zone gets the mean of each raster in zone_rasters.
+    """
+    zone_percentage = 0.4  # Adjust this value to change the size of the zones
+    buffer_distance = 0.0001  # Adjust this value as needed
+    direction_percentage = 0.4
+    zone_rasters = {
+        'zonal': ['slope', 'aspect', 'solar'],
+        'neighborhood': ['slope', 'aspect']
+    }
+
+    def __init__(self, raster_service: RasterService):
+        self.raster_service = raster_service
+
+    @staticmethod
+    def split_into_directions(geom, percentage: float) -> dict:
+        """ Split a geometry, or a numpy array of geometries, into north/south/east/west bands of its bounds. """
+        minx, miny, maxx, maxy = np.moveaxis(shapely.bounds(geom), -1, 0)
+        width = maxx - minx
+        height = maxy - miny
+
+        def rectangle(*corners):
+            return shapely.polygons(np.stack([np.stack(corner, axis=-1) for corner in corners], axis=-2))
+
+        return {
+            'north': shapely.intersection(geom, rectangle(
+                (minx, maxy - height * percentage),
+                (maxx, maxy - height * percentage),
+                (maxx, maxy),
+                (minx, maxy)
+            )),
+            'south': shapely.intersection(geom, rectangle(
+                (minx, miny),
+                (maxx, miny),
+                (maxx, miny + height * percentage),
+                (minx, miny + height * percentage)
+            )),
+            'east': shapely.intersection(geom, rectangle(
+                (maxx - width * percentage, miny),
+                (maxx, miny),
+                (maxx, maxy),
+                (maxx - width * percentage, maxy)
+            )),
+            'west': shapely.intersection(geom, rectangle(
+                (minx, miny),
+                (minx + width * percentage, miny),
+                (minx + width * percentage, maxy),
+                (minx, maxy)
+            ))
+        }
+
+    def get_zonal_geometries(self, building_geom: Polygon) -> dict:
+        zones = self.split_into_directions(building_geom, self.zone_percentage)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # WKT of every zone is only worth building when someone reads it
+            for direction, zone in zones.items():
+                logger.debug("Zone %s: %s", direction, zone.wkt)
+        return zones
+
+    def get_neighborhood_geometries(self, building_geom: Polygon) -> dict:
+        buffered_polygon = building_geom.buffer(self.buffer_distance).simplify(0.5)
+        buffer_ring = buffered_polygon.difference(building_geom)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Buffer polygon: %s", buffer_ring.wkt)
+
+        directions = self.split_into_directions(buffer_ring, self.direction_percentage)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for direction, zone in directions.items():
+                logger.debug("Buffer %s: %s", direction, zone.wkt)
+        return directions
+
+    def collect_zone_stats(self, zone_groups: Dict[str, dict], group_rasters: Dict[str, List[str]]) -> Dict[str, dict]:
+        """
+        Stats for several groups of zones, reading one window per raster for all of them.
+
+        zone_groups maps a group name to its {zone_name: geometry} dict and group_rasters
+        lists the raster keys wanted for that group. Empty zones get None for every raster.
+        """
+        raster_keys = list(dict.fromkeys(key for keys in group_rasters.values() for key in keys))
+        raster_means = {}
+        for raster_key in raster_keys:
+            zones = {
+                (group, zone_name): zone_geom
+                for group, zones_in_group in zone_groups.items()
+                if raster_key in group_rasters[group]
+                for zone_name, zone_geom in zones_in_group.items()
+                if not zone_geom.is_empty
+            }
+            logger.debug("Calculating raster stats for %s zones of raster: %s", len(zones), raster_key)
+            raster_means[raster_key] = self.raster_service.get_zones_stats(raster_key, zones)
+
+        group_stats = {}
+        for group, zones_in_group in zone_groups.items():
+            group_stats[group] = {}
+            for zone_name, zone_geom in zones_in_group.items():
+                if zone_geom.is_empty:
+                    logger.debug("No geometry found for %s zone: %s. Setting stats to None.", group, zone_name)
+                group_stats[group][zone_name] = {
+                    raster_key: None if zone_geom.is_empty else raster_means[raster_key][(group, zone_name)]
+                    for raster_key in group_rasters[group]
+                }
+        return group_stats
+
+    def calculate_zonal_variation(self, building_geom: Polygon) -> dict:
+        logger.debug("Calculating zonal variation for building geometry.")
+        zones = self.get_zonal_geometries(building_geom)
+        zonal_stats = self.collect_zone_stats({'zonal': zones}, {'zonal': self.zone_rasters['zonal']})['zonal']
+        logger.debug("Completed calculating zonal variation.")
+        return zonal_stats
+
+    def calculate_neighborhood_analysis(self, building_geom: Polygon) -> dict:
+        logger.debug("Starting neighborhood analysis for building geometry.")
+        directions = self.get_neighborhood_geometries(building_geom)
+        neighborhood_stats = self.collect_zone_stats({'neighborhood': directions}, {'neighborhood': self.zone_rasters['neighborhood']})['neighborhood']
+        logger.debug("Completed neighborhood analysis.")
+        return neighborhood_stats
+
+    def calculate_building_stats(self, building_geom: Polygon) -> tuple:
+        logger.debug("Calculating zonal and neighborhood stats for building geometry.")
+        group_stats = self.collect_zone_stats(
+            {
+                'zonal': self.get_zonal_geometries(building_geom),
+                'neighborhood': self.get_neighborhood_geometries(building_geom)
+            },
+            self.zone_rasters
+        )
+        return group_stats['zonal'], group_stats['neighborhood']
+
+    def get_partition_geometries(self, building_geoms: np.ndarray) -> Dict[str, dict]:
+        """ Vectorized get_zonal_geometries/get_neighborhood_geometries over an array of buildings. """
+        buffered_polygons = shapely.simplify(shapely.buffer(building_geoms, self.buffer_distance, quad_segs=16), 0.5)
+        buffer_rings = shapely.difference(buffered_polygons, building_geoms)
+        return {
+            'zonal': self.split_into_directions(building_geoms, self.zone_percentage),
+            'neighborhood': self.split_into_directions(buffer_rings, self.direction_percentage)
+        }
+
+    def calculate_partition_stats(self, building_geoms: np.ndarray) -> List[tuple]:
+        """
+        Zonal and neighborhood stats for every building of a partition at once.
+
+        All zones of all buildings are reduced together by RasterService.get_partition_zones_stats,
+        so each raster is read once per partition instead of once per zone.
+        """
+        logger.debug("Calculating partition stats for %s buildings.", len(building_geoms))
+        zone_groups = self.get_partition_geometries(building_geoms)
+
+        group_stats = {
+            group: [{zone_name: {} for zone_name in zones} for _ in range(len(building_geoms))]
+            for group, zones in zone_groups.items()
+        }
+        raster_keys = list(dict.fromkeys(key for keys in self.zone_rasters.values() for key in keys))
+        for raster_key in raster_keys:
+            zone_keys, zone_geoms = [], []
+            for group, zones in zone_groups.items():
+                if raster_key not in self.zone_rasters[group]:
+                    continue
+                for zone_name, geoms in zones.items():
+                    for building_idx in np.flatnonzero(~shapely.is_empty(geoms)):
+                        zone_keys.append((group, zone_name, building_idx))
+                        zone_geoms.append(geoms[building_idx])
+
+            zone_means = self.raster_service.get_partition_zones_stats(raster_key, np.array(zone_geoms, dtype=object))
+            for (group, zone_name, building_idx), zone_mean in zip(zone_keys, zone_means):
+                group_stats[group][building_idx][zone_name][raster_key] = float(zone_mean)
+
+        for group, buildings in group_stats.items():
+            for building in buildings:
+                for zone_stats in building.values():
+                    for raster_key in self.zone_rasters[group]:
+                        zone_stats.setdefault(raster_key, None)
+
+        return list(zip(group_stats['zonal'], group_stats['neighborhood']))
+
+class BuildingStatsStore:
+    """
+    Columnar layout of the precomputed building_stats.parquet written next to each buildings.parquet.
+
+    One row per building: a 'gmlid' column plus one float column per {group}_{direction}_{raster},
+    e.g. 'zonal_north_slope'. Empty zones are stored as null and zones without valid pixels as NaN,
+    so the stats read back exactly as BuildingStatsEngine computed them.
+    """
+    filename = 'building_stats.parquet'
+    directions = ['north', 'south', 'east', 'west']
+
+    @classmethod
+    def columns(cls, zone_rasters: Dict[str, List[str]]) -> List[tuple]:
+        return [
+            (f"{group}_{direction}_{raster_key}", group, direction, raster_key)
+            for group, raster_keys in zone_rasters.items()
+            for direction in cls.directions
+            for raster_key in raster_keys
+        ]
+
+    @classmethod
+    def to_table(cls, building_ids: List[str], building_stats: List[tuple], zone_rasters: Dict[str, List[str]]) -> pa.Table:
+        """ Table for building_ids and their (zonal_variation, neighborhood_understanding) tuples. """
+        group_index = {group: index for index, group in enumerate(zone_rasters)}
+        data = {'gmlid': pa.array(building_ids, type=pa.string())}
+        for column, group, direction, raster_key in cls.columns(zone_rasters):
+            values = [stats[group_index[group]][direction][raster_key] for stats in building_stats]
+            data[column] = pa.array(values, type=pa.float64(), from_pandas=False)
+        return pa.table(data)
+
+    @classmethod
+    def from_table(cls, table: pa.Table, zone_rasters: Dict[str, List[str]]) -> Dict[str, tuple]:
+        """ Inverse of to_table: maps each gmlid to its (zonal_variation, neighborhood_understanding). """
+        column_values = {column: table.column(column).to_pylist() for column, _, _, _ in cls.columns(zone_rasters)}
+        building_stats = {}
+        for row, building_id in enumerate(table.column('gmlid').to_pylist()):
+            groups = {group: {direction: {} for direction in cls.directions} for group in zone_rasters}
+            for column, group, direction, raster_key in cls.columns(zone_rasters):
+                groups[group][direction][raster_key] = column_values[column][row]
+            building_stats[building_id] = tuple(groups[group] for group in zone_rasters)
+        return building_stats
+
+    @classmethod
+    def loader(cls, zone_rasters: Dict[str, List[str]]):
+        """ BuildingPartitionCache loader for a building_stats.parquet file. """
+        def load(stats_path: str) -> tuple:
+            logger.debug("Reading precomputed building stats from %s", stats_path)
+            table = pq.read_table(stats_path)
+            # Roughly 3 KB of nested dicts and floats per building once decoded
+            return cls.from_table(table, zone_rasters), table.nbytes + table.num_rows * 3000
+        return load
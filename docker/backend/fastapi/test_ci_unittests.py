@@ -1,10 +1,31 @@
 # test_ci_unittests.py
 
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, mock_open
+import os
+import sys
+import subprocess
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import geopandas as gpd
+import pygeohash as pgh
+import pyarrow as pa
+import pyarrow.parquet as pq
+import rasterio
+import rasterio.mask
+import rasterio.features
+from rasterio.transform import from_origin
+from rasterio.windows import Window
 from fastapi.testclient import TestClient
-from main import GeoApp
+from shapely.geometry import box, shape, Point, Polygon, MultiPolygon
+from main import GeoApp, BuildingService, BuildingPartitionCache, BuildingIndex, BuildingWorkerPool, GeohashService, InterpretationService, ReportService, ResultCache, ReportColumns, JsonLogFormatter, available_cpus
+from building_reports import process_building_task, task_started
+from terrain_stats import RasterDatasetPool, RasterService, MinMaxPyramid, SummedAreaTable, BuildingStatsEngine, BuildingStatsStore
+from instrumentation import LatencyMetrics
 import logging
 
 # Configure logging
@@ -50,6 +71,68 @@ class TestCIUnitGeoTerrainAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json(), {"detail": "Raster file not found."})
 
+    @patch('main.RasterService.clip_raster_stats')
+    @patch('main.os.path.exists')
+    def test_clip_and_stats_approximate(self, mock_exists, mock_clip_raster_stats):
+        logger.info("Testing /rasterstats endpoint in exact and approximate mode.")
+        mock_exists.return_value = True
+        request = {
+            "geojson": {
+                "type": "FeatureCollection",
+                "features": [{
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]
+                    }
+                }]
+            },
+            "tif_url": "cog_merged_slope.tif"
+        }
+
+        mock_clip_raster_stats.return_value = {"min": 1.0, "max": 4.0}
+        response = self.client.post("/rasterstats", json=request)
+        self.assertEqual(response.json(), {"min": 1.0, "max": 4.0})
+        self.assertIsNone(mock_clip_raster_stats.call_args[0][2])
+
+        mock_clip_raster_stats.return_value = {"min": 1.5, "max": 3.5, "overview_level": 2}
+        response = self.client.post("/rasterstats", json=dict(request, approximate=True))
+        self.assertEqual(response.json(), {"min": 1.5, "max": 3.5, "overview_level": 2})
+        self.assertEqual(mock_clip_raster_stats.call_args[0][2], 1_000_000)
+
+    @patch('main.RasterService.clip_rasters_stats')
+    @patch('main.os.path.exists')
+    def test_clip_and_stats_batch(self, mock_exists, mock_clip_rasters_stats):
+        logger.info("Testing /rasterstats/batch endpoint with several geometries and rasters.")
+        mock_exists.return_value = True
+        geojsons = [{
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[0, 0], [0, size], [size, size], [size, 0], [0, 0]]]
+                }
+            }]
+        } for size in (1, 2)]
+        mock_clip_rasters_stats.side_effect = lambda geojson, tif_paths, max_pixels: {
+            tif_path: {"min": 0.0, "max": geojson["features"][0]["geometry"]["coordinates"][0][2][0] * 10.0 + index}
+            for index, tif_path in enumerate(tif_paths)
+        }
+
+        response = self.client.post("/rasterstats/batch", json={
+            "geojsons": geojsons,
+            "tif_urls": ["cog_merged_slope.tif", "cog_merged_aspect.tif", "cog_merged_slope.tif"]
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"results": [
+            {"cog_merged_slope.tif": {"min": 0.0, "max": 10.0}, "cog_merged_aspect.tif": {"min": 0.0, "max": 11.0}},
+            {"cog_merged_slope.tif": {"min": 0.0, "max": 20.0}, "cog_merged_aspect.tif": {"min": 0.0, "max": 21.0}}
+        ]})
+        self.assertEqual(mock_clip_rasters_stats.call_count, 2)
+        self.assertEqual(len(mock_clip_rasters_stats.call_args[0][1]), 2)
+
     @patch('main.BuildingService.generate_building_reports')
     def test_bbox_insights_success(self, mock_generate_reports):
         logger.info("Testing /stats endpoint with successful building report generation.")
@@ -115,6 +198,69 @@ class TestCIUnitGeoTerrainAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"building_reports": []})
 
+    @patch('main.BuildingService.iter_geohash_reports')
+    @patch('main.GeohashService.geohash_grid_covering_polygon')
+    def test_bbox_insights_ndjson_stream(self, mock_covering, mock_iter_reports):
+        logger.info("Testing /stats endpoint streaming NDJSON reports and progress events.")
+        mock_covering.return_value = ['u0wt8k', 'u0wt8m']
+        mock_iter_reports.return_value = iter([
+            (1, 'u0wt8m', [{"building_id": "b1", "zonal_variation": {"north": {"slope": float('nan')}}}]),
+            (0, 'u0wt8k', [])
+        ])
+
+        response = self.client.post(
+            "/stats?stream=ndjson",
+            json={
+                "geojson": {
+                    "type": "FeatureCollection",
+                    "features": [{
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]
+                        }
+                    }]
+                }
+            }
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        events = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([event["event"] for event in events], ["progress", "building_report", "progress", "progress", "complete"])
+        self.assertEqual(events[1]["data"], {"building_id": "b1", "zonal_variation": {"north": {"slope": None}}})
+        self.assertEqual(events[3]["geohashes_done"], 2)
+        self.assertEqual(events[3]["geohashes_total"], 2)
+        self.assertEqual(events[-1]["building_count"], 1)
+
+    @patch('main.BuildingService.iter_geohash_reports')
+    @patch('main.GeohashService.geohash_grid_covering_polygon')
+    def test_bbox_insights_sse_stream(self, mock_covering, mock_iter_reports):
+        logger.info("Testing /stats endpoint streaming Server-Sent Events.")
+        mock_covering.return_value = ['u0wt8k']
+        mock_iter_reports.return_value = iter([(0, 'u0wt8k', [{"building_id": "b1"}])])
+
+        response = self.client.post(
+            "/stats?stream=sse",
+            json={
+                "geojson": {
+                    "type": "FeatureCollection",
+                    "features": [{
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]
+                        }
+                    }]
+                }
+            }
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        self.assertIn('event: building_report\ndata: {"event": "building_report", "data": {"building_id": "b1"}}\n\n', response.text)
+        self.assertTrue(response.text.endswith('event: complete\ndata: {"event": "complete", "building_count": 1}\n\n'))
+
     def test_clip_and_stats_with_malformed_geojson(self):
         logger.info("Testing /rasterstats endpoint with malformed GeoJSON.")
 
@@ -185,5 +331,1076 @@ class TestCIUnitGeoTerrainAPI(unittest.TestCase):
         self.assertEqual(response.json()["building_reports"][0]["building_id"], "test_id_0")
         self.assertEqual(response.json()["building_reports"][-1]["building_id"], "test_id_99")
 
+class TestCIUnitRasterDatasetPool(unittest.TestCase):
+    def setUp(self):
+        handle, self.raster_path = tempfile.mkstemp(suffix=".tif")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.raster_path)
+
+    @patch('terrain_stats.mask')
+    @patch('terrain_stats.rasterio.open')
+    def test_dataset_reused_across_zones(self, mock_rasterio_open, mock_mask):
+        logger.info("Testing that repeated zone stats reuse a single pooled dataset.")
+        mock_src = MagicMock()
+        mock_src.nodata = None
+        mock_src.closed = False
+        mock_rasterio_open.return_value = mock_src
+        mock_mask.return_value = (np.array([[1.0, 2.0], [3.0, 4.0]]), None)
+
+        raster_service = RasterService({'slope': self.raster_path}, RasterDatasetPool())
+        for _ in range(4):
+            self.assertEqual(raster_service.get_raster_stats('slope', box(0, 0, 1, 1)), 2.5)
+
+        self.assertEqual(mock_rasterio_open.call_count, 1)
+
+    @patch('terrain_stats.rasterio.open')
+    def test_dataset_reopened_when_file_changes(self, mock_rasterio_open):
+        logger.info("Testing that a pooled dataset is reopened after the file changes on disk.")
+        first_src, second_src = MagicMock(closed=False), MagicMock(closed=False)
+        mock_rasterio_open.side_effect = [first_src, second_src]
+
+        pool = RasterDatasetPool()
+        self.assertIs(pool.get(self.raster_path), first_src)
+        self.assertIs(pool.get(self.raster_path), first_src)
+
+        stat = os.stat(self.raster_path)
+        os.utime(self.raster_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        self.assertIs(pool.get(self.raster_path), second_src)
+        first_src.close.assert_called_once()
+
+        pool.close()
+        second_src.close.assert_called_once()
+
+class TestCIUnitZonalStatistics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(42)
+        self.raster_paths = {}
+        for raster_key in ('slope', 'aspect', 'solar'):
+            data = (rng.random((200, 200)) * 300).astype('float32')
+            data[rng.random((200, 200)) < 0.05] = -9999
+            path = os.path.join(self.tmp_dir.name, f"{raster_key}.tif")
+            with rasterio.open(
+                path, 'w', driver='GTiff', height=200, width=200, count=1, dtype='float32',
+                crs='EPSG:4326', transform=from_origin(9.17, 48.775, 0.00001, 0.00001), nodata=-9999
+            ) as dst:
+                dst.write(data, 1)
+            self.raster_paths[raster_key] = path
+
+        self.raster_service = RasterService(self.raster_paths, RasterDatasetPool())
+        self.building_service = BuildingService(self.raster_service, None, None, self.tmp_dir.name)
+        self.building_geom = Polygon([
+            (9.1705, 48.7740), (9.1712, 48.7742), (9.1713, 48.7736), (9.1707, 48.7734), (9.1705, 48.7740)
+        ])
+
+    def tearDown(self):
+        self.raster_service.close()
+        self.tmp_dir.cleanup()
+
+    def write_partition(self, geohash: str, footprints, **to_parquet_kwargs) -> gpd.GeoDataFrame:
+        """ Write the buildings.parquet of geohash with the numbered footprints of a row of small on-grid buildings. """
+        footprints = list(footprints)
+        os.makedirs(os.path.join(self.tmp_dir.name, geohash), exist_ok=True)
+        buildings = gpd.GeoDataFrame(
+            {'gmlid': [f"building_{i}" for i in footprints]},
+            geometry=[box(9.1702 + i * 0.0001, 48.7735, 9.17028 + i * 0.0001, 48.77358) for i in footprints],
+            crs='EPSG:4326'
+        )
+        buildings.to_parquet(os.path.join(self.tmp_dir.name, geohash, 'buildings.parquet'), **to_parquet_kwargs)
+        return buildings
+
+    def test_building_stats_match_per_zone_masking(self):
+        logger.info("Testing that single-window zonal stats match per-zone masked stats.")
+        zonal_variation, neighborhood_understanding = self.building_service.calculate_building_stats(self.building_geom)
+
+        zones = self.building_service.get_zonal_geometries(self.building_geom)
+        for zone_name, zone_geom in zones.items():
+            for raster_key in ('slope', 'aspect', 'solar'):
+                self.assertEqual(
+                    zonal_variation[zone_name][raster_key],
+                    self.raster_service.get_raster_stats(raster_key, zone_geom)
+                )
+
+        directions = self.building_service.get_neighborhood_geometries(self.building_geom)
+        for direction, direction_geom in directions.items():
+            for raster_key in ('slope', 'aspect'):
+                self.assertEqual(
+                    neighborhood_understanding[direction][raster_key],
+                    self.raster_service.get_raster_stats(raster_key, direction_geom)
+                )
+            self.assertNotIn('solar', neighborhood_understanding[direction])
+
+    def test_partition_stats_match_building_stats(self):
+        logger.info("Testing that partition-wide bincount stats agree with per-building stats.")
+        building_geoms = np.array([
+            self.building_geom,
+            box(9.1720, 48.7730, 9.17225, 48.77315),
+            box(9.17225, 48.7730, 9.17251, 48.77317),  # shares a wall with the previous building
+            box(0, 0, 0.0001, 0.0001)  # outside the raster
+        ], dtype=object)
+
+        partition_stats = self.building_service.calculate_partition_stats(building_geoms)
+
+        self.assertEqual(len(partition_stats), len(building_geoms))
+        for building_geom, (zonal_variation, neighborhood_understanding) in zip(building_geoms, partition_stats):
+            expected_zonal, expected_neighborhood = self.building_service.calculate_building_stats(building_geom)
+            for actual, expected in ((zonal_variation, expected_zonal), (neighborhood_understanding, expected_neighborhood)):
+                self.assertEqual(actual.keys(), expected.keys())
+                for zone_name in expected:
+                    self.assertEqual(actual[zone_name].keys(), expected[zone_name].keys())
+                    for raster_key, expected_value in expected[zone_name].items():
+                        if np.isnan(expected_value):
+                            self.assertTrue(np.isnan(actual[zone_name][raster_key]))
+                        else:
+                            self.assertAlmostEqual(actual[zone_name][raster_key], expected_value, delta=abs(expected_value) * 0.01)
+
+    def test_process_geohash_batch_mode_keeps_every_building(self):
+        logger.info("Testing that batch mode processes every intersecting building instead of sampling 10.")
+        buildings = self.write_partition('u0wt8k', range(12))
+        self.building_service.report_service = MagicMock()
+
+        reports = self.building_service.process_geohash('u0wt8k', box(9.17, 48.773, 9.172, 48.775), {})
+
+        self.assertEqual(sorted(report['building_id'] for report in reports), sorted(buildings['gmlid']))
+
+    def test_several_features_share_partitions_and_key_reports(self):
+        logger.info("Testing that several input features are answered in one pass, with reports keyed by feature.")
+        geohash = GeohashService.encode_point(9.1702, 48.7735, 6)  # the cell the features are covered by
+        self.write_partition(geohash, range(4))
+        self.building_service.geohash_service = GeohashService()
+        self.building_service.report_service = MagicMock()
+        geojson = {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {}, "geometry": box(9.1701, 48.7734, 9.17045, 48.7737).__geo_interface__},
+            {"type": "Feature", "properties": {}, "geometry": box(9.17042, 48.7734, 9.1707, 48.7737).__geo_interface__}
+        ]}
+
+        with patch.object(self.building_service, 'process_geohash', wraps=self.building_service.process_geohash) as mock_process_geohash:
+            reports = self.building_service.generate_building_reports(geojson, {})
+
+        self.assertEqual(
+            [(report['building_id'], report['feature_indices']) for report in reports],
+            [('building_0', [0]), ('building_1', [0]), ('building_2', [0, 1]), ('building_3', [1])]
+        )
+        self.assertEqual([call[0][0] for call in mock_process_geohash.call_args_list].count(geohash), 1)
+
+    def test_building_at_point(self):
+        logger.info("Testing that a point resolves to the building of its geohash partition and its report.")
+        geohash = pgh.encode(48.77354, 9.17034, precision=6)
+        self.write_partition(geohash, range(4))
+        self.building_service.geohash_service = GeohashService()
+        self.building_service.report_service = ReportService(InterpretationService())
+        self.assertEqual(GeohashService.encode_point(9.17034, 48.77354, 6), geohash)
+
+        building = self.building_service.building_at(9.17034, 48.77354, {'solar': [0, 300]})
+
+        self.assertEqual(building['geohash'], geohash)
+        self.assertEqual(building['report']['building_id'], 'building_1')
+        self.assertEqual(shape(building['geometry']), box(9.1703, 48.7735, 9.17038, 48.77358))
+        self.assertEqual(
+            repr(building['report']['zonal_variation']),
+            repr(self.building_service.calculate_building_stats(box(9.1703, 48.7735, 9.17038, 48.77358))[0])
+        )
+        self.assertIsNone(self.building_service.building_at(9.17029, 48.77354, {'solar': [0, 300]}))
+
+    def test_building_index_matches_partition_reads(self):
+        logger.info("Testing that the global building index answers like the partition files, without duplicates.")
+        for geohash, rows in (('u0wt8k', [0, 1, 2]), ('u0wt8m', [2, 3])):  # building_2 crosses both partitions
+            self.write_partition(geohash, rows)
+        self.building_service.geohash_service = MagicMock()
+        self.building_service.report_service = MagicMock()
+
+        index = BuildingIndex.load(self.tmp_dir.name)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.partitions, {'u0wt8k': (0, 3), 'u0wt8m': (3, 4)})
+
+        self.building_service.building_index = index
+        reports = self.building_service.generate_building_reports({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {}, "geometry": box(9.1701, 48.7734, 9.1707, 48.7737).__geo_interface__}
+        ]}, {})
+        self.assertEqual([report['building_id'] for report in reports], [f"building_{i}" for i in range(4)])
+        self.building_service.geohash_service.geohash_grid_covering_polygon.assert_not_called()
+
+        self.assertEqual(self.building_service.building_at(9.17044, 48.77354, {})['report']['building_id'], 'building_2')
+        self.assertIsNone(self.building_service.building_at(9.17029, 48.77354, {}))
+
+    def test_small_queries_read_only_matching_row_groups(self):
+        logger.info("Testing that small queries decode only the row groups of a bbox-covered partition.")
+        self.write_partition('u0wt8k', range(12), write_covering_bbox=True, row_group_size=2)
+        building_path = os.path.join(self.tmp_dir.name, 'u0wt8k', 'buildings.parquet')
+        self.assertTrue(BuildingService.has_bbox_covering(building_path))
+        self.building_service.report_service = MagicMock()
+        input_geom = box(9.1703, 48.7734, 9.17045, 48.7737)
+
+        partition_df = self.building_service.read_partition('u0wt8k', building_path, input_geom)
+        self.assertLess(len(partition_df), 12)
+        self.assertEqual(self.building_service.partition_cache.stats()['entries'], 0)
+
+        pruned_reports = self.building_service.process_geohash('u0wt8k', input_geom, {})
+        self.building_service.bbox_pruning = False
+        full_reports = self.building_service.process_geohash('u0wt8k', input_geom, {})
+        self.assertEqual([report['building_id'] for report in pruned_reports], ['building_1', 'building_2'])
+        self.assertEqual(repr(pruned_reports), repr(full_reports))
+        self.assertEqual(self.building_service.partition_cache.stats()['entries'], 1)
+
+    def test_shared_worker_pool_matches_inline_processing(self):
+        logger.info("Testing that the shared worker pool returns the same reports as inline processing.")
+        self.write_partition('u0wt8k', range(4))
+        self.building_service.batch_mode = False
+        self.building_service.report_service = ReportService(InterpretationService())
+        input_geom = box(9.17, 48.773, 9.172, 48.775)
+
+        inline_reports = self.building_service.process_geohash('u0wt8k', input_geom, {'solar': [0, 300]})
+
+        worker_pool = BuildingWorkerPool(self.raster_paths, processes=2)
+        worker_pool.start()
+        try:
+            self.building_service.worker_pool = worker_pool
+            pooled_reports = self.building_service.process_geohash('u0wt8k', input_geom, {'solar': [0, 300]})
+        finally:
+            worker_pool.close()
+
+        self.assertEqual(len(pooled_reports), 4)
+        self.assertEqual(repr(pooled_reports), repr(inline_reports))
+
+    def test_building_stats_store_round_trip(self):
+        logger.info("Testing that precomputed building stats read back exactly, keeping None and NaN apart.")
+        building_stats = [
+            self.building_service.calculate_building_stats(self.building_geom),
+            self.building_service.calculate_building_stats(box(0, 0, 0.0001, 0.0001))  # outside the raster
+        ]
+        building_stats[1][0]['north']['slope'] = None
+
+        table = BuildingStatsStore.to_table(['inside', 'outside'], building_stats, BuildingService.zone_rasters)
+        path = os.path.join(self.tmp_dir.name, 'building_stats.parquet')
+        pq.write_table(table, path)
+        restored = BuildingStatsStore.from_table(pq.read_table(path), BuildingService.zone_rasters)
+
+        self.assertEqual(repr(restored['inside']), repr(building_stats[0]))
+        self.assertEqual(repr(restored['outside']), repr(building_stats[1]))
+
+    def test_process_geohash_uses_precomputed_stats(self):
+        logger.info("Testing that precomputed stats are used and only missing buildings are computed live.")
+        buildings = self.write_partition('u0wt8k', range(3))
+        precomputed = [self.building_service.calculate_building_stats(geom) for geom in buildings.geometry[:2]]
+        precomputed[0][0]['north']['slope'] = 12345.0
+        pq.write_table(
+            BuildingStatsStore.to_table(['building_0', 'building_1'], precomputed, BuildingService.zone_rasters),
+            os.path.join(self.tmp_dir.name, 'u0wt8k', 'building_stats.parquet')
+        )
+        self.building_service.report_service = MagicMock()
+
+        with patch.object(self.building_service, 'calculate_partition_stats', wraps=self.building_service.calculate_partition_stats) as mock_partition_stats:
+            reports = self.building_service.process_geohash('u0wt8k', box(9.17, 48.773, 9.172, 48.775), {})
+
+        self.assertEqual([report['building_id'] for report in reports], ['building_0', 'building_1', 'building_2'])
+        self.assertEqual(reports[0]['zonal_variation']['north']['slope'], 12345.0)
+        self.assertEqual(len(mock_partition_stats.call_args[0][0]), 1)
+
+        # Stats older than the buildings are ignored
+        building_path = os.path.join(self.tmp_dir.name, 'u0wt8k', 'buildings.parquet')
+        stat = os.stat(building_path)
+        os.utime(building_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+        reports = self.building_service.process_geohash('u0wt8k', box(9.17, 48.773, 9.172, 48.775), {})
+        self.assertNotEqual(reports[0]['zonal_variation']['north']['slope'], 12345.0)
+
+    def test_precomputed_stats_match_live_batch_stats(self):
+        logger.info("Testing that stats precomputed with the standalone engine match the live batch-mode stats.")
+        buildings = self.write_partition('u0wt8k', range(4))  # on the pixel grid
+        stats_engine = BuildingStatsEngine(RasterService(self.raster_paths, RasterDatasetPool()))
+        pq.write_table(
+            BuildingStatsStore.to_table(buildings['gmlid'].tolist(), stats_engine.calculate_partition_stats(buildings.geometry.to_numpy()), stats_engine.zone_rasters),
+            os.path.join(self.tmp_dir.name, 'u0wt8k', 'building_stats.parquet')
+        )
+        self.building_service.report_service = MagicMock()
+        input_geom = box(9.17, 48.773, 9.172, 48.775)
+
+        with patch.object(self.building_service, 'calculate_partition_stats') as mock_partition_stats:
+            precomputed_reports = self.building_service.process_geohash('u0wt8k', input_geom, {})
+        mock_partition_stats.assert_not_called()
+        self.building_service.use_precomputed_stats = False
+        live_reports = self.building_service.process_geohash('u0wt8k', input_geom, {})
+
+        self.assertEqual(len(live_reports), 4)
+        self.assertEqual(repr(precomputed_reports), repr(live_reports))
+
+    def test_stats_engine_imports_without_the_api(self):
+        logger.info("Testing that the preprocessing scripts can import the stats engine without the API's dependencies.")
+        code = "import sys; sys.modules['fastapi'] = sys.modules['orjson'] = None; import terrain_stats; assert 'main' not in sys.modules"
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_approximate_clip_reads_overview_within_budget(self):
+        logger.info("Testing that approximate raster stats read the finest overview that fits the pixel budget.")
+        with rasterio.open(self.raster_paths['slope'], 'r+') as dst:
+            dst.build_overviews([2, 4, 8], rasterio.enums.Resampling.average)
+        large = {"features": [{"geometry": box(9.1701, 48.7731, 9.1719, 48.7749).__geo_interface__}]}
+        small = {"features": [{"geometry": self.building_geom.__geo_interface__}]}
+
+        exact = self.raster_service.clip_raster_stats(large, self.raster_paths['slope'])
+        approximate = self.raster_service.clip_raster_stats(large, self.raster_paths['slope'], max_pixels=5000)
+
+        self.assertNotIn('overview_level', exact)
+        self.assertEqual(approximate['overview_level'], 2)  # 4x decimated, 2x would need ~8,100 pixels
+        self.assertGreaterEqual(approximate['min'], exact['min'])
+        self.assertLessEqual(approximate['max'], exact['max'])
+        self.assertEqual(
+            self.raster_service.clip_raster_stats(small, self.raster_paths['slope'], max_pixels=10000),
+            dict(self.raster_service.clip_raster_stats(small, self.raster_paths['slope']), overview_level=0)
+        )
+
+    def test_batch_clip_stats_share_one_mask(self):
+        logger.info("Testing that batched raster stats match per-raster stats while rasterizing the geometry once.")
+        geojson = {"features": [{"geometry": self.building_geom.buffer(0.0002).__geo_interface__}]}
+        tif_paths = list(self.raster_paths.values())
+
+        with patch('terrain_stats.geometry_mask', wraps=rasterio.features.geometry_mask) as mock_geometry_mask:
+            batch = self.raster_service.clip_rasters_stats(geojson, tif_paths)
+        self.assertEqual(mock_geometry_mask.call_count, 1)
+
+        for tif_path in tif_paths:
+            self.assertEqual(batch[tif_path], self.raster_service.clip_raster_stats(geojson, tif_path))
+
+        # The block stream and min/max pyramid paths also rasterize once for rasters on the same grid
+        self.raster_service.block_stream_min_pixels = 0
+        for build_sidecars in (lambda: None, lambda: [MinMaxPyramid.build(tif_path, cell_size=4) for tif_path in tif_paths]):
+            build_sidecars()
+            with patch('terrain_stats.geometry_mask', wraps=rasterio.features.geometry_mask) as mock_geometry_mask:
+                expected = {tif_path: self.raster_service.clip_raster_stats(geojson, tif_path) for tif_path in tif_paths}
+            single_count = mock_geometry_mask.call_count // len(tif_paths)
+            with patch('terrain_stats.geometry_mask', wraps=rasterio.features.geometry_mask) as mock_geometry_mask:
+                self.assertEqual(self.raster_service.clip_rasters_stats(geojson, tif_paths), expected)
+            self.assertEqual(mock_geometry_mask.call_count, single_count)
+
+    def test_block_streamed_stats_match_masked_stats(self):
+        logger.info("Testing that block-streamed raster stats match the full-crop mask path.")
+        with rasterio.open(self.raster_paths['slope']) as src:
+            self.assertLess(src.block_shapes[0][0], 200)  # several blocks per crop
+        # Edges on the pixel grid, where rasterizing each block on its own origin would select different pixels
+        apart = MultiPolygon([box(9.1701, 48.7731, 9.1705, 48.7733), box(9.1715, 48.7745, 9.1719, 48.7749)])
+        geometries = [
+            self.building_geom,
+            box(9.1701, 48.7731, 9.1719, 48.7749),
+            box(9.1695, 48.7735, 9.1705, 48.7745),  # partly outside the raster
+            apart
+        ]
+        streaming_service = RasterService(self.raster_paths, RasterDatasetPool())
+        streaming_service.block_stream_min_pixels = 0
+
+        try:
+            with rasterio.open(self.raster_paths['slope']) as src:
+                with patch.object(RasterService, 'read_masked_values', wraps=RasterService.read_masked_values) as mock_read:
+                    blocks = list(RasterService.iter_masked_blocks(src, [apart]))
+                self.assertEqual(mock_read.call_count, 6)  # the three blocks each part touches, not the 12 between them
+                self.assertEqual(len(blocks), 6)
+
+                with patch('terrain_stats.geometry_mask', wraps=rasterio.features.geometry_mask) as mock_geometry_mask:
+                    streaming_service.block_stream_stats(src, [geometries[1]])
+                # One mask per row of blocks, never one over the whole crop
+                self.assertEqual(mock_geometry_mask.call_count, 18)
+                self.assertTrue(all(call.kwargs['out_shape'][0] <= src.block_shapes[0][0] for call in mock_geometry_mask.call_args_list))
+
+            with patch('terrain_stats.mask', wraps=rasterio.mask.mask) as mock_mask:
+                for geom in geometries:
+                    geojson = {"features": [{"geometry": geom.__geo_interface__}]}
+                    self.assertEqual(
+                        streaming_service.clip_raster_stats(geojson, self.raster_paths['slope']),
+                        self.raster_service.clip_raster_stats(geojson, self.raster_paths['slope'])
+                    )
+                    self.assertAlmostEqual(
+                        streaming_service.get_raster_stats('slope', geom),
+                        self.raster_service.get_raster_stats('slope', geom),
+                        places=3
+                    )
+            self.assertEqual(mock_mask.call_count, 2 * len(geometries))  # only the non-streaming service masks
+        finally:
+            streaming_service.close()
+
+    def test_minmax_pyramid_matches_masked_stats(self):
+        logger.info("Testing that raster stats answered from the min/max pyramid match the full-crop mask path.")
+        with rasterio.open(self.raster_paths['slope'], 'r+') as dst:
+            # The maximum sits on a pixel the building's on-grid edge only touches through a pixel corner
+            dst.write(np.full((1, 1), 1000, dtype='float32'), 1, window=Window(52, 109, 1, 1))
+        MinMaxPyramid.build(self.raster_paths['slope'], cell_size=4)
+        geometries = [
+            self.building_geom,
+            box(9.1701, 48.7731, 9.1719, 48.7749),
+            box(9.1695, 48.7735, 9.1705, 48.7745)  # partly outside the raster
+        ]
+        exact_service = RasterService(self.raster_paths, RasterDatasetPool(), use_minmax_pyramids=False)
+
+        try:
+            with patch('terrain_stats.mask', wraps=rasterio.mask.mask) as mock_mask:
+                for geom in geometries:
+                    geojson = {"features": [{"geometry": geom.__geo_interface__}]}
+                    self.assertEqual(
+                        self.raster_service.clip_raster_stats(geojson, self.raster_paths['slope']),
+                        exact_service.clip_raster_stats(geojson, self.raster_paths['slope'])
+                    )
+            self.assertEqual(mock_mask.call_count, len(geometries))  # only the service without pyramids masks
+
+            # Boundary cells are masked from bands of rows, never from one mask over the whole crop
+            self.raster_service.mask_band_pixels = 200 * 16
+            geojson = {"features": [{"geometry": geometries[1].__geo_interface__}]}
+            with patch('terrain_stats.geometry_mask', wraps=rasterio.features.geometry_mask) as mock_geometry_mask:
+                self.assertEqual(
+                    self.raster_service.clip_raster_stats(geojson, self.raster_paths['slope']),
+                    exact_service.clip_raster_stats(geojson, self.raster_paths['slope'])
+                )
+            self.assertGreater(mock_geometry_mask.call_count, 1)
+            self.assertTrue(all(call.kwargs['out_shape'][0] <= 16 + 4 for call in mock_geometry_mask.call_args_list))
+
+            # A pyramid older than its raster is ignored
+            stat = os.stat(self.raster_paths['slope'])
+            os.utime(self.raster_paths['slope'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+            self.assertIsNone(self.raster_service.get_sidecar(MinMaxPyramid, self.raster_paths['slope']))
+        finally:
+            exact_service.close()
+
+    def test_summed_area_table_matches_masked_mean(self):
+        logger.info("Testing that zonal means from the summed-area table match the full-crop mask path.")
+        SummedAreaTable.build(self.raster_paths['solar'], cell_size=4, tile_size=64)
+        zones = {
+            'building': self.building_geom,  # on-grid edges through pixel corners
+            **self.building_service.get_zonal_geometries(self.building_geom),
+            'tiles': box(9.1701, 48.7731, 9.1719, 48.7749),  # spans several tiles
+            'outside': box(9.1695, 48.7735, 9.1705, 48.7745),  # partly outside the raster
+            'small': box(9.1702, 48.7735, 9.17028, 48.77358)
+        }
+        summed_service = RasterService(self.raster_paths, RasterDatasetPool(), use_summed_area_tables=True)
+
+        try:
+            expected_stats = self.raster_service.get_zones_stats('solar', zones)
+            with patch.object(summed_service, 'summed_area_interior', wraps=summed_service.summed_area_interior) as mock_interior:
+                zone_stats = summed_service.get_zones_stats('solar', zones)
+            self.assertEqual(mock_interior.call_count, 3)  # only the building, 'tiles' and 'outside' reach the pixel threshold
+            self.assertEqual(list(zone_stats), list(zones))
+            for key, expected_mean in expected_stats.items():
+                self.assertAlmostEqual(zone_stats[key], expected_mean, places=3)
+
+            summed_service.summed_area_min_pixels = 0
+            zone_geoms = np.array(list(zones.values()), dtype=object)
+            expected_means = self.raster_service.get_partition_zones_stats('solar', zone_geoms)
+            with patch.object(summed_service, 'summed_area_interior', wraps=summed_service.summed_area_interior) as mock_interior:
+                zone_means = summed_service.get_partition_zones_stats('solar', zone_geoms)
+            self.assertEqual(mock_interior.call_count, len(zones))
+            for zone_mean, expected_mean in zip(zone_means, expected_means):
+                self.assertAlmostEqual(zone_mean, expected_mean, places=3)
+
+            # A table older than its raster is ignored
+            stat = os.stat(self.raster_paths['solar'])
+            os.utime(self.raster_paths['solar'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+            with patch.object(summed_service, 'summed_area_interior') as mock_interior:
+                summed_service.get_zones_stats('solar', zones)
+            mock_interior.assert_not_called()
+        finally:
+            summed_service.close()
+
+    def test_missing_partitions_are_counted_in_the_summary(self):
+        logger.info("Testing that geohashes without a partition are logged at DEBUG and counted in the request summary.")
+        self.building_service.geohash_service = MagicMock()
+        self.building_service.geohash_service.geohash_grid_covering_polygon.return_value = ['u0wt8k', 'u0wt8m']
+        geojson = {"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": self.building_geom.__geo_interface__}]}
+
+        with self.assertLogs('main', level='INFO') as captured:
+            self.assertEqual(self.building_service.generate_building_reports(geojson, {}), [])
+        self.assertEqual(len(captured.records), 1)
+        self.assertIn("from 2 geohashes (2 without a partition)", captured.output[0])
+        self.assertEqual(captured.records[0].missing_partitions, 2)
+
+    def test_zones_outside_raster_are_nan(self):
+        logger.info("Testing that zones outside the raster extent return NaN.")
+        stats = self.raster_service.get_zones_stats('slope', {
+            'inside': self.building_geom,
+            'outside': box(0, 0, 1, 1)
+        })
+
+        self.assertFalse(np.isnan(stats['inside']))
+        self.assertTrue(np.isnan(stats['outside']))
+
+class TestCIUnitGeohashService(unittest.TestCase):
+    def setUp(self):
+        self.geohash_service = GeohashService()
+
+    def test_encode_cells_matches_pygeohash(self):
+        logger.info("Testing vectorized geohash encoding against pygeohash.")
+        rng = np.random.default_rng(7)
+        latitudes, longitudes = rng.uniform(-90, 90, 500), rng.uniform(-180, 180, 500)
+        for precision in (1, 6, 9):
+            _, _, cell_width, cell_height = GeohashService.cell_size(precision)
+            geohashes = GeohashService.encode_cells(
+                np.floor((longitudes + 180) / cell_width), np.floor((latitudes + 90) / cell_height), precision
+            )
+            self.assertEqual(list(geohashes), [pgh.encode(lat, lon, precision) for lat, lon in zip(latitudes, longitudes)])
+
+    def test_covering_polygon_wider_than_sampling_lattice(self):
+        logger.info("Testing that the geohash cover of a large polygon includes every cell it touches.")
+        polygon = Polygon([(9.0, 48.6), (9.4, 48.65), (9.35, 48.9), (9.05, 48.85), (9.0, 48.6)])
+
+        geohashes = self.geohash_service.geohash_grid_covering_polygon(polygon, resolution=6)
+
+        self.assertEqual(len(geohashes), len(set(geohashes)))
+        rng = np.random.default_rng(3)
+        for lon, lat in zip(rng.uniform(9.0, 9.4, 5000), rng.uniform(48.6, 48.9, 5000)):
+            if polygon.contains(Point(lon, lat)):
+                self.assertIn(pgh.encode(lat, lon, 6), geohashes)
+
+    def test_decode_bounds_matches_pygeohash(self):
+        logger.info("Testing vectorized geohash decoding against pygeohash.")
+        geohashes = ['u0wt8k', 'u0wt', 'ezs42e44yx96', 's']
+
+        bounds = GeohashService.decode_bounds(geohashes + ['not-a-geohash'])
+
+        for geohash, (lon_min, lat_min, lon_max, lat_max) in zip(geohashes, bounds):
+            lat, lon, lat_err, lon_err = pgh.decode_exactly(geohash)
+            np.testing.assert_allclose([lon_min, lat_min, lon_max, lat_max], [lon - lon_err, lat - lat_err, lon + lon_err, lat + lat_err])
+        self.assertTrue(np.isnan(bounds[-1]).all())
+
+    def test_filter_intersecting_geohashes(self):
+        logger.info("Testing that only geohashes intersecting the polygon are kept.")
+        polygon = box(9.1769, 48.7727, 9.1779, 48.7732)
+        inside = pgh.encode(48.773, 9.1774, 6)
+        outside = pgh.encode(48.9, 9.4, 6)
+
+        self.assertEqual(self.geohash_service.filter_intersecting_geohashes(polygon, [outside, inside, 'invalid!']), [inside])
+        self.assertEqual(self.geohash_service.filter_intersecting_geohashes(polygon, []), [])
+
+    def test_covering_small_polygon(self):
+        logger.info("Testing that a footprint-sized polygon is covered by the geohash containing it.")
+        polygon = box(9.1769, 48.7727, 9.1779, 48.7732)
+
+        self.assertEqual(
+            self.geohash_service.geohash_grid_covering_polygon(polygon, resolution=6),
+            [pgh.encode(48.773, 9.1774, 6)]
+        )
+
+class TestCIUnitBuildingPartitionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = {}
+        for geohash in ('u0wt8k', 'u0wt8m'):
+            path = os.path.join(self.tmp_dir.name, f"{geohash}.parquet")
+            gpd.GeoDataFrame(
+                {'gmlid': [f"{geohash}_{i}" for i in range(5)]},
+                geometry=[box(i, 0, i + 0.5, 0.5) for i in range(5)],
+                crs='EPSG:4326'
+            ).to_parquet(path)
+            self.paths[geohash] = path
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit_after_first_read(self):
+        logger.info("Testing that a cached partition is served without re-reading the parquet file.")
+        cache = BuildingPartitionCache()
+
+        first = cache.get('u0wt8k', self.paths['u0wt8k'])
+        with patch('main.gpd.read_parquet') as mock_read_parquet:
+            second = cache.get('u0wt8k', self.paths['u0wt8k'])
+            mock_read_parquet.assert_not_called()
+
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_invalidated_when_file_changes(self):
+        logger.info("Testing that a cached partition is re-read after the parquet file changes.")
+        cache = BuildingPartitionCache()
+        first = cache.get('u0wt8k', self.paths['u0wt8k'])
+
+        stat = os.stat(self.paths['u0wt8k'])
+        os.utime(self.paths['u0wt8k'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        second = cache.get('u0wt8k', self.paths['u0wt8k'])
+
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_least_recently_used_evicted_over_budget(self):
+        logger.info("Testing that the least recently used partition is evicted when over the byte budget.")
+        partition_bytes = BuildingPartitionCache.estimate_bytes(gpd.read_parquet(self.paths['u0wt8k']))
+        cache = BuildingPartitionCache(max_bytes=int(partition_bytes * 1.5))
+
+        cache.get('u0wt8k', self.paths['u0wt8k'])
+        cache.get('u0wt8m', self.paths['u0wt8m'])
+
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], cache.max_bytes)
+        cache.get('u0wt8m', self.paths['u0wt8m'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+class TestCIUnitResultCache(unittest.TestCase):
+    def setUp(self):
+        ring = [[9.1769, 48.7727], [9.1779, 48.7727], [9.1779, 48.7732], [9.1769, 48.7732], [9.1769, 48.7727]]
+        self.geojson = {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]}, "properties": {}}
+        ]}
+        # Same polygon, reversed orientation and another start vertex
+        vertices = ring[:-1][::-1]
+        rotated = vertices[1:] + vertices[:2]
+        self.equivalent_geojson = {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [rotated]}, "properties": {"name": "site"}}
+        ]}
+
+    def test_geometry_key_is_canonical(self):
+        logger.info("Testing that equivalent geometries share a cache key and rasters do not.")
+        key = ResultCache.geometry_key(self.geojson, 'rasterstats', 'cog_merged_slope.tif')
+
+        self.assertEqual(ResultCache.geometry_key(self.equivalent_geojson, 'rasterstats', 'cog_merged_slope.tif'), key)
+        self.assertNotEqual(ResultCache.geometry_key(self.geojson, 'rasterstats', 'cog_merged_aspect.tif'), key)
+        self.assertIsNone(ResultCache.geometry_key({"features": [{"geometry": None}]}, 'stats'))
+
+    def test_entries_expire_after_ttl(self):
+        logger.info("Testing that cached results are recomputed once their TTL has passed.")
+        cache = ResultCache(ttl_seconds=60)
+        compute = MagicMock(return_value={'min': 1.0, 'max': 2.0})
+
+        with patch('main.time.monotonic', return_value=1000):
+            cache.get_or_compute('key', compute)
+            cache.get_or_compute('key', compute)
+        self.assertEqual(compute.call_count, 1)
+
+        with patch('main.time.monotonic', return_value=1061):
+            cache.get_or_compute('key', compute)
+        self.assertEqual(compute.call_count, 2)
+
+    def test_least_recently_used_evicted_over_budget(self):
+        logger.info("Testing that the least recently used result is evicted when over the byte budget.")
+        cache = ResultCache(max_bytes=len(json.dumps(['x' * 100])) * 2)
+
+        cache.get_or_compute('a', lambda: ['x' * 100])
+        cache.get_or_compute('b', lambda: ['y' * 100])
+        cache.get_or_compute('a', lambda: ['x' * 100])
+        cache.get_or_compute('c', lambda: ['z' * 100])
+
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.get_or_compute('a', lambda: None), ['x' * 100])
+        self.assertIsNone(cache.get_or_compute('b', lambda: None))
+
+    def test_concurrent_requests_coalesced(self):
+        logger.info("Testing that concurrent identical requests wait on a single computation.")
+        cache = ResultCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'min': 1.0, 'max': 2.0}
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(cache.get_or_compute, 'key', compute)
+            started.wait(5)
+            others = [executor.submit(cache.get_or_compute, 'key', compute) for _ in range(3)]
+            while cache.stats()['coalesced'] < 3:
+                time.sleep(0.01)
+            release.set()
+            results = [first.result()] + [future.result() for future in others]
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result == {'min': 1.0, 'max': 2.0} for result in results))
+
+    def test_failures_are_not_cached(self):
+        logger.info("Testing that a failed computation is retried by the next request.")
+        cache = ResultCache()
+
+        with self.assertRaises(ValueError):
+            cache.get_or_compute('key', MagicMock(side_effect=ValueError("boom")))
+
+        self.assertEqual(cache.get_or_compute('key', lambda: 42), 42)
+
+    @patch('main.BuildingService.generate_building_reports')
+    def test_stats_endpoint_served_from_cache(self, mock_generate_reports):
+        logger.info("Testing that /stats computes a repeated polygon only once.")
+        mock_generate_reports.return_value = [{
+            "building_id": "b1",
+            "zonal_variation": {"north": {"slope": float('nan')}},
+            "zonal_variation_text": {},
+            "neighborhood_understanding": {},
+            "neighborhood_understanding_text": {}
+        }]
+        client = TestClient(GeoApp().app)
+
+        first = client.post("/stats", json={"geojson": self.geojson})
+        second = client.post("/stats", json={"geojson": self.equivalent_geojson})
+
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(mock_generate_reports.call_count, 1)
+
+class TestCIUnitWorkerPool(unittest.TestCase):
+    def test_available_cpus_follows_cgroup_quota(self):
+        logger.info("Testing that the worker count follows the cgroup CPU quota instead of the host CPU count.")
+        with patch('main.os.sched_getaffinity', return_value=set(range(16))), \
+                patch('builtins.open', mock_open(read_data="150000 100000")):
+            self.assertEqual(available_cpus(), 2)
+        with patch('main.os.sched_getaffinity', return_value=set(range(4))), \
+                patch('builtins.open', mock_open(read_data="max 100000")):
+            self.assertEqual(available_cpus(), 4)
+
+    def test_single_cpu_runs_inline(self):
+        logger.info("Testing that no worker processes are started when only one CPU is available.")
+        worker_pool = BuildingWorkerPool({}, processes=1)
+        worker_pool.start()
+        self.assertFalse(worker_pool.is_running)
+        worker_pool.close()
+
+    def test_pool_queue_depth_counts_tasks_not_started(self):
+        logger.info("Testing that the worker pool queue depth counts building tasks until a worker starts them.")
+        worker_pool = BuildingWorkerPool({}, processes=2)
+        worker_pool._pool = MagicMock()
+        worker_pool._pool.map.side_effect = lambda func, tasks, chunksize: [func(task) for task in tasks]
+
+        def task(_):
+            task_started()
+            return worker_pool.queue_depth()
+
+        with patch('building_reports._worker_queued_tasks', worker_pool._queued_tasks):
+            self.assertEqual(worker_pool.map(task, [1, 2, 3]), [2, 1, 0])
+        worker_pool._pool = None
+
+    def test_pool_started_only_for_per_building_mode(self):
+        logger.info("Testing that the worker pool is only started when buildings are processed one at a time.")
+        # Worker processes unpickle the pool's functions from building_reports, which imports neither main nor the API
+        self.assertEqual(process_building_task.__module__, 'building_reports')
+        code = "import sys; sys.modules['fastapi'] = None; import building_reports; assert 'main' not in sys.modules"
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for batch_mode, expected_starts in (('true', 0), ('false', 1)):
+                with patch.dict(os.environ, {'PARTITION_BATCH_MODE': batch_mode, 'JOB_DB_PATH': os.path.join(tmp_dir, 'jobs.sqlite')}):
+                    geo_app = GeoApp()
+                with patch.object(geo_app.worker_pool, 'start') as mock_start, TestClient(geo_app.app):
+                    pass
+                self.assertEqual(mock_start.call_count, expected_starts)
+
+class TestCIUnitMetrics(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        logger.info("Testing that stage latencies render as cumulative Prometheus histograms.")
+        latency_metrics = LatencyMetrics()
+        latency_metrics.observe('process_geohash', 0.003)
+        latency_metrics.observe('process_geohash', 2.0)
+
+        @latency_metrics.timed('get_zones_stats')
+        def failing_stage():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            failing_stage()
+
+        text = latency_metrics.render()
+        self.assertIn('geoterrain_stage_duration_seconds_bucket{stage="process_geohash",le="0.001"} 0', text)
+        self.assertIn('geoterrain_stage_duration_seconds_bucket{stage="process_geohash",le="0.005"} 1', text)
+        self.assertIn('geoterrain_stage_duration_seconds_bucket{stage="process_geohash",le="+Inf"} 2', text)
+        self.assertIn('geoterrain_stage_duration_seconds_count{stage="process_geohash"} 2', text)
+        self.assertIn('geoterrain_stage_duration_seconds_count{stage="get_zones_stats"} 1', text)
+
+    @patch('main.BuildingService.generate_building_reports')
+    def test_metrics_endpoint(self, mock_generate_reports):
+        logger.info("Testing that /metrics exposes stage histograms, cache ratios and queue depths.")
+        mock_generate_reports.return_value = []
+        client = TestClient(GeoApp().app)
+        client.post("/stats", json={"geojson": {"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+        }]}})
+
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertIn('geoterrain_stage_duration_seconds_count{stage="serialize"}', response.text)
+        self.assertIn('geoterrain_cache_hit_ratio{cache="results"} 0.0', response.text)
+        self.assertIn('geoterrain_queue_depth{pool="geohash_executor"} 0', response.text)
+
+    @patch('main.BuildingService.generate_building_reports')
+    def test_stats_response_carries_server_timing(self, mock_generate_reports):
+        logger.info("Testing that /stats responses break their time down in a Server-Timing header.")
+        mock_generate_reports.return_value = [{"building_id": "b1", "zonal_variation": {"north": {"slope": float('nan')}}}]
+        client = TestClient(GeoApp().app)
+        response = client.post("/stats", json={"geojson": {"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+        }]}})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["building_reports"][0]["zonal_variation"], {"north": {"slope": None}})
+        stages = [entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")]
+        self.assertIn("serialize", stages)
+        self.assertEqual(stages[-1], "total")
+        self.assertNotIn("x-profile-id", response.headers)
+
+    @patch('main.BuildingService.generate_building_reports')
+    def test_stats_columnar_formats(self, mock_generate_reports):
+        logger.info("Testing that /stats returns one row per building and zone as column JSON and Arrow.")
+        mock_generate_reports.return_value = [{
+            "building_id": "b1",
+            "zonal_variation": {"north": {"slope": float('nan'), "aspect": 90.0, "solar": 0.5}},
+            "zonal_variation_text": {"north": {"slope": "s", "aspect": "a", "solar": "p"}},
+            "neighborhood_understanding": {"east": {"slope": 3.0, "aspect": np.float32(45.0)}},
+            "neighborhood_understanding_text": {"east": {"slope": "s", "aspect": "a"}}
+        }]
+        client = TestClient(GeoApp().app)
+        geojson = {"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+        }]}
+
+        columns = client.post("/stats?format=columnar", json={"geojson": geojson}).json()
+        self.assertEqual(columns["building_id"], ["b1", "b1"])
+        self.assertEqual(columns["group"], ["zonal", "neighborhood"])
+        self.assertEqual(columns["zone"], ["north", "east"])
+        self.assertEqual(columns["slope"], [None, 3.0])
+        self.assertEqual(columns["aspect"], [90.0, 45.0])
+        self.assertEqual(columns["solar"], [0.5, None])
+        self.assertEqual(columns["solar_text"], ["p", None])
+
+        response = client.post("/stats?format=arrow", json={"geojson": geojson})
+        self.assertEqual(response.headers["content-type"], ReportColumns.arrow_media_type)
+        table = pa.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.column("slope").to_pylist(), [None, 3.0])
+        self.assertEqual(table.column("zone").to_pylist(), ["north", "east"])
+        self.assertEqual(mock_generate_reports.call_count, 1)
+
+    def test_profiled_request_stores_collapsed_stacks(self):
+        logger.info("Testing that profile=true stores the request's sampled stacks as a flamegraph file.")
+        geo_app = GeoApp()
+        client = TestClient(geo_app.app)
+        geojson = {"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+        }]}
+
+        def slow_building_reports(geojson, raster_stats):
+            time.sleep(0.1)
+            return []
+
+        with tempfile.TemporaryDirectory() as profile_dir, \
+                patch('main.BuildingService.generate_building_reports', side_effect=slow_building_reports):
+            geo_app.profile_dir = profile_dir
+            self.assertFalse(geo_app.request_profiling)  # opt-in
+            self.assertNotIn('x-profile-id', client.post("/stats?profile=true", json={"geojson": geojson}).headers)
+
+            geo_app.request_profiling = True
+            geo_app.profile_max_count = 1
+            first = client.post("/stats?profile=true", json={"geojson": geojson})
+            response = client.post("/stats?profile=true", json={"geojson": geojson})
+            profile = client.get(f"/profiles/{response.headers['x-profile-id']}")
+
+            self.assertEqual(profile.status_code, 200)
+            stack, count = profile.text.splitlines()[0].rsplit(" ", 1)
+            self.assertIn("slow_building_reports", stack)
+            self.assertGreater(int(count), 0)
+            self.assertEqual(client.get("/profiles/../../etc/passwd").status_code, 404)
+            # Only the newest profile_max_count profiles are kept
+            self.assertEqual(client.get(f"/profiles/{first.headers['x-profile-id']}").status_code, 404)
+            self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+class TestCIUnitLogging(unittest.TestCase):
+    def test_json_formatter_keeps_extra_fields(self):
+        logger.info("Testing that structured log lines carry their extra fields.")
+        record = logging.LogRecord('main', logging.INFO, __file__, 1, "Generated reports for %s buildings.", (3,), None)
+        record.buildings = 3
+        entry = json.loads(JsonLogFormatter().format(record))
+        self.assertEqual(entry['message'], "Generated reports for 3 buildings.")
+        self.assertEqual(entry['level'], "INFO")
+        self.assertEqual(entry['buildings'], 3)
+        self.assertNotIn('args', entry)
+
+    def test_per_item_lines_stay_below_info(self):
+        logger.info("Testing that interpretation and zone geometry lines are DEBUG only.")
+        service = BuildingService(MagicMock(), MagicMock(), MagicMock(), tempfile.gettempdir())
+        with self.assertLogs(level='DEBUG') as captured:
+            InterpretationService().interpret_slope(12.0)
+            service.get_zonal_geometries(box(0, 0, 10, 10))
+        self.assertTrue(captured.records)
+        self.assertTrue(all(record.levelno == logging.DEBUG for record in captured.records))
+
+
+class TestCIUnitGeohashFanOut(unittest.TestCase):
+    def test_reports_ordered_and_concurrency_limited(self):
+        logger.info("Testing parallel geohash fan-out keeps geohash order and the per-request limit.")
+        geohashes = ['u0wt8h', 'u0wt8j', 'u0wt8k', 'u0wt8m', 'u0wt8n', 'u0wt8p']
+        lock = threading.Lock()
+        running = {'now': 0, 'peak': 0}
+
+        def process_geohash(geohash, input_geom, raster_stats, sample=True, feature_tree=None):
+            with lock:
+                running['now'] += 1
+                running['peak'] = max(running['peak'], running['now'])
+            time.sleep(0.01 * (len(geohashes) - geohashes.index(geohash)))
+            with lock:
+                running['now'] -= 1
+            return [{'building_id': f"{geohash}_{i}"} for i in range(2)]
+
+        geohash_service = MagicMock()
+        geohash_service.geohash_grid_covering_polygon.return_value = list(reversed(geohashes))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            building_service = BuildingService(
+                None, geohash_service, None, '', geohash_executor=executor, max_concurrent_geohashes=2
+            )
+            building_service.process_geohash = process_geohash
+            reports = building_service.generate_building_reports({
+                "type": "FeatureCollection",
+                "features": [{"type": "Feature", "properties": {}, "geometry": {
+                    "type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]
+                }}]
+            }, {})
+
+        self.assertEqual([report['building_id'] for report in reports], [f"{geohash}_{i}" for geohash in geohashes for i in range(2)])
+        self.assertEqual(running['peak'], 2)
+
+    def test_geohash_queue_depth_counts_waiting_geohashes(self):
+        logger.info("Testing that the geohash queue depth counts submitted geohashes until they start.")
+        started, release = threading.Event(), threading.Event()
+
+        def process_geohash(geohash, input_geom, raster_stats, sample=True, feature_tree=None):
+            started.set()
+            release.wait(5)
+            return []
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            building_service = BuildingService(
+                None, MagicMock(), None, '', geohash_executor=executor, max_concurrent_geohashes=3
+            )
+            building_service.process_geohash = process_geohash
+            consumer = threading.Thread(target=lambda: list(building_service.iter_geohash_reports(['u0wt8h', 'u0wt8j', 'u0wt8k'], None, {})))
+            consumer.start()
+            started.wait(5)
+            self.assertEqual(building_service.geohash_queue_depth(), 2)  # one running on the only thread
+            release.set()
+            consumer.join(5)
+        self.assertEqual(building_service.geohash_queue_depth(), 0)
+
+class TestCIUnitJobsAPI(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        with patch.dict(os.environ, {'JOB_DB_PATH': os.path.join(self.tmp_dir.name, 'jobs.sqlite')}):
+            self.geo_app = GeoApp()
+        self.client = TestClient(self.geo_app.app)
+
+    def tearDown(self):
+        self.geo_app.job_service.close()
+        self.tmp_dir.cleanup()
+
+    def wait_for_job(self, job_id):
+        for _ in range(100):
+            job = self.client.get(f"/jobs/{job_id}").json()
+            if job["status"] in ("completed", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} did not finish.")
+
+    @patch('main.BuildingService.stream_building_reports')
+    def test_job_runs_in_background_with_paginated_results(self, mock_stream):
+        logger.info("Testing /jobs/stats submission, progress and paginated results.")
+        mock_stream.return_value = iter([
+            {"event": "progress", "geohashes_done": 0, "geohashes_total": 2},
+            {"event": "building_report", "data": {"building_id": "b1", "zonal_variation": {}, "zonal_variation_text": {}, "neighborhood_understanding": {}, "neighborhood_understanding_text": {}}},
+            {"event": "building_report", "data": {"building_id": "b2", "zonal_variation": {}, "zonal_variation_text": {}, "neighborhood_understanding": {}, "neighborhood_understanding_text": {}}},
+            {"event": "progress", "geohashes_done": 1, "geohashes_total": 2, "geohash": "u0wt8k"},
+            {"event": "building_report", "data": {"building_id": "b3", "zonal_variation": {}, "zonal_variation_text": {}, "neighborhood_understanding": {}, "neighborhood_understanding_text": {}}},
+            {"event": "progress", "geohashes_done": 2, "geohashes_total": 2, "geohash": "u0wt8m"},
+            {"event": "complete", "building_count": 3}
+        ])
+
+        response = self.client.post(
+            "/jobs/stats",
+            json={
+                "geojson": {
+                    "type": "FeatureCollection",
+                    "features": [{
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]
+                        }
+                    }]
+                }
+            }
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job_id"]
+
+        job = self.wait_for_job(job_id)
+        self.assertEqual(job["status"], "completed")
+        self.assertEqual(job["geohashes_done"], 2)
+        self.assertEqual(job["building_count"], 3)
+        self.assertEqual(mock_stream.call_args.kwargs["sample"], False)
+
+        first_page = self.client.get(f"/jobs/{job_id}?offset=0&limit=2").json()
+        self.assertEqual([report["building_id"] for report in first_page["results"]], ["b1", "b2"])
+        self.assertEqual(first_page["next_offset"], 2)
+        second_page = self.client.get(f"/jobs/{job_id}?offset=2&limit=2").json()
+        self.assertEqual([report["building_id"] for report in second_page["results"]], ["b3"])
+        self.assertIsNone(second_page["next_offset"])
+
+    @patch('main.BuildingService.stream_building_reports')
+    def test_failed_job_reports_error(self, mock_stream):
+        logger.info("Testing that a failing job is marked as failed with its error.")
+        mock_stream.side_effect = RuntimeError("raster unavailable")
+
+        job_id = self.client.post(
+            "/jobs/stats",
+            json={"geojson": {"type": "FeatureCollection", "features": []}}
+        ).json()["job_id"]
+
+        job = self.wait_for_job(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "raster unavailable")
+
+    @patch('main.BuildingService.stream_building_reports')
+    def test_queue_depth_counts_waiting_jobs(self, mock_stream):
+        logger.info("Testing that the job queue depth counts jobs waiting for the single job worker.")
+        release = threading.Event()
+
+        def blocked_stream(*args, **kwargs):
+            release.wait(5)
+            yield {"event": "complete", "building_count": 0}
+        mock_stream.side_effect = blocked_stream
+        geojson = {"type": "FeatureCollection", "features": []}
+
+        first_id = self.client.post("/jobs/stats", json={"geojson": geojson}).json()["job_id"]
+        second_id = self.client.post("/jobs/stats", json={"geojson": geojson}).json()["job_id"]
+        for _ in range(100):
+            if self.client.get(f"/jobs/{first_id}").json()["status"] == "running":
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.geo_app.job_service.queue_depth(), 1)
+
+        release.set()
+        self.assertEqual(self.wait_for_job(second_id)["status"], "completed")
+        self.assertEqual(self.geo_app.job_service.queue_depth(), 0)
+
+    @patch('main.BuildingService.stream_building_reports')
+    def test_finished_jobs_deleted_after_retention(self, mock_stream):
+        logger.info("Testing that finished jobs and their results are deleted once their retention has passed.")
+        mock_stream.side_effect = lambda *args, **kwargs: iter([
+            {"event": "building_report", "data": {"building_id": "b1", "zonal_variation": {}, "zonal_variation_text": {}, "neighborhood_understanding": {}, "neighborhood_understanding_text": {}}},
+            {"event": "progress", "geohashes_done": 1, "geohashes_total": 1}
+        ])
+        geojson = {"type": "FeatureCollection", "features": []}
+        old_id = self.client.post("/jobs/stats", json={"geojson": geojson}).json()["job_id"]
+        self.assertEqual(self.wait_for_job(old_id)["building_count"], 1)
+
+        self.client.post("/jobs/stats", json={"geojson": geojson})
+        self.assertEqual(self.client.get(f"/jobs/{old_id}").status_code, 200)  # still within its retention
+
+        self.geo_app.job_service.retention_seconds = 0
+        new_id = self.client.post("/jobs/stats", json={"geojson": geojson}).json()["job_id"]
+        self.assertEqual(self.client.get(f"/jobs/{old_id}").status_code, 404)
+        self.assertEqual(self.geo_app.job_service.job_store.get_results(old_id, 0, 10), [])
+        self.assertEqual(self.wait_for_job(new_id)["status"], "completed")
+
+    def test_unknown_job_not_found(self):
+        logger.info("Testing /jobs/{job_id} with an unknown job id.")
+        response = self.client.get("/jobs/does-not-exist")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"detail": "Job not found."})
+
 if __name__ == '__main__':
     unittest.main()
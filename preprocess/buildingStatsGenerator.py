@@ -0,0 +1,115 @@
+import os
+import sys
+import tqdm
+import geopandas as gpd
+import pyarrow.parquet as pq
+import multiprocessing
+
+# The stats are computed with the API's own engine, so precomputed and live values are identical.
+# terrain_stats only needs the raster libraries, importing it does not start the API.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker', 'backend', 'fastapi'))
+from terrain_stats import BuildingStatsEngine, BuildingStatsStore, RasterDatasetPool, RasterService
+
+_worker_stats_engine = None
+
+
+class BuildingStatsGenerator:
+    def __init__(self, db_dir, raster_paths, num_workers=4, overwrite=False):
+        """
+        Initialize the BuildingStatsGenerator with the geohash database and the terrain COGs.
+        """
+        self.db_dir = db_dir
+        self.raster_paths = raster_paths
+        self.num_workers = num_workers
+        self.overwrite = overwrite
+
+    def get_stats_engine(self):
+        """
+        Create the BuildingStatsEngine once per worker process.
+        """
+        global _worker_stats_engine
+        if _worker_stats_engine is None:
+            _worker_stats_engine = BuildingStatsEngine(RasterService(self.raster_paths, RasterDatasetPool()))
+        return _worker_stats_engine
+
+    def list_partitions(self):
+        """
+        Geohashes with a buildings.parquet whose building_stats.parquet is missing or outdated.
+        """
+        geohashes = []
+        for geohash in sorted(os.listdir(self.db_dir)):
+            building_path = os.path.join(self.db_dir, geohash, 'buildings.parquet')
+            stats_path = os.path.join(self.db_dir, geohash, BuildingStatsStore.filename)
+            if not os.path.exists(building_path):
+                continue
+            if not self.overwrite and os.path.exists(stats_path) and os.path.getmtime(stats_path) >= os.path.getmtime(building_path):
+                continue
+            geohashes.append(geohash)
+        return geohashes
+
+    def process_partition(self, geohash):
+        """
+        Compute zonal_variation and neighborhood_understanding for every building of a partition.
+        """
+        stats_engine = self.get_stats_engine()
+        building_df = gpd.read_parquet(os.path.join(self.db_dir, geohash, 'buildings.parquet'))
+        building_df = building_df[building_df['gmlid'].notna()].drop_duplicates(subset='gmlid')
+
+        # The partition-wide engine the API uses by default (PARTITION_BATCH_MODE=true)
+        building_stats = stats_engine.calculate_partition_stats(building_df.geometry.to_numpy())
+
+        table = BuildingStatsStore.to_table(building_df['gmlid'].tolist(), building_stats, stats_engine.zone_rasters)
+        output_file = os.path.join(self.db_dir, geohash, BuildingStatsStore.filename)
+        # Write next to the target and rename, so the API never reads a half-written file
+        pq.write_table(table, output_file + '.tmp')
+        os.replace(output_file + '.tmp', output_file)
+        return len(building_stats)
+
+    def worker_process(self, geohash):
+        """
+        Wrapper function for multiprocessing workers.
+        """
+        try:
+            return f"Processed {geohash}: {self.process_partition(geohash)} buildings"
+        except Exception as e:
+            return f"Failed {geohash}: {e}"
+
+    def generate(self):
+        """
+        Main function to precompute building stats for every geohash partition using multiprocessing.
+        """
+        geohashes = self.list_partitions()
+        print(f'Found {len(geohashes)} partitions to process')
+
+        failures = []
+        with multiprocessing.Pool(processes=self.num_workers) as pool:
+            for result in tqdm.tqdm(pool.imap_unordered(self.worker_process, geohashes), total=len(geohashes)):
+                if result.startswith('Failed'):
+                    failures.append(result)
+
+        for failure in failures:
+            print(failure)
+        print("Processing complete!")
+
+
+if __name__ == "__main__":
+
+    # Ideally, Output from dbGenerator.py -> 'data/output/db/'
+    db_dir = 'data/output/db/'
+
+    # The same Cloud Optimized GeoTIFFs the API serves, see data/raster/README.md
+    raster_dir = '../data/raster/'
+    raster_paths = {
+        'slope': os.path.join(raster_dir, 'cog_merged_slope.tif'),
+        'aspect': os.path.join(raster_dir, 'cog_merged_aspect.tif'),
+        'solar': os.path.join(raster_dir, 'cog_global_solar_potential.tif')
+    }
+
+    generator = BuildingStatsGenerator(
+        db_dir=db_dir,
+        raster_paths=raster_paths,
+        num_workers=os.cpu_count()-1
+    )
+
+    # Run the precomputation
+    generator.generate()
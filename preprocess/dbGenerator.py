@@ -7,6 +7,9 @@ from shapely.geometry import box
 
 
 class GeohashPartitioner:
+    # Small row groups for the buildings, whose reads the API prunes by bbox
+    building_row_group_size = 256
+
     def __init__(self, geohash_grid_file, dtm_parquet_files, buildings_parquet_files, parcels_parquet_files, output_base_dir, num_workers=4):
         """
         Initialize the GeohashPartitioner with the required parameters.
@@ -38,9 +41,9 @@ class GeohashPartitioner:
         return gdf.total_bounds  # Returns (minx, miny, maxx, maxy)
 
     @staticmethod
-    def clip_and_save_geoparquet(gdfs, geohash_geom, output_file):
+    def clip_and_save_geoparquet(gdfs, geohash_geom, output_file, row_group_size=None):
         """
-        Clip and save the combined GeoDataFrames to a GeoParquet file.
+        Clip and save the combined GeoDataFrames to a GeoParquet 1.1 file.
         """
         # Concatenate all the GeoDataFrames before clipping
         combined_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
@@ -49,7 +52,9 @@ class GeohashPartitioner:
         clipped_gdf = combined_gdf[combined_gdf.intersects(geohash_geom)]
         
         if not clipped_gdf.empty:
-            clipped_gdf.to_parquet(output_file)
+            # Hilbert-sorted row groups with bbox column statistics let the API skip row groups outside a query
+            clipped_gdf = clipped_gdf.loc[clipped_gdf.hilbert_distance().sort_values(kind='stable').index]
+            clipped_gdf.to_parquet(output_file, schema_version='1.1.0', write_covering_bbox=True, row_group_size=row_group_size)
 
     def process_geohash_grid(self, geohash_row, dtm_parquet_bounds, buildings_parquet_bounds, parcels_parquet_bounds):
         """
@@ -65,14 +70,14 @@ class GeohashPartitioner:
         self._process_data_for_geohash(geohash_geom, dtm_parquet_bounds, geohash_folder, "dtm.parquet")
 
         # Step 3: Accumulate and save Buildings data for this geohash
-        self._process_data_for_geohash(geohash_geom, buildings_parquet_bounds, geohash_folder, "buildings.parquet")
+        self._process_data_for_geohash(geohash_geom, buildings_parquet_bounds, geohash_folder, "buildings.parquet", self.building_row_group_size)
 
         # Step 4: Accumulate and save Parcels data for this geohash
         self._process_data_for_geohash(geohash_geom, parcels_parquet_bounds, geohash_folder, "parcel.parquet")
 
         return f"Processed {geohash_string}"
 
-    def _process_data_for_geohash(self, geohash_geom, parquet_bounds, geohash_folder, output_filename):
+    def _process_data_for_geohash(self, geohash_geom, parquet_bounds, geohash_folder, output_filename, row_group_size=None):
         """
         Helper function to process data for a specific geohash and save the output.
         """
@@ -84,7 +89,7 @@ class GeohashPartitioner:
 
         if gdfs:
             output_file = os.path.join(geohash_folder, output_filename)
-            self.clip_and_save_geoparquet(gdfs, geohash_geom, output_file)
+            self.clip_and_save_geoparquet(gdfs, geohash_geom, output_file, row_group_size)
 
     def worker_process(self, args):
         """
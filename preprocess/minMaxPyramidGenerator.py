@@ -0,0 +1,59 @@
+import os
+import sys
+import glob
+import tqdm
+
+# The sidecars are written with the API's own MinMaxPyramid, so /rasterstats reads exactly this layout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker', 'backend', 'fastapi'))
+from terrain_stats import MinMaxPyramid
+
+
+class MinMaxPyramidGenerator:
+    def __init__(self, raster_dir, cell_size=MinMaxPyramid.default_cell_size, overwrite=False):
+        """
+        Initialize the MinMaxPyramidGenerator with the directory of COGs served by /rasterstats.
+        """
+        self.raster_dir = raster_dir
+        self.cell_size = cell_size
+        self.overwrite = overwrite
+
+    def list_rasters(self):
+        """
+        Rasters whose {raster}.minmax/ sidecar is missing or outdated.
+        """
+        raster_paths = []
+        for raster_path in sorted(glob.glob(os.path.join(self.raster_dir, '*.tif'))):
+            meta_path = os.path.join(MinMaxPyramid.sidecar_dir(raster_path), MinMaxPyramid.meta_filename)
+            if not self.overwrite and os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(raster_path):
+                continue
+            raster_paths.append(raster_path)
+        return raster_paths
+
+    def generate(self):
+        """
+        Build the min/max pyramid of every raster, one raster at a time to keep memory bounded.
+        """
+        raster_paths = self.list_rasters()
+        print(f'Found {len(raster_paths)} rasters to process')
+
+        failures = []
+        for raster_path in tqdm.tqdm(raster_paths):
+            try:
+                MinMaxPyramid.build(raster_path, cell_size=self.cell_size)
+            except Exception as e:
+                failures.append(f"Failed {raster_path}: {e}")
+
+        for failure in failures:
+            print(failure)
+        print("Processing complete!")
+
+
+if __name__ == "__main__":
+
+    # The same Cloud Optimized GeoTIFFs the API serves, see data/raster/README.md
+    raster_dir = '../data/raster/'
+
+    generator = MinMaxPyramidGenerator(raster_dir=raster_dir)
+
+    # Build the sidecars next to the rasters
+    generator.generate()
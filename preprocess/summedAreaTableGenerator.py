@@ -0,0 +1,62 @@
+import os
+import sys
+import tqdm
+
+# The sidecars are written with the API's own SummedAreaTable, so RasterService reads exactly this layout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker', 'backend', 'fastapi'))
+from terrain_stats import SummedAreaTable
+
+
+class SummedAreaTableGenerator:
+    def __init__(self, raster_paths, overwrite=False):
+        """
+        Initialize the SummedAreaTableGenerator with the terrain COGs used for zonal means.
+        """
+        self.raster_paths = raster_paths
+        self.overwrite = overwrite
+
+    def list_rasters(self):
+        """
+        Rasters whose {raster}.sat/ sidecar is missing or outdated.
+        """
+        raster_paths = []
+        for raster_path in self.raster_paths:
+            meta_path = os.path.join(SummedAreaTable.sidecar_dir(raster_path), SummedAreaTable.meta_filename)
+            if not self.overwrite and os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(raster_path):
+                continue
+            raster_paths.append(raster_path)
+        return raster_paths
+
+    def generate(self):
+        """
+        Build the summed-area tables of every raster, one tile at a time to keep memory bounded.
+        """
+        raster_paths = self.list_rasters()
+        print(f'Found {len(raster_paths)} rasters to process')
+
+        failures = []
+        for raster_path in tqdm.tqdm(raster_paths):
+            try:
+                SummedAreaTable.build(raster_path)
+            except Exception as e:
+                failures.append(f"Failed {raster_path}: {e}")
+
+        for failure in failures:
+            print(failure)
+        print("Processing complete!")
+
+
+if __name__ == "__main__":
+
+    # The rasters behind the zonal and neighborhood stats, see data/raster/README.md
+    raster_dir = '../data/raster/'
+    raster_paths = [
+        os.path.join(raster_dir, 'cog_merged_slope.tif'),
+        os.path.join(raster_dir, 'cog_merged_aspect.tif'),
+        os.path.join(raster_dir, 'cog_global_solar_potential.tif')
+    ]
+
+    generator = SummedAreaTableGenerator(raster_paths=raster_paths)
+
+    # Build the sidecars next to the rasters
+    generator.generate()